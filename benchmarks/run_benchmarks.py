@@ -0,0 +1,317 @@
+"""Benchmark the preprocess_* commands against synthetic datasets
+
+Each command is run as it would be from the command line, in a fresh process so that
+its peak memory is its own, recording the time taken, peak resident memory and bytes
+read and written. Results are written as JSON, keyed by the commit benchmarked, for
+comparing runs with `compare`:
+
+    python benchmarks/run_benchmarks.py run --size small --frequencies day
+    python benchmarks/run_benchmarks.py compare results/a.json results/b.json
+"""
+import argparse
+import concurrent.futures
+import datetime as dt
+import logging
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import time
+
+import orjson
+
+from synthetic import FREQUENCIES, SIZES, generate_dataset, generate_reference
+
+
+# Frequencies run unless others are asked for. Monthly datasets can't be written under
+# pandas 3, as download-toolbox resamples them with the "M" offset it no longer accepts
+DEFAULT_FREQUENCIES = ["day"]
+
+
+def _split_args(start_year: int, years: int) -> list:
+    return ["-sn", "train,val",
+            "-ss", "{}-01-01,{}-01-01".format(start_year, start_year + years - 1),
+            "-se", "{}-12-31,{}-06-30".format(start_year + years - 2, start_year + years - 1)]
+
+
+def _all_dates_split_args(start_year: int, years: int) -> list:
+    return ["-sn", "all", "-ss", "{}-01-01".format(start_year), "-se", "{}-12-31".format(start_year + years - 1)]
+
+
+def command_args(command: str, context: dict) -> list:
+    """The arguments to run `command` with against the datasets in `context`
+
+    :param command: Name of the preprocess_* command, without the prefix
+    :param context: dict of the benchmark datasets, as from prepare
+    :return:
+    """
+    projected, latlon, ref_file = context["projected"], context["latlon"], context["reference"]
+    output = ["-p", context["output_path"]]
+    all_dates = _all_dates_split_args(context["start_year"], context["years"])
+
+    return dict(
+        missing_time=[projected, "missing_time", "-n", "uas,vas", *output, *all_dates],
+        missing_spatial=[projected, "missing_spatial", "-n", "uas,vas", *output, *all_dates],
+        regrid=[latlon, ref_file, "regrid", *output, *all_dates],
+        rotate=[projected, ref_file, "rotate", "-n", "uas,vas", *output, *all_dates],
+        dataset=[context["complete"], "dataset", "--abs", "uas", "--anom", "vas", "--trends", "uas",
+                 "-ps", "train", "-sh", "3", "-st", "3", *output,
+                 *_split_args(context["start_year"], context["years"])],
+        pipeline=[latlon, "pipeline", "regrid,rotate,missing_time,missing_spatial", "-r", ref_file, *output],
+    )[command]
+
+
+COMMANDS = dict(
+    missing_time="preprocess_toolbox.dataset.cli:missing_time",
+    missing_spatial="preprocess_toolbox.dataset.cli:missing_spatial",
+    regrid="preprocess_toolbox.dataset.cli:regrid",
+    rotate="preprocess_toolbox.dataset.cli:rotate",
+    dataset="preprocess_toolbox.dataset.cli:process_dataset",
+    pipeline="preprocess_toolbox.dataset.cli:pipeline",
+)
+
+
+def _io_counters() -> dict:
+    # Bytes passed through read and write calls, whether or not they reached storage
+    try:
+        with open("/proc/self/io") as fh:
+            counters = dict([line.split(": ") for line in fh.read().splitlines()])
+        return dict(bytes_read=int(counters["rchar"]), bytes_written=int(counters["wchar"]))
+    except (OSError, KeyError):
+        return dict(bytes_read=None, bytes_written=None)
+
+
+class _ErrorRecords(logging.Handler):
+    """Keep the errors logged, as commands log some failures rather than raising them"""
+
+    def __init__(self):
+        super().__init__(level=logging.ERROR)
+        self.records = list()
+
+    def emit(self, record: logging.LogRecord) -> None:
+        self.records.append(record)
+
+
+def run_command(command: str,
+                context: dict) -> dict:
+    """Run a command in this process, measuring it
+
+    This is intended to run in a fresh process, as peak memory covers the whole process.
+    A command that logs an error, such as for files it couldn't rotate, has failed
+    even if it carries on to the end.
+
+    :param command:
+    :param context:
+    :return: dict of measurements
+    """
+    import importlib
+
+    module_name, function_name = COMMANDS[command].split(":")
+    entry_point = getattr(importlib.import_module(module_name), function_name)
+
+    # The source configuration is copied, as the commands write back to the one they're given
+    args = command_args(command, context)
+    source = os.path.join(context["work_path"], "{}.{}".format(command, os.path.basename(args[0])))
+    shutil.copy(args[0], source)
+    sys.argv = ["preprocess_{}".format(command), source, *args[1:]]
+    # Some outputs and temporary files are relative to the working directory
+    os.chdir(context["work_path"])
+
+    errors = _ErrorRecords()
+    logging.getLogger().addHandler(errors)
+
+    io_start = _io_counters()
+    start = time.perf_counter()
+    entry_point()
+    seconds = time.perf_counter() - start
+    io_end = _io_counters()
+
+    if len(errors.records) > 0:
+        raise RuntimeError("{} logged {} errors, the first: {}".
+                           format(command, len(errors.records), errors.records[0].getMessage()))
+
+    # ru_maxrss is in kilobytes on Linux
+    peak_rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                   resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) * 1024
+    return dict(seconds=seconds,
+                peak_rss_bytes=peak_rss,
+                **{key: None if io_start[key] is None else io_end[key] - io_start[key]
+                   for key in io_start.keys()})
+
+
+def prepare(work_path: os.PathLike,
+            size: str,
+            frequency: str,
+            grid: int = None,
+            years: int = None,
+            **kwargs) -> dict:
+    """Generate the datasets the commands are benchmarked against
+
+    :param work_path:
+    :param size: Key of synthetic.SIZES
+    :param frequency: Key of synthetic.FREQUENCIES
+    :param grid: Grid size to use instead of that of `size`
+    :param years: Number of years to use instead of that of `size`
+    :param kwargs: Further arguments for synthetic.generate_dataset
+    :return: dict of the datasets and settings, for command_args
+    """
+    size = SIZES[size]
+    size = type(size)(grid=size.grid if grid is None else grid,
+                      years=size.years if years is None else years)
+    data_path = os.path.join(work_path, "data")
+
+    datasets = dict()
+    for grid_type in ["projected", "latlon"]:
+        ds_config = generate_dataset(data_path, grid_type, ["uas", "vas"], size,
+                                     frequency=frequency, grid_type=grid_type, **kwargs)
+        datasets[grid_type] = ds_config.config_path
+
+    # Processing expects the gaps in time to have been filled already
+    ds_config = generate_dataset(data_path, "complete", ["uas", "vas"], size,
+                                 frequency=frequency, **dict(kwargs, missing_fraction=0.))
+    datasets["complete"] = ds_config.config_path
+
+    return dict(output_path=os.path.join(work_path, "output"),
+                reference=generate_reference(os.path.join(work_path, "ref.nc"), size.grid),
+                start_year=kwargs.get("start_year", 2000),
+                work_path=work_path,
+                years=size.years,
+                **datasets)
+
+
+def _commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"],
+                              capture_output=True, check=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args: object) -> dict:
+    commands = list(COMMANDS.keys()) if args.commands is None else args.commands
+    results = list()
+
+    for frequency in args.frequencies:
+        work_path = os.path.abspath(os.path.join(args.work_path, "{}.{}".format(args.size, frequency)))
+        shutil.rmtree(work_path, ignore_errors=True)
+        os.makedirs(work_path)
+
+        start = time.perf_counter()
+        context = prepare(work_path, args.size, frequency, grid=args.grid, years=args.years,
+                          land_fraction=args.land_fraction, missing_fraction=args.missing_fraction,
+                          nan_fraction=args.nan_fraction)
+        logging.info("Generated {} {} datasets in {:.1f}s".format(args.size, frequency, time.perf_counter() - start))
+
+        for command in commands:
+            logging.info("Benchmarking {} on {} {} data".format(command, args.size, frequency))
+            result = dict(command=command, frequency=frequency, size=args.size)
+
+            # A fresh process for each, so that nothing is cached and peak memory is the command's own
+            with concurrent.futures.ProcessPoolExecutor(max_workers=1,
+                                                        mp_context=multiprocessing.get_context("spawn")) as executor:
+                try:
+                    result.update(executor.submit(run_command, command, context).result())
+                except Exception as e:
+                    logging.exception("{} failed on {} {} data".format(command, args.size, frequency))
+                    result["error"] = repr(e)
+            results.append(result)
+
+        if not args.keep:
+            shutil.rmtree(work_path, ignore_errors=True)
+
+    return dict(commit=_commit(),
+                created=dt.datetime.now(dt.timezone.utc).isoformat(),
+                machine=dict(cpus=os.cpu_count(), platform=platform.platform(), python=platform.python_version()),
+                settings=dict(size=args.size, grid=args.grid, years=args.years, land_fraction=args.land_fraction,
+                              missing_fraction=args.missing_fraction, nan_fraction=args.nan_fraction),
+                results=results)
+
+
+def compare(baseline: dict, candidate: dict) -> None:
+    """Print the change in each measurement between two sets of results
+
+    :param baseline:
+    :param candidate:
+    """
+    keyed = {(result["command"], result["frequency"], result["size"]): result for result in baseline["results"]}
+    measures = ["seconds", "peak_rss_bytes", "bytes_read", "bytes_written"]
+
+    print("{} -> {}".format(baseline["commit"], candidate["commit"]))
+    print("{:<16} {:<6} {:<7} ".format("command", "freq", "size") +
+          " ".join(["{:>22}".format(measure) for measure in measures]))
+
+    for result in candidate["results"]:
+        key = (result["command"], result["frequency"], result["size"])
+        base = keyed.get(key, dict())
+        changes = list()
+
+        for measure in measures:
+            before, after = base.get(measure), result.get(measure)
+            changes.append("{:>22}".format(
+                "-" if after is None else "{:.4g}".format(after) if not before else
+                "{:.4g} ({:+.0%})".format(after, after / before - 1)))
+        print("{:<16} {:<6} {:<7} ".format(*key) + " ".join(changes) +
+              ("  {}".format(result["error"]) if "error" in result else ""))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("-v", "--verbose", action="store_true", default=False)
+    subparsers = parser.add_subparsers(dest="action", required=True)
+
+    run_parser = subparsers.add_parser("run", help="Run the benchmarks")
+    run_parser.add_argument("-s", "--size", choices=list(SIZES.keys()), default="small")
+    run_parser.add_argument("-f", "--frequencies", type=lambda s: s.split(","), default=DEFAULT_FREQUENCIES,
+                            help="Comma separated frequencies, from {}, by default {}".
+                            format(", ".join(FREQUENCIES.keys()), ",".join(DEFAULT_FREQUENCIES)))
+    run_parser.add_argument("-c", "--commands", type=lambda s: s.split(","), default=None,
+                            help="Comma separated commands to run, from {}".format(", ".join(COMMANDS.keys())))
+    run_parser.add_argument("-g", "--grid", type=int, default=None, help="Grid size, overriding the size")
+    run_parser.add_argument("-y", "--years", type=int, default=None, help="Years of data, overriding the size")
+    run_parser.add_argument("--land-fraction", type=float, default=0.2)
+    run_parser.add_argument("--missing-fraction", type=float, default=0.02)
+    run_parser.add_argument("--nan-fraction", type=float, default=0.05)
+    run_parser.add_argument("-w", "--work-path", default="benchmark_data",
+                            help="Directory to generate data and run commands in")
+    run_parser.add_argument("-k", "--keep", action="store_true", default=False,
+                            help="Keep the generated data and outputs")
+    run_parser.add_argument("-o", "--output", default=None,
+                            help="File to write results to, by default in results/ named by time and commit")
+
+    compare_parser = subparsers.add_parser("compare", help="Compare two sets of results")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("candidate")
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+
+    if args.action == "compare":
+        with open(args.baseline, "rb") as baseline_fh, open(args.candidate, "rb") as candidate_fh:
+            compare(orjson.loads(baseline_fh.read()), orjson.loads(candidate_fh.read()))
+        return
+
+    results = run(args)
+    output = args.output if args.output is not None else os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "results", "{}.{}.{}.json".format(
+            dt.datetime.now().strftime("%Y%m%dT%H%M%S"), args.size, (results["commit"] or "unknown")[:8]))
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+
+    with open(output, "wb") as fh:
+        fh.write(orjson.dumps(results, option=orjson.OPT_INDENT_2))
+    logging.info("Written results to {}".format(output))
+
+    errors = [result for result in results["results"] if "error" in result]
+    if len(errors) > 0:
+        # Failing, so that a regression can't pass for a completed run
+        logging.error("{} of {} benchmarks failed: {}".format(
+            len(errors), len(results["results"]),
+            ", ".join(["{} ({})".format(result["command"], result["frequency"]) for result in errors])))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,196 @@
+"""Synthetic datasets for benchmarking, standing in for those from download-toolbox
+
+Datasets are written as download-toolbox would lay them out, one file per output group
+of each variable alongside a dataset configuration, so everything downstream of the
+download runs against them unchanged.
+"""
+import dataclasses
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from download_toolbox.dataset import DatasetConfig
+from download_toolbox.interface import Frequency
+from download_toolbox.location import Location
+
+
+@dataclasses.dataclass
+class SyntheticSize:
+    """The extent of a synthetic dataset
+
+    :param grid: Number of cells along each horizontal dimension.
+    :param years: Number of years of data.
+    """
+    grid: int
+    years: int
+
+
+SIZES = dict(
+    small=SyntheticSize(grid=48, years=2),
+    medium=SyntheticSize(grid=216, years=5),
+    large=SyntheticSize(grid=432, years=10),
+)
+
+FREQUENCIES = dict(
+    day=(Frequency.DAY, "D"),
+    month=(Frequency.MONTH, "MS"),
+)
+
+# Extent of the projected grid, as for the EASE-Grid 2.0 north
+GRID_EXTENT = 5.4e6
+
+# CF grid mapping of the projected grid, that of generate_reference
+GRID_MAPPING = dict(
+    grid_mapping_name="lambert_azimuthal_equal_area",
+    latitude_of_projection_origin=90.,
+    longitude_of_projection_origin=0.,
+    false_easting=0.,
+    false_northing=0.,
+    earth_radius=6371228.0,
+)
+
+
+class SyntheticDatasetConfig(DatasetConfig):
+    """A dataset configuration for synthetic data, providing what processors expect of one"""
+
+    @property
+    def config_file(self) -> os.PathLike:
+        return self.config_path
+
+
+def projected_coords(grid: int) -> dict:
+    """Coordinates of a Lambert azimuthal equal area grid of `grid` cells square
+
+    Files on this grid need GRID_MAPPING alongside their variables for iris to recognise
+    the coordinates as those of the projection.
+
+    :param grid:
+    :return: dict of coordinate DataArrays
+    """
+    return dict(
+        yc=xr.DataArray(np.linspace(GRID_EXTENT, -GRID_EXTENT, grid), dims="yc",
+                        attrs=dict(axis="Y", standard_name="projection_y_coordinate", units="m")),
+        xc=xr.DataArray(np.linspace(-GRID_EXTENT, GRID_EXTENT, grid), dims="xc",
+                        attrs=dict(axis="X", standard_name="projection_x_coordinate", units="m")),
+    )
+
+
+def latlon_coords(grid: int) -> dict:
+    """Coordinates of a northern latitude and longitude grid, `grid` cells along each
+
+    :param grid:
+    :return: dict of coordinate DataArrays
+    """
+    return dict(
+        latitude=xr.DataArray(np.linspace(90, 20, grid), dims="latitude",
+                              attrs=dict(axis="Y", standard_name="latitude", units="degrees_north")),
+        longitude=xr.DataArray(np.linspace(0, 360, grid, endpoint=False), dims="longitude",
+                               attrs=dict(axis="X", standard_name="longitude", units="degrees_east")),
+    )
+
+
+def generate_reference(ref_file: os.PathLike,
+                       grid: int) -> os.PathLike:
+    """Write a reference file on the projected grid, for regridding and rotation
+
+    :param ref_file:
+    :param grid:
+    :return: ref_file
+    """
+    import iris.coord_systems
+    import iris.coords
+    import iris.cube
+
+    cs = iris.coord_systems.LambertAzimuthalEqualArea(90, 0, ellipsoid=iris.coord_systems.GeogCS(6371228.0))
+    coords = projected_coords(grid)
+
+    cube = iris.cube.Cube(np.zeros((grid, grid), dtype=np.float32), var_name="ref")
+    cube.add_dim_coord(iris.coords.DimCoord(coords["yc"].values, "projection_y_coordinate",
+                                            var_name="yc", units="m", coord_system=cs), 0)
+    cube.add_dim_coord(iris.coords.DimCoord(coords["xc"].values, "projection_x_coordinate",
+                                            var_name="xc", units="m", coord_system=cs), 1)
+    iris.save(cube, ref_file)
+    return ref_file
+
+
+def generate_dataset(base_path: os.PathLike,
+                     identifier: str,
+                     var_names: list,
+                     size: SyntheticSize,
+                     frequency: str = "day",
+                     grid_type: str = "projected",
+                     land_fraction: float = 0.2,
+                     missing_fraction: float = 0.02,
+                     nan_fraction: float = 0.05,
+                     start_year: int = 2000,
+                     seed: int = 42) -> SyntheticDatasetConfig:
+    """Write a synthetic dataset of smoothly varying fields with gaps to fill
+
+    Fields are a seasonal cycle over a spatial gradient with noise. Three kinds of gaps
+    are introduced: a fixed region of NaNs standing in for land, rectangles of NaNs on a
+    fraction of dates standing in for missing observations, and dates left out entirely.
+
+    :param base_path: Directory to write datasets into.
+    :param identifier: Identifier of the dataset.
+    :param var_names: Variables to generate.
+    :param size: Extent of the dataset, as from SIZES.
+    :param frequency: Key of FREQUENCIES.
+    :param grid_type: Either projected, on the grid of generate_reference, or latlon.
+    :param land_fraction: Approximate fraction of the grid that is NaN throughout.
+    :param missing_fraction: Fraction of dates left out.
+    :param nan_fraction: Fraction of dates with a region of missing values.
+    :param start_year:
+    :param seed:
+    :return: The configuration of the dataset, which has also been saved
+    """
+    frequency, date_freq = FREQUENCIES[frequency]
+    coords = projected_coords(size.grid) if grid_type == "projected" else latlon_coords(size.grid)
+    dims = list(coords.keys())
+
+    ds_config = SyntheticDatasetConfig(location=Location(identifier, north=True),
+                                       var_names=var_names,
+                                       path_components=[],
+                                       identifier=identifier,
+                                       levels=[None] * len(var_names),
+                                       base_path=base_path,
+                                       frequency=frequency)
+
+    rng = np.random.default_rng(seed)
+    dates = pd.date_range("{}-01-01".format(start_year), "{}-12-31".format(start_year + size.years - 1),
+                          freq=date_freq)
+    dates = dates.delete(rng.choice(len(dates), int(len(dates) * missing_fraction), replace=False))
+
+    yy, xx = np.meshgrid(np.linspace(-1, 1, size.grid), np.linspace(-1, 1, size.grid), indexing="ij")
+    land = (yy - 0.3) ** 2 + (xx + 0.3) ** 2 < land_fraction
+    gradient = (yy + xx).astype(np.float32)
+
+    for var_idx, var_config in enumerate(ds_config.variables):
+        for year in range(start_year, start_year + size.years):
+            year_dates = dates[dates.year == year]
+            seasonal = np.sin(2 * np.pi * (year_dates.dayofyear.values + 30 * var_idx) / 365.25).astype(np.float32)
+
+            data = seasonal[:, np.newaxis, np.newaxis] + gradient + \
+                rng.normal(scale=0.1, size=(len(year_dates), size.grid, size.grid)).astype(np.float32)
+            data[:, land] = np.nan
+
+            for date_idx in np.flatnonzero(rng.random(len(year_dates)) < nan_fraction):
+                y, x = rng.integers(0, size.grid - size.grid // 8, size=2)
+                data[date_idx, y:y + size.grid // 8, x:x + size.grid // 8] = np.nan
+
+            da = xr.DataArray(data, dims=["time", *dims], coords=dict(time=year_dates, **coords),
+                              name=var_config.name)
+            if grid_type == "projected":
+                da = da.assign_coords(crs=xr.DataArray(np.int32(0), attrs=GRID_MAPPING))
+                da.attrs["grid_mapping"] = "crs"
+
+            destination_path = ds_config.var_filepath(var_config, year_dates)
+            logging.debug("Writing {}".format(destination_path))
+            da.to_netcdf(destination_path)
+
+    logging.info("Generated {} {} {} dates of {} on a {} grid of {}".
+                 format(identifier, len(dates), frequency.attribute, ", ".join(var_names), grid_type, size.grid))
+    ds_config.save_config()
+    return ds_config
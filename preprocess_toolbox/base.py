@@ -1,16 +1,21 @@
 from abc import abstractmethod
 
+import contextlib
 import logging
 import os
+import shutil
 
 import dask.array
 import numpy as np
-import xarray as xr
+import pandas as pd
 
 from pprint import pformat
 
 from download_toolbox.interface import DataCollection, DatasetConfig
 
+from preprocess_toolbox.profiling import span
+from preprocess_toolbox.storage import NetCDFBackend, get_storage_backend
+
 
 class ProcessingError(RuntimeError):
     pass
@@ -20,7 +25,7 @@ class Processor(DataCollection):
     """An abstract base class for data processing classes.
 
     Provides methods for initialising source data from download-toolbox defined
-    configurations, process the data, and saving the processed data to normalised netCDF files.
+    configurations, process the data, and saving the processed data via a storage backend.
 
     TODO: the majority of actual data processing, for the moment, is being isolated in the
      child implementation of NormalisingChannelProcessor whilst I work out what is going
@@ -38,6 +43,8 @@ class Processor(DataCollection):
                  base_path: os.PathLike = os.path.join(".", "processed"),
                  dtype: np.typecodes = np.float32,
                  processed_files: dict = None,
+                 storage: str = NetCDFBackend.name,
+                 storage_options: dict = None,
                  update_key: str = None,
                  **kwargs) -> None:
         """
@@ -48,6 +55,9 @@ class Processor(DataCollection):
             identifier:
             base_path:
             dtype:
+            processed_files:
+            storage: name of the storage backend for processed files
+            storage_options: chunking and compression options for the storage backend
             update_key:
             **kwargs:
         """
@@ -59,9 +69,13 @@ class Processor(DataCollection):
         self.config.directory = "."
 
         self._abs_vars = absolute_vars if absolute_vars else []
+        self._date_ranges = dict()
+        self._deferred_writes = None
         self._dtype = dtype
 
         self._processed_files = dict() if processed_files is None else processed_files
+        self._storage = get_storage_backend(storage, storage_options)
+        self._storage_report = dict()
 
         self._update_key = self.identifier if not update_key else update_key
 
@@ -98,26 +112,47 @@ class Processor(DataCollection):
                             name: str,
                             data: object,
                             convert: bool = True,
-                            overwrite: bool = False) -> str:
-        """Save processed data to netCDF file.
+                            overwrite: bool = False,
+                            append: bool = False) -> str:
+        """Save processed data via the storage backend.
 
         Args:
             var_name: The name of the variable.
-            name: The name of the file.
+            name: The name of the file, the extension of which is set by the storage backend.
             data: The data to be saved.
             convert: Whether to convert data to the processors data type
             overwrite: Whether to overwrite extant files
+            append: Whether to append the dates of data after the end of an extant file to it
 
         Returns:
-            object: The path of the saved netCDF file.
+            object: The path of the saved file.
 
         """
-        file_path = os.path.join(self.path, name)
-        if overwrite or not os.path.exists(file_path):
-            logging.debug("Writing to {}".format(file_path))
+        file_path = os.path.join(self.path, self._storage.filename(name))
+        append = append and not overwrite and os.path.exists(file_path)
+
+        if append:
+            data = self._dates_to_append(file_path, data)
+        elif not overwrite and os.path.exists(file_path):
+            data = None
+
+        if data is not None:
+            if not append:
+                self._date_ranges.pop(file_path, None)
+            self._record_date_range(file_path, data.indexes["time"] if "time" in data.indexes else None)
+            write = self._storage.append if append else self._storage.write
+            logging.debug("{} to {}".format("Appending" if append else "Writing", file_path))
             if convert:
                 data = data.astype(self._dtype)
-            data.to_netcdf(file_path)
+
+            if self._deferred_writes is not None:
+                self._deferred_writes[file_path] = (write(data, file_path, compute=False),
+                                                    data.nbytes,
+                                                    append)
+            else:
+                with span("write", var=var_name):
+                    write(data, file_path)
+                self._storage_report[file_path] = self._storage.report(file_path, data.nbytes)
 
         if var_name not in self.processed_files.keys():
             self.processed_files[var_name] = list()
@@ -129,6 +164,117 @@ class Processor(DataCollection):
         #     logging.warning("{} already exists in {} processed list".format(file_path, var_name))
         return file_path
 
+    @contextlib.contextmanager
+    def deferred_writes(self):
+        """Defer the writes made by save_processed_file, computing them together on exit.
+
+        The writes then share a single dask graph, so the source chunks they have in
+        common are read once for all of the files rather than once per file. Anything
+        computed before the writes are made, such as the parameters the outputs are
+        derived with, still reads the source for itself. If anything fails before the
+        writes complete, the incomplete files are removed.
+        """
+        self._deferred_writes = dict()
+
+        try:
+            yield self
+            if len(self._deferred_writes) > 0:
+                logging.info("Computing {} deferred writes".format(len(self._deferred_writes)))
+                with span("write", files=len(self._deferred_writes)):
+                    dask.compute(*[write for write, _, _ in self._deferred_writes.values()])
+
+                for file_path, (_, data_bytes, _) in self._deferred_writes.items():
+                    self._storage_report[file_path] = self._storage.report(file_path, data_bytes)
+        except BaseException:
+            for file_path, (_, _, append) in self._deferred_writes.items():
+                if append:
+                    # Removing it would lose everything that was there before
+                    logging.warning("{} may have been partially appended to, check or regenerate it".
+                                    format(file_path))
+                elif os.path.isdir(file_path):
+                    logging.warning("Removing incomplete output {}".format(file_path))
+                    shutil.rmtree(file_path)
+                elif os.path.exists(file_path):
+                    logging.warning("Removing incomplete output {}".format(file_path))
+                    os.remove(file_path)
+            raise
+        finally:
+            self._deferred_writes = None
+
+    def _dates_to_append(self,
+                         file_path: os.PathLike,
+                         data: object) -> object:
+        """The dates of `data` that follow the last in `file_path`, or None if there aren't any
+
+        Dates missing from within the range of the file can't be inserted by appending,
+        so are left out with a warning.
+
+        :param file_path:
+        :param data:
+        :return:
+        """
+        existing = self._storage.open_dataarray(file_path)
+        existing_dates = existing.indexes["time"]
+        existing.close()
+        self._record_date_range(file_path, existing_dates)
+
+        data_dates = data.indexes["time"]
+        new_dates = data_dates[data_dates > existing_dates.max()]
+        gap_dates = data_dates[data_dates <= existing_dates.max()].difference(existing_dates)
+
+        if len(gap_dates) > 0:
+            logging.warning("{} dates are missing from within {} and can't be appended, "
+                            "reprocess it in full to include them".format(len(gap_dates), file_path))
+
+        if len(new_dates) < 1:
+            logging.info("{} is up to date".format(file_path))
+            return None
+
+        logging.info("Appending {} dates from {} to {}".format(len(new_dates), new_dates.min(), file_path))
+        return data.sel(time=new_dates)
+
+    def _record_date_range(self,
+                           file_path: os.PathLike,
+                           dates: object) -> None:
+        """Record the dates written to `file_path`, extending any range already recorded for it
+
+        :param file_path:
+        :param dates: DatetimeIndex of the dates, or None if the data isn't by date
+        """
+        if dates is None or len(dates) < 1:
+            return
+
+        first, last = dates.min(), dates.max()
+        if file_path in self._date_ranges:
+            first, last = min(first, self._date_ranges[file_path][0]), max(last, self._date_ranges[file_path][1])
+        self._date_ranges[file_path] = (first, last)
+
+    def processed_date_ranges(self) -> dict:
+        """The first and last dates held in the processed files of each variable
+
+        Ranges are recorded as files are written, so only files this processor hasn't
+        written or appended to, such as those left as they were, are opened to find them.
+
+        :return: dict of [first, last] dates as ISO strings by variable name
+        """
+        date_ranges = dict()
+
+        for var_name, file_paths in self.processed_files.items():
+            dates = list()
+
+            for file_path in [file_path for file_path in file_paths if os.path.exists(file_path)]:
+                if file_path not in self._date_ranges:
+                    da = self._storage.open_dataarray(file_path)
+                    self._record_date_range(file_path, da.indexes["time"] if "time" in da.indexes else None)
+                    da.close()
+
+                if file_path in self._date_ranges:
+                    dates += list(self._date_ranges[file_path])
+
+            if len(dates) > 0:
+                date_ranges[var_name] = [min(dates).isoformat(), max(dates).isoformat()]
+        return date_ranges
+
     def get_dataset(self,
                     var_names: list = None):
         logging.debug("Finding files for {}".format(", ".join(var_names if var_names is not None else "everything")))
@@ -139,24 +285,37 @@ class Processor(DataCollection):
             if var_names is not None else \
                     [var_filepaths
                      for vn in self.processed_files.keys()
-                     for var_filepaths in self.processed_files[vn].values()]
+                     for var_filepaths in self.processed_files[vn]]
 
         logging.info("Got {} filenames to open dataset with!".format(len(var_files)))
         logging.debug(pformat(var_files))
 
-        # TODO: where's my parallel mfdataset please!?
         with (dask.config.set(**{'array.slicing.split_large_chunks': True})):
-            ds = xr.open_mfdataset(
-                var_files,
-                combine="nested",
-                concat_dim="time",
-                coords="minimal",
-                compat="override",
-                chunks=dict(time=1, ),
-            )
+            ds = self._storage.open_dataset(var_files)
             ds = ds.astype(self._dtype)
         return ds
 
+    def merge_processed_files(self,
+                              processed_files: dict,
+                              date_ranges: dict = None) -> None:
+        """Merge processed files produced elsewhere, such as by a worker process.
+
+        Args:
+            processed_files: processed files organised by variable name
+            date_ranges: first and last dates written to each file, by file path
+        """
+        for file_path, dates in (dict() if date_ranges is None else date_ranges).items():
+            self._record_date_range(file_path, pd.DatetimeIndex(dates))
+
+        for var_name, file_paths in processed_files.items():
+            if var_name not in self.processed_files.keys():
+                self.processed_files[var_name] = list()
+
+            for file_path in file_paths:
+                if file_path not in self.processed_files[var_name]:
+                    logging.debug("Adding {} file: {}".format(var_name, file_path))
+                    self.processed_files[var_name].append(file_path)
+
     @abstractmethod
     def process(self):
         pass
@@ -165,6 +324,11 @@ class Processor(DataCollection):
     def abs_vars(self):
         return self._abs_vars
 
+    @property
+    def date_ranges(self) -> dict:
+        """The first and last dates recorded as written to each processed file, by file path"""
+        return self._date_ranges
+
     @property
     def dtype(self):
         return self._dtype
@@ -174,6 +338,16 @@ class Processor(DataCollection):
         """A dict with the processed files organised by variable name."""
         return self._processed_files
 
+    @property
+    def storage(self):
+        """The storage backend for processed files."""
+        return self._storage
+
+    @property
+    def storage_report(self) -> dict:
+        """Bytes written and compression ratios for each processed file written."""
+        return self._storage_report
+
     @property
     def update_key(self):
         return self._update_key
@@ -0,0 +1,489 @@
+import collections
+import hashlib
+import logging
+import os
+
+import numpy as np
+import orjson
+import pandas as pd
+import xarray as xr
+
+
+class DatasetHandleCache:
+    """Opened datasets held for reuse within a process, keyed by name and source files
+
+    A handle lives until it is evicted explicitly, or until more than `max_handles`
+    are held, at which point the least recently used is closed. Handles are never
+    carried across to another process, as open files can't be shared that way.
+
+    :param max_handles: The most datasets to hold open at once.
+    """
+
+    def __init__(self,
+                 max_handles: int = 2):
+        self._handles = collections.OrderedDict()
+        self._max_handles = max_handles
+
+    def __getstate__(self):
+        return dict(_handles=collections.OrderedDict(),
+                    _max_handles=self._max_handles)
+
+    def evict(self, name: str = None) -> None:
+        """Close and remove the handles for `name`, or all handles if not given
+
+        :param name:
+        """
+        for key in [key for key in self._handles.keys() if name is None or key[0] == name]:
+            logging.debug("Closing dataset handle for {}".format(key[0]))
+            self._handles.pop(key).close()
+
+    def get(self,
+            name: str,
+            files: list,
+            opener: callable) -> object:
+        """Return the dataset for `name` and `files`, opening it only if not already held
+
+        :param name:
+        :param files:
+        :param opener: callable taking `name` and `files` to open the dataset
+        :return:
+        """
+        key = (name, tuple(sorted(files)))
+
+        if key in self._handles:
+            logging.debug("Reusing opened dataset for {}".format(name))
+            self._handles.move_to_end(key)
+        else:
+            self._handles[key] = opener(name, files)
+
+            while len(self._handles) > self._max_handles:
+                evicted_key, handle = self._handles.popitem(last=False)
+                logging.debug("Closing least recently used dataset handle for {}".format(evicted_key[0]))
+                handle.close()
+        return self._handles[key]
+
+
+class TrendCache:
+    """An append-only store of linear trend maps with a sidecar index of cached dates
+
+    Trend maps are appended to a zarr store chunked by single time steps, so adding
+    dates never rewrites what is already there. The index maps each cached date to its
+    position in the store, which means checking what is cached never touches the data
+    and reads only pull the chunks requested.
+
+    Caches are keyed by the parameters that determine the trend values, so a change of
+    any of them leads to a fresh cache rather than stale reuse. Only the source start
+    date is part of the key: the earliest years of history are used, so later data never
+    changes the trend for a date whose history was complete when it was cached. The
+    source files are instead recorded with the index along with the first date each
+    holds, and should one of those change, only the dates from its first onwards are
+    dropped, as those are the only trends whose history reads it. Their positions in the
+    store are reused as they're cached again. Files that are new to the cache, or not
+    part of this run, leave it as it is.
+
+    :param path: The directory to hold cache stores and indexes.
+    :param var_name: The variable the trends are for.
+    :param parameters: The inputs that determine the trend values.
+    :param sources: Fingerprints of the source files the trends are from, as from file_fingerprints.
+    :param source_starts: The first date held by each of `sources`, if known.
+    """
+
+    def __init__(self,
+                 path: os.PathLike,
+                 var_name: str,
+                 parameters: dict,
+                 sources: dict = None,
+                 source_starts: dict = None):
+        self._parameters = parameters
+        self._sources = dict() if sources is None else sources
+        self._source_starts = dict() if source_starts is None else \
+            {source: pd.Timestamp(start).isoformat() for source, start in source_starts.items()}
+        self._var_name = var_name
+
+        key = hashlib.sha256(orjson.dumps(parameters, option=orjson.OPT_SORT_KEYS)).hexdigest()[:16]
+        name = "{}_linear_trend.{}".format(var_name, key)
+
+        os.makedirs(path, exist_ok=True)
+        self._index_path = os.path.join(path, "{}.json".format(name))
+        self._store_path = os.path.join(path, "{}.zarr".format(name))
+        self._index = dict()
+        # Positions in the store of dropped dates, for reuse when they're cached again
+        self._stale = dict()
+
+        if os.path.exists(self._index_path):
+            with open(self._index_path, "r") as fh:
+                index = orjson.loads(fh.read())
+            cached_sources = index.get("sources", dict())
+            cached_starts = index.get("source_starts", dict())
+
+            self._index = {pd.Timestamp(date): position for date, position in index["dates"].items()}
+            self._stale = {pd.Timestamp(date): position for date, position in index.get("stale", dict()).items()}
+            logging.info("Loaded trend cache index of {} dates from {}".
+                         format(len(self._index), self._index_path))
+
+            changed = [source for source, fingerprint in cached_sources.items()
+                       if source in self._sources and self._sources[source] != fingerprint]
+
+            # The earliest each changed file held, before and now, or None if not known
+            starts = [min([start for start in (cached_starts.get(source), self._source_starts.get(source))
+                           if start is not None], default=None)
+                      for source in changed]
+            self._sources = dict(cached_sources, **self._sources)
+            self._source_starts = dict(cached_starts, **self._source_starts)
+
+            if len(changed) > 0:
+                self._invalidate(None if None in starts else pd.Timestamp(min(starts)), changed)
+            elif self._sources != cached_sources or self._source_starts != cached_starts:
+                # Recording the files new to the cache, so their changes are caught from now on
+                self._write_index()
+
+    def _invalidate(self,
+                    since: pd.Timestamp,
+                    changed: list) -> None:
+        """Drop the cached dates from `since`, or all of them if None, as their sources have changed"""
+        dropped = [date for date in self._index.keys() if since is None or date >= since]
+        logging.warning("{} source files of trend cache {} have changed, dropping {} dates{}".
+                        format(len(changed), self._store_path, len(dropped),
+                               "" if since is None else " from {}".format(since.date())))
+
+        for date in dropped:
+            self._stale[date] = self._index.pop(date)
+        self._write_index()
+
+    def append(self, da: xr.DataArray) -> None:
+        """Append the trend maps in `da` for dates not already in the cache
+
+        Dates that were dropped as their sources changed are written back in place.
+
+        :param da: DataArray with a time dimension leading
+        """
+        new_dates = [date for date in pd.DatetimeIndex(da.time.values) if date not in self._index]
+
+        if len(new_dates) < 1:
+            return
+
+        logging.info("Appending {} dates to trend cache {}".format(len(new_dates), self._store_path))
+        da = da.sel(time=new_dates).rename(self.name)
+        stale_dates = [date for date in new_dates if date in self._stale]
+        append_dates = [date for date in new_dates if date not in self._stale]
+
+        if len(stale_dates) > 0:
+            # Written to their positions a run of consecutive positions at a time
+            stale_dates = sorted(stale_dates, key=self._stale.get)
+            positions = np.array([self._stale[date] for date in stale_dates])
+            runs = np.split(np.arange(len(positions)), np.flatnonzero(np.diff(positions) != 1) + 1)
+            region_da = da.drop_vars([name for name, coord in da.coords.items() if "time" not in coord.dims])
+
+            for run in runs:
+                run_dates = [stale_dates[idx] for idx in run]
+                region_da.sel(time=run_dates).chunk(dict(time=1)).\
+                    to_zarr(self._store_path, region=dict(time=slice(positions[run[0]], positions[run[-1]] + 1)))
+                self._index.update({date: self._stale.pop(date) for date in run_dates})
+
+        if len(append_dates) > 0:
+            da = da.sel(time=append_dates)
+
+            if not os.path.exists(self._store_path):
+                offset = 0
+                chunks = dict(zip(da.dims, (1, *da.shape[1:])))
+                da.chunk(chunks).to_zarr(self._store_path, mode="w")
+            else:
+                # Positions are taken from the store rather than the index, so a write that
+                # was interrupted before the index was updated only leaves unindexed entries
+                with xr.open_zarr(self._store_path) as store:
+                    offset = store.sizes["time"]
+                da.chunk(dict(time=1)).to_zarr(self._store_path, append_dim="time")
+
+            self._index.update({date: offset + idx for idx, date in enumerate(append_dates)})
+        self._write_index()
+
+    def get(self, dates: list) -> xr.DataArray:
+        """Retrieve the cached trend maps for `dates`, all of which must be cached
+
+        :param dates:
+        :return: DataArray ordered as `dates`
+        """
+        positions = [self._index[pd.Timestamp(date)] for date in dates]
+        with xr.open_zarr(self._store_path) as store:
+            return store[self.name].isel(time=positions).load()
+
+    def _write_index(self) -> None:
+        temp_path = "{}.tmp".format(self._index_path)
+        with open(temp_path, "w") as fh:
+            fh.write(orjson.dumps(dict(
+                parameters=self._parameters,
+                sources=self._sources,
+                source_starts=self._source_starts,
+                dates={date.isoformat(): position for date, position in sorted(self._index.items())},
+                stale={date.isoformat(): position for date, position in sorted(self._stale.items())},
+            ), option=orjson.OPT_INDENT_2).decode())
+        os.replace(temp_path, self._index_path)
+
+    @property
+    def dates(self) -> pd.DatetimeIndex:
+        """The dates present in the cache."""
+        return pd.DatetimeIndex(sorted(self._index.keys()))
+
+    @property
+    def name(self) -> str:
+        return "{}_linear_trend".format(self._var_name)
+
+
+class ClimatologyCache:
+    """A store of climatologies keyed by their content, for sharing between processors
+
+    A climatology is stored under a hash of the inputs that determine it, so any processor
+    using the same variable, source files and dates picks up the one already calculated,
+    whilst a change of any of them leads to a fresh one rather than stale reuse.
+
+    :param path: The directory to hold climatologies, shared by the processors using it.
+    :param var_name: The variable the climatology is of.
+    :param parameters: The inputs that determine the climatology.
+    """
+
+    def __init__(self,
+                 path: os.PathLike,
+                 var_name: str,
+                 parameters: dict):
+        key = hashlib.sha256(orjson.dumps(dict(parameters, var_name=var_name),
+                                          option=orjson.OPT_SORT_KEYS)).hexdigest()[:16]
+
+        os.makedirs(path, exist_ok=True)
+        self._path = os.path.join(path, "{}.{}.nc".format(var_name, key))
+
+    def get(self) -> xr.DataArray:
+        """The cached climatology, loaded into memory, or None if there isn't one
+
+        :return:
+        """
+        if not os.path.exists(self._path):
+            return None
+
+        logging.info("Reusing climatology {}".format(self._path))
+        with xr.open_dataarray(self._path) as da:
+            return da.load()
+
+    def put(self, da: xr.DataArray) -> None:
+        logging.info("Caching climatology {}".format(self._path))
+        # Written aside and moved into place, so others never see a partial file
+        temp_path = "{}.{}.tmp".format(self._path, os.getpid())
+        da.to_netcdf(temp_path)
+        os.replace(temp_path, self._path)
+
+    @property
+    def path(self) -> os.PathLike:
+        return self._path
+
+
+class FileIndex:
+    """A persistent index of the source files of each variable of a dataset
+
+    Each file is recorded with its size, modification time and the dates it holds, in
+    a file under `cache_path` named for the dataset path, so the dataset itself is never
+    written to. Refreshing only lists the
+    directories whose modification time has changed, as it does when files are added,
+    removed or renamed, otherwise checking the size and modification time of the files
+    already indexed, so those rewritten in place or replaced within the resolution of the
+    directory's modification time are still picked up. Dates are only read from files
+    that are new or have changed, so opening a large archive doesn't mean crawling all of
+    it each time. Use `refresh(full=True)` to list every directory regardless.
+
+    Files are those named for their output group, which all begin with the year. Without
+    a `cache_path`, or if the index can't be written there, it's held in memory only.
+
+    :param ds_config: The dataset to index.
+    :param cache_path: Directory holding file indexes, None to index in memory only.
+    """
+
+    def __init__(self,
+                 ds_config: object,
+                 cache_path: os.PathLike = None):
+        self._ds_config = ds_config
+        self._index_path = None if cache_path is None else os.path.join(cache_path, "{}.json".format(
+            hashlib.sha256(os.path.abspath(ds_config.path).encode()).hexdigest()[:16]))
+        self._variables = dict()
+
+        if self._index_path is not None and os.path.exists(self._index_path):
+            with open(self._index_path, "rb") as fh:
+                self._variables = orjson.loads(fh.read())["variables"]
+            logging.debug("Loaded file index from {}".format(self._index_path))
+
+        self._dates = dict()
+        self.refresh()
+
+    @staticmethod
+    def _read_dates(file_path: os.PathLike) -> list:
+        try:
+            with xr.open_dataset(file_path) as ds:
+                return [date.isoformat() for date in pd.DatetimeIndex(ds.time.values)]
+        except (OSError, ValueError, AttributeError) as e:
+            logging.warning("Unable to read dates from {}, it won't be indexed: {}".format(file_path, e))
+            return None
+
+    def refresh(self, full: bool = False) -> None:
+        """Bring the index up to date with the files on disk
+
+        :param full: List every directory, rather than only those that have changed
+        """
+        changed = False
+
+        for var_config in self._ds_config.variables:
+            record = self._variables.get(var_config.name, dict(mtime_ns=None, files=dict()))
+
+            try:
+                # Taken before listing, so changes made during it are picked up next time
+                dir_mtime_ns = os.stat(var_config.path).st_mtime_ns
+            except FileNotFoundError:
+                logging.warning("No directory {} for {}".format(var_config.path, var_config.name))
+                dir_mtime_ns = None
+
+            unlisted = dir_mtime_ns == record["mtime_ns"] and var_config.name in self._variables and not full
+
+            if unlisted:
+                candidates = [(file_name, os.path.join(var_config.path, file_name))
+                              for file_name in record["files"]]
+            elif dir_mtime_ns is not None:
+                with os.scandir(var_config.path) as entries:
+                    candidates = [(entry.name, entry.path) for entry in entries
+                                  if entry.is_file() and entry.name[:1].isdigit()]
+            else:
+                candidates = list()
+
+            files = dict()
+            for file_name, file_path in candidates:
+                try:
+                    stat = os.stat(file_path)
+                except FileNotFoundError:
+                    continue
+
+                previous = record["files"].get(file_name)
+
+                if previous is not None \
+                        and previous["size"] == stat.st_size \
+                        and previous["mtime_ns"] == stat.st_mtime_ns:
+                    files[file_name] = previous
+                    continue
+
+                dates = self._read_dates(file_path)
+                if dates is not None:
+                    files[file_name] = dict(dates=dates, mtime_ns=stat.st_mtime_ns, size=stat.st_size)
+
+            if unlisted and files == record["files"]:
+                continue
+
+            logging.info("Indexed {} files for {}".format(len(files), var_config.name))
+            self._variables[var_config.name] = dict(mtime_ns=dir_mtime_ns, files=files)
+            self._dates.pop(var_config.name, None)
+            changed = True
+
+        if changed:
+            self._write_index()
+
+    def _write_index(self) -> None:
+        if self._index_path is None:
+            return
+
+        temp_path = "{}.{}.tmp".format(self._index_path, os.getpid())
+
+        try:
+            os.makedirs(os.path.dirname(self._index_path), exist_ok=True)
+            with open(temp_path, "wb") as fh:
+                fh.write(orjson.dumps(dict(variables=self._variables)))
+            os.replace(temp_path, self._index_path)
+        except OSError as e:
+            logging.warning("Unable to write file index {}, it will be rebuilt next time: {}".
+                            format(self._index_path, e))
+
+    def _period_starts(self, dates: object) -> pd.DatetimeIndex:
+        # Dates are matched by the period of the dataset frequency that they fall in, as
+        # data may be stamped at any time within it. Pandas spells hourly in lower case
+        freq = self._ds_config.frequency.freq.replace("H", "h")
+        return pd.DatetimeIndex(dates).to_period(freq).to_timestamp()
+
+    def _var_path(self, var_name: str) -> os.PathLike:
+        return [var_config.path for var_config in self._ds_config.variables if var_config.name == var_name][0]
+
+    def date_files(self, var_name: str) -> pd.Series:
+        """The file holding each date available for a variable
+
+        :param var_name:
+        :return: Series of file paths indexed by the start of each period available, sorted
+        """
+        if var_name not in self._dates:
+            var_path = self._var_path(var_name)
+            files = self._variables[var_name]["files"]
+            dates = [date for details in files.values() for date in details["dates"]]
+            paths = [os.path.join(var_path, file_name)
+                     for file_name, details in files.items()
+                     for _ in details["dates"]]
+
+            date_files = pd.Series(paths, index=self._period_starts(dates), dtype=object)
+            self._dates[var_name] = date_files[~date_files.index.duplicated()].sort_index()
+        return self._dates[var_name]
+
+    def dates(self, var_name: str = None) -> pd.DatetimeIndex:
+        """The dates available for a variable, or for all variables if not given
+
+        :param var_name:
+        :return:
+        """
+        var_names = [var_config.name for var_config in self._ds_config.variables] if var_name is None else [var_name]
+        dates = self.date_files(var_names[0]).index
+
+        for other_var_name in var_names[1:]:
+            dates = dates.intersection(self.date_files(other_var_name).index)
+        return dates
+
+    def has_dates(self,
+                  dates: list,
+                  var_name: str = None) -> np.ndarray:
+        """Whether each of `dates` is available for a variable, or for all variables if not given
+
+        :param dates:
+        :param var_name:
+        :return: boolean array ordered as `dates`
+        """
+        return self._period_starts(dates).isin(self.dates(var_name))
+
+    def files(self,
+              var_name: str,
+              dates: list = None) -> list:
+        """The files for a variable, optionally only those holding some of `dates`
+
+        :param var_name:
+        :param dates:
+        :return: sorted list of file paths
+        """
+        date_files = self.date_files(var_name)
+
+        if dates is not None:
+            date_files = date_files[date_files.index.isin(self._period_starts(dates))]
+        return sorted(set(date_files.values))
+
+    def files_between(self,
+                      var_name: str,
+                      start: object,
+                      end: object) -> list:
+        """The files for a variable holding dates from `start` to `end` inclusive
+
+        The range is found by binary search of the sorted dates, with either end snapped
+        inward to the nearest available date if there is no data for it.
+
+        :param var_name:
+        :param start:
+        :param end:
+        :return: sorted list of file paths
+        """
+        date_files = self.date_files(var_name)
+        start, end = self._period_starts([start, end])
+        first = date_files.index.searchsorted(start, side="left")
+        last = date_files.index.searchsorted(end, side="right")
+
+        if first >= last:
+            logging.warning("No {} data available between {} and {}".format(var_name, start, end))
+            return list()
+
+        if date_files.index[first] != start or date_files.index[last - 1] != end:
+            logging.info("Snapped {} range {} - {} to the nearest available dates {} - {}".
+                         format(var_name, start, end, date_files.index[first], date_files.index[last - 1]))
+        return sorted(set(date_files.iloc[first:last].values))
@@ -8,6 +8,10 @@ import pandas as pd
 
 from download_toolbox.interface import Frequency, get_dataset_config_implementation
 
+from preprocess_toolbox.profiling import enable_tracing
+from preprocess_toolbox.storage import STORAGE_BACKENDS, NetCDFBackend
+from preprocess_toolbox.utils import date_range_freq
+
 
 def date_arg(string: str) -> object:
     """
@@ -53,6 +57,22 @@ def csv_arg(string: str) -> list:
     return csv_items
 
 
+def chunks_arg(string: str) -> dict:
+    """
+
+    :param string: comma separated name=integer pairs, such as dim=size for chunks
+    :return: dict of integers by name
+    """
+    chunks = dict()
+
+    for el in csv_arg(string):
+        if el is None or "=" not in el:
+            raise argparse.ArgumentTypeError("{} is not a comma separated list of name=integer".format(string))
+        dim, size = el.split("=")
+        chunks[dim.strip()] = int(size)
+    return chunks
+
+
 def csv_of_csv_arg(string: str) -> list:
     """
 
@@ -87,6 +107,34 @@ def csv_of_date_args(string: str) -> list:
     return csv_items
 
 
+def memory_arg(string: str) -> int:
+    """
+
+    :param string: an amount of memory such as 512M, 8GB or 1.5T
+    :return: the number of bytes
+    """
+    memory_match = re.match(r"^(\d+(?:\.\d+)?)\s*([KMGT]?)B?$", string.strip(), re.IGNORECASE)
+
+    if memory_match is None:
+        raise argparse.ArgumentTypeError("{} is not a valid amount of memory".format(string))
+
+    amount, unit = memory_match.groups()
+    return int(float(amount) * 1024 ** " KMGT".index(unit.upper() if unit else " "))
+
+
+def int_or_dict_arg(string: str) -> object:
+    """
+
+    :param string: an integer, or comma separated name=integer pairs
+    :return:
+    """
+    try:
+        val = int(string)
+    except ValueError:
+        val = {k: int(v) for k, v in chunks_arg(string).items()}
+    return val
+
+
 def int_or_list_arg(string: str) -> object:
     """
 
@@ -120,6 +168,11 @@ class BaseArgParser(argparse.ArgumentParser):
                           "--verbose",
                           action="store_true",
                           default=False)
+        self.add_argument("--trace",
+                          help="Write the time spent in each stage, dask task and memory use to this "
+                               "file as trace events, for loading into a trace viewer",
+                          type=str,
+                          default=None)
 
     def add_extra_args(self, extra_args):
         for arg in extra_args:
@@ -139,6 +192,9 @@ class BaseArgParser(argparse.ArgumentParser):
                 logging.getLogger(log_module).setLevel(logging.WARNING)
         logging.getLogger("matplotlib").setLevel(logging.WARNING)
 
+        if args.trace is not None:
+            enable_tracing(args.trace)
+
         return args
 
 
@@ -180,6 +236,26 @@ class ProcessingArgParser(BaseArgParser):
                           default=False,
                           action="store_true",
                           help="Allow parallel opens and dask implementation")
+        self.add_argument("-w",
+                          "--workers",
+                          default=1,
+                          type=int,
+                          help="Number of processes to run concurrently")
+        self.add_argument("-ml",
+                          "--memory-limit",
+                          default=None,
+                          type=memory_arg,
+                          help="Memory each worker process may use, e.g. 8GB, "
+                               "defaulting to an even share of physical memory")
+        return self
+
+    def add_incremental(self):
+        self.add_argument("-in",
+                          "--incremental",
+                          help="Append dates after the end of existing outputs to them, using the "
+                               "existing normalisation and climatology parameters",
+                          action="store_true",
+                          default=False)
         return self
 
     def add_implementation(self):
@@ -232,6 +308,12 @@ class ProcessingArgParser(BaseArgParser):
                           help="Comma separated list of anomoly vars",
                           type=csv_arg,
                           default=[])
+        self.add_argument("-cf",
+                          "--clim-frequency",
+                          help="Frequency of the climatologies anomalies are taken from, by "
+                               "month or by day of the year",
+                          choices=("month", "day"),
+                          default="month")
         return self
 
     def add_var_name(self):
@@ -241,6 +323,41 @@ class ProcessingArgParser(BaseArgParser):
                           default=None)
         return self
 
+    def add_storage(self):
+        self.add_argument("-sf",
+                          "--storage",
+                          choices=list(STORAGE_BACKENDS.keys()),
+                          default=NetCDFBackend.name,
+                          help="Storage format for processed files")
+        self.add_argument("-sc",
+                          "--storage-chunks",
+                          type=chunks_arg,
+                          default=None,
+                          help="Chunk sizes for processed files, e.g. time=1,yc=216,xc=216, "
+                               "with unlisted dimensions left whole")
+        self.add_argument("-scc",
+                          "--storage-codec",
+                          type=str,
+                          default=None,
+                          help="Compression codec for processed files")
+        self.add_argument("-scl",
+                          "--storage-level",
+                          type=int,
+                          default=None,
+                          help="Compression level for processed files")
+        self.add_argument("-sns",
+                          "--storage-no-shuffle",
+                          action="store_true",
+                          default=False,
+                          help="Disable the shuffle filter ahead of compression")
+        self.add_argument("-sl",
+                          "--storage-lsd",
+                          type=int_or_dict_arg,
+                          default=None,
+                          help="Least significant digit to quantise processed files to, either for all "
+                               "variables or per variable, e.g. sic_abs=3,tas_anom=2")
+        return self
+
     def add_trends(self):
         self.add_argument("--trends",
                           help="Comma separated list of abs vars",
@@ -261,6 +378,25 @@ class ProcessingArgParser(BaseArgParser):
         return self
 
 
+def process_storage_args(args: object) -> dict:
+    """
+
+    :param args:
+    :return: keyword arguments selecting the storage backend for a processor
+    """
+    per_variable = isinstance(args.storage_lsd, dict)
+
+    return dict(storage=args.storage,
+                storage_options=dict(chunks=args.storage_chunks,
+                                     codec=args.storage_codec,
+                                     level=args.storage_level,
+                                     shuffle=not args.storage_no_shuffle,
+                                     least_significant_digit=None if per_variable else args.storage_lsd,
+                                     variables={var_name: dict(least_significant_digit=lsd)
+                                                for var_name, lsd in args.storage_lsd.items()}
+                                     if per_variable else None))
+
+
 def process_split_args(args: object,
                        frequency: Frequency) -> dict:
     """
@@ -281,7 +417,7 @@ def process_split_args(args: object,
         for period_start, period_end in zip(args.split_starts[idx], args.split_ends[idx]):
             split_dates += [
                 pd.to_datetime(date).date()
-                for date in pd.date_range(period_start, period_end, freq=frequency.freq)
+                for date in pd.date_range(period_start, period_end, freq=date_range_freq(frequency))
             ]
         logging.info("Got {} dates for {}".format(len(split_dates), split))
 
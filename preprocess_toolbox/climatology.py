@@ -0,0 +1,193 @@
+import logging
+
+import dask.array
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from download_toolbox.interface import Frequency
+
+
+# The time attribute climatologies are grouped by and the number of groups there can be
+CLIMATOLOGY_GROUPS = {
+    Frequency.MONTH: ("month", 12),
+    Frequency.DAY: ("dayofyear", 366),
+}
+
+
+def climatology_group(frequency: Frequency) -> tuple:
+    """The time attribute and number of groups of a climatology at `frequency`
+
+    :param frequency:
+    :return: tuple of the attribute name and number of groups
+    """
+    if frequency not in CLIMATOLOGY_GROUPS:
+        raise NotImplementedError("Climatologies can only be generated at a {} resolution, not {}".
+                                  format(" or ".join([f.attribute for f in CLIMATOLOGY_GROUPS.keys()]),
+                                         frequency.attribute))
+    return CLIMATOLOGY_GROUPS[frequency]
+
+
+def time_groups(da: xr.DataArray,
+                frequency: Frequency = Frequency.MONTH) -> np.ndarray:
+    """The climatology group of each date of `da`, taken from the time coordinate alone
+
+    :param da:
+    :param frequency:
+    :return: array of the groups, starting from one as months and days of the year do
+    """
+    group, _ = climatology_group(frequency)
+    return np.asarray(getattr(da.indexes["time"], group))
+
+
+def _sum_by_group(values: np.ndarray,
+                  groups: np.ndarray,
+                  dtype: type = np.float64) -> np.ndarray:
+    """Sums along the leading axis of `values` of each of `groups`, in order of the groups"""
+    order = np.argsort(groups, kind="stable")
+    # The first element of each group, once ordered by group
+    starts = np.flatnonzero(np.diff(groups[order], prepend=-1))
+
+    if len(starts) == len(groups):
+        # As when a block covers no more than a year of days, there's nothing to add up
+        return values[order].astype(dtype)
+    return np.add.reduceat(values[order], starts, axis=0, dtype=dtype)
+
+
+def _block_group_sums(block: np.ndarray,
+                      groups: np.ndarray,
+                      block_info: dict = None) -> np.ndarray:
+    """Sums and counts of the non-NaN values of a block for each group of its dates
+
+    Only the groups the block has dates in are accumulated, so the result is never
+    larger than the block, however many groups the climatology has.
+
+    :param block: Block with time leading
+    :param groups: Group of every date of the whole array
+    :param block_info: As supplied by map_blocks, for the dates the block covers
+    :return: array of the sums and counts of each group present, in order of the groups
+    """
+    start, stop = block_info[0]["array-location"][0]
+    values = np.asarray(block, dtype=np.float64)
+    valid = ~np.isnan(values)
+    return np.stack([_sum_by_group(np.where(valid, values, 0.), groups[start:stop]),
+                     _sum_by_group(valid, groups[start:stop])], axis=1)
+
+
+def _block_group_totals(block: np.ndarray,
+                        groups: np.ndarray,
+                        block_info: dict = None) -> np.ndarray:
+    """Totals of the rows of a block of sums for each group of its rows
+
+    :param block: Block of sums, as from _block_group_sums
+    :param groups: Group of every row of the whole array of sums
+    :param block_info: As supplied by map_blocks, for the rows the block covers
+    :return: array of the totals of each group present, in order of the groups
+    """
+    start, stop = block_info[0]["array-location"][0]
+    return _sum_by_group(block, groups[start:stop])
+
+
+def _pack_groups(group_rows: np.ndarray,
+                 max_rows: int) -> list:
+    """Consecutive runs of groups with no more than `max_rows` rows between them, or one group
+
+    :param group_rows: Number of rows of each group
+    :param max_rows:
+    :return: list of the number of groups in each run
+    """
+    runs, rows = list(), 0
+
+    for num_rows in group_rows:
+        if len(runs) == 0 or rows + num_rows > max_rows:
+            runs.append(0)
+            rows = 0
+        runs[-1] += 1
+        rows += num_rows
+    return runs
+
+
+def compute_climatology(da: xr.DataArray,
+                        dates: list,
+                        frequency: Frequency = Frequency.MONTH) -> xr.DataArray:
+    """The mean of `da` over `dates` for each month, or day of the year
+
+    Each chunk of the data is reduced to sums and counts for the groups it has dates
+    in as it's read, and those of each group are then added up, so the climatology
+    takes a single pass over the data and never holds more than a chunk's worth of
+    sums at once, however many groups there are. Days of the year are numbered from
+    the start of each year, so after February those of leap years are one day out
+    from the others.
+
+    :param da: DataArray with a time dimension
+    :param dates: Dates to calculate the climatology over
+    :param frequency: Either monthly or daily
+    :return: DataArray with a dimension of the groups present in `dates` in place of time
+    """
+    group, _ = climatology_group(frequency)
+    da = da.sel(time=dates).transpose("time", ...)
+    groups = time_groups(da, frequency)
+
+    data = da.data if isinstance(da.data, dask.array.Array) else dask.array.from_array(da.data)
+    bounds = np.cumsum((0,) + data.chunks[0])
+    block_groups = [np.unique(groups[start:stop]) for start, stop in zip(bounds[:-1], bounds[1:])]
+    # The group of each row of sums, which has a row for every group in every block of dates
+    row_groups = np.concatenate(block_groups)
+    sums = data.map_blocks(_block_group_sums,
+                           groups,
+                           chunks=(tuple(len(el) for el in block_groups), (2,), *data.chunks[1:]),
+                           new_axis=[1],
+                           dtype=np.float64)
+
+    present, group_rows = np.unique(row_groups, return_counts=True)
+    logging.debug("Calculating {} climatology over {} dates for {} {}s".
+                  format(da.name, len(dates), len(present), group))
+
+    # Bringing the rows of each group together, in chunks of whole groups no larger than those read
+    order = np.argsort(row_groups, kind="stable")
+    runs = _pack_groups(group_rows, max(data.chunks[0]))
+    run_bounds = np.cumsum([0] + runs)
+    sums = sums[order].rechunk({0: tuple(group_rows[start:stop].sum()
+                                         for start, stop in zip(run_bounds[:-1], run_bounds[1:]))})
+    sums = sums.map_blocks(_block_group_totals,
+                           row_groups[order],
+                           chunks=(tuple(runs), *sums.chunks[1:]),
+                           dtype=np.float64)
+    totals, counts = sums[:, 0], sums[:, 1]
+    means = dask.array.where(counts > 0, totals / dask.array.maximum(counts, 1), np.nan)
+
+    return xr.DataArray(means.astype(da.dtype),
+                        dims=(group, *da.dims[1:]),
+                        coords={group: present,
+                                **{name: coord for name, coord in da.coords.items() if "time" not in coord.dims}},
+                        name=da.name,
+                        attrs=da.attrs)
+
+
+def subtract_climatology(da: xr.DataArray,
+                         climatology: xr.DataArray,
+                         frequency: Frequency = Frequency.MONTH) -> xr.DataArray:
+    """Anomalies of `da` from its climatology
+
+    The climatology is indexed by the group of each date, rather than grouping the data,
+    so the subtraction stays a single elementwise operation in the graph. Should the
+    climatology lack any of the groups in the data, the mean over the climatology is
+    subtracted instead.
+
+    :param da: DataArray with a time dimension
+    :param climatology: As from compute_climatology
+    :param frequency: Frequency of the climatology
+    :return: DataArray of anomalies
+    """
+    group, _ = climatology_group(frequency)
+    groups = time_groups(da, frequency)
+    missing = pd.Index(np.unique(groups)).difference(climatology[group].values)
+
+    if len(missing) > 0:
+        logging.warning("We don't have a full climatology ({}) compared with data ({})".format(
+            ",".join([str(i) for i in climatology[group].values]),
+            ",".join([str(i) for i in np.unique(groups)])))
+        return da - climatology.mean()
+
+    return da - climatology.sel({group: xr.DataArray(groups, dims="time", coords=dict(time=da.time))}).\
+        drop_vars(group)
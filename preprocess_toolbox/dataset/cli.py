@@ -1,13 +1,24 @@
 import logging
+import os
+import tempfile
 
 from dateutil.relativedelta import relativedelta
 
-from download_toolbox.interface import get_dataset_config_implementation
+import xarray as xr
 
+from download_toolbox.interface import Frequency, get_dataset_config_implementation
+
+from preprocess_toolbox.dataset.pipeline import (MissingSpatialStage,
+                                                 MissingTimeStage,
+                                                 RegridStage,
+                                                 RotateStage,
+                                                 open_dataset_variables,
+                                                 run_pipeline)
 from preprocess_toolbox.dataset.process import regrid_dataset, rotate_dataset
-from preprocess_toolbox.dataset.spatial import spatial_interpolation
-from preprocess_toolbox.dataset.time import process_missing_dates
-from preprocess_toolbox.cli import ProcessingArgParser, process_split_args, csv_arg
+from preprocess_toolbox.dataset.spatial import spatial_interpolation_blocks
+from preprocess_toolbox.dataset.time import load_invalid_dates, process_missing_dates
+from preprocess_toolbox.cache import FileIndex
+from preprocess_toolbox.cli import ProcessingArgParser, process_split_args, process_storage_args, csv_arg
 from preprocess_toolbox.interface import get_processor_from_source
 from preprocess_toolbox.processor import NormalisingChannelProcessor
 from preprocess_toolbox.utils import get_config, get_implementation
@@ -18,8 +29,10 @@ def process_dataset():
             add_concurrency().
             add_destination().
             add_implementation().
+            add_incremental().
             add_reference().
             add_splits().
+            add_storage().
             add_trends().
             add_vars()).parse_args()
     ds_config = get_dataset_config_implementation(args.source)
@@ -34,6 +47,8 @@ def process_dataset():
                           splits,
                           args.abs,
                           anom_clim_splits=args.processing_splits,
+                          clim_frequency=Frequency[args.clim_frequency.upper()],
+                          incremental=args.incremental,
                           identifier=args.destination_id,
                           # TODO: nomenclature is old here, lag and lead make sense in forecasting, but not in here
                           #  so this mapping should be revised throughout the library - we don't necessarily forecast!
@@ -42,13 +57,17 @@ def process_dataset():
                           linear_trends=args.trends,
                           linear_trend_steps=args.trend_lead,
                           normalisation_splits=args.processing_splits,
+                          memory_limit=args.memory_limit,
                           parallel_opens=args.parallel_opens or False,
-                          ref_procdir=args.ref)
+                          ref_procdir=args.ref,
+                          workers=args.workers,
+                          **process_storage_args(args))
     proc.process()
 
 
 def init_dataset(args):
     ds_config = get_dataset_config_implementation(args.source)
+    load_invalid_dates(ds_config)
 
     if args.destination_id is not None:
         splits = process_split_args(args, frequency=ds_config.frequency)
@@ -57,19 +76,16 @@ def init_dataset(args):
             logging.info("Processing based on {} provided splits".format(len(splits)))
             split_dates = [date for split in splits.values() for date in split]
 
+            file_index = FileIndex(ds_config)
             all_files = dict()
             for var_config in ds_config.variables:
                 # This is not processing, so we naively extend the range as the split extension args might be set
                 # and if they aren't the preprocessing will dump the dates via Processor
-                lag = relativedelta({"{}s".format(ds_config.frequency.attribute): args.split_head})
-                lead = relativedelta({"{}s".format(ds_config.frequency.attribute): args.split_head})
-                min_filepath = ds_config.var_filepath(var_config, [min(split_dates) - lag])
-                max_filepath = ds_config.var_filepath(var_config, [max(split_dates) + lead])
-
-                var_files = sorted(ds_config.var_files[var_config.name])
-                min_index = var_files.index(min_filepath)
-                max_index = var_files.index(max_filepath)
-                all_files[var_config.name] = var_files[min_index:max_index+1]
+                lag = relativedelta(**{"{}s".format(ds_config.frequency.attribute): args.split_head})
+                lead = relativedelta(**{"{}s".format(ds_config.frequency.attribute): args.split_tail})
+                all_files[var_config.name] = file_index.files_between(var_config.name,
+                                                                      min(split_dates) - lag,
+                                                                      max(split_dates) + lead)
             ds_config.var_files = all_files
         else:
             logging.info("No splits provided, assuming to copy the whole dataset")
@@ -78,7 +94,7 @@ def init_dataset(args):
                           base_path=args.destination_path)
 
     var_names = None if "var_names" not in args else args.var_names
-    ds = ds_config.get_dataset(var_names)
+    ds = open_dataset_variables(ds_config, var_names)
     return ds, ds_config
 
 
@@ -87,65 +103,144 @@ def missing_time():
             add_destination().
             add_var_name().
             add_splits().
+            add_extra_args([
+                (("-mg", "--max-gap"), dict(type=int, default=None,
+                                            help="Longest run of missing dates to interpolate")),
+                (("-nt", "--nan-threshold"), dict(type=float, default=None,
+                                                  help="Fraction of NaN values at which a date is treated as missing")),
+            ]).
             parse_args())
     ds, ds_config = init_dataset(args)
 
-    for var_name in args.var_names:
-        logging.info("Processing missing dates for {}".format(var_name))
-        ds = process_missing_dates(ds,
-                                   ds_config,
-                                   var_name)
+    logging.info("Processing missing dates for {}".format(", ".join(args.var_names)))
+    ds = process_missing_dates(ds,
+                               ds_config,
+                               args.var_names,
+                               max_gap=args.max_gap,
+                               nan_threshold=args.nan_threshold)
 
     ds_config.save_data_for_config(source_ds=ds)
 
 
 def missing_spatial():
     args = (ProcessingArgParser(suppress_logs=["PIL"]).
+            add_concurrency().
             add_destination().
             add_var_name().
             add_splits().
             add_extra_args([
                 (("-m", "--mask-configuration"), dict()),
                 (("-mp", "--masks"), dict(type=csv_arg)),
+                (("-b", "--block-size"), dict(type=int, default=100,
+                                              help="Number of dates to load and interpolate at once")),
             ]).
             parse_args())
     ds, ds_config = init_dataset(args)
     mask_proc = None
 
-    if len(args.masks) > 0:
+    if args.masks is not None and len(args.masks) > 0:
         proc_config = get_config(args.mask_configuration)["data"]
         mask_proc = get_processor_from_source("masks", proc_config)
 
     for var_name in args.var_names:
         logging.info("Processing missing dates for {}".format(var_name))
-        ds[var_name] = spatial_interpolation(getattr(ds, var_name).compute(),
-                                             ds_config,
-                                             mask_proc,
-                                             args.masks,
-                                             save_comparison_fig=False)
-
-    ds_config.save_data_for_config(source_ds=ds)
+        # Blocks are staged as they're done, as the output files are still being read from,
+        # and merged into the dataset once the whole variable has been interpolated
+        with tempfile.TemporaryDirectory(dir=ds_config.path) as staging_dir:
+            block_files = list()
+
+            for block_da in spatial_interpolation_blocks(getattr(ds, var_name),
+                                                         ds_config,
+                                                         mask_proc,
+                                                         args.masks,
+                                                         block_size=args.block_size,
+                                                         workers=args.workers,
+                                                         memory_limit=args.memory_limit):
+                block_file = os.path.join(staging_dir, "{}.{}.nc".format(var_name, len(block_files)))
+                block_da.to_dataset().assign_attrs(ds.attrs).to_netcdf(block_file)
+                block_files.append(block_file)
+
+            with xr.open_mfdataset(block_files, combine="nested", concat_dim="time") as interpolated_ds:
+                ds_config.save_data_for_config(source_ds=interpolated_ds)
 
 
 def regrid():
     args = (ProcessingArgParser().
+            add_concurrency().
             add_ref_ds().
             add_destination().
             add_splits().
             parse_args())
     ds, ds_config = init_dataset(args)
-    regrid_dataset(args.reference, ds_config)
+    regrid_dataset(args.reference,
+                   ds_config,
+                   workers=args.workers,
+                   memory_limit=args.memory_limit)
     ds_config.save_config()
 
 
 def rotate():
     args = (ProcessingArgParser().
+            add_concurrency().
             add_ref_ds().
             add_destination().
             add_splits().
             add_var_name().
             parse_args())
     ds, ds_config = init_dataset(args)
-    rotate_dataset(args.reference, ds_config)
+    rotate_dataset(args.reference,
+                   ds_config,
+                   workers=args.workers,
+                   memory_limit=args.memory_limit)
     ds_config.save_config()
 
+
+def pipeline():
+    args = (ProcessingArgParser(suppress_logs=["PIL"]).
+            add_destination(optional=False).
+            add_var_name().
+            add_extra_args([
+                (("stages",), dict(type=csv_arg,
+                                   help="Comma separated stages to apply in order, from regrid, rotate, "
+                                        "missing_time and missing_spatial")),
+                (("-r", "--reference"), dict(type=str, default=None,
+                                             help="Reference file with the grid for the regrid and rotate stages")),
+                (("-vr", "--vars-to-rotate"), dict(type=csv_arg, default=["uas", "vas"],
+                                                   help="Comma separated names of the components to rotate")),
+                (("-mg", "--max-gap"), dict(type=int, default=None,
+                                            help="Longest run of missing dates to interpolate")),
+                (("-nt", "--nan-threshold"), dict(type=float, default=None,
+                                                  help="Fraction of NaN values at which a date is treated as missing")),
+                (("-m", "--mask-configuration"), dict()),
+                (("-mp", "--masks"), dict(type=csv_arg)),
+                (("-b", "--block-size"), dict(type=int, default=100,
+                                              help="Number of dates to interpolate spatially at once")),
+            ]).
+            parse_args())
+    ds_config = get_dataset_config_implementation(args.source)
+    load_invalid_dates(ds_config)
+    mask_proc = None
+
+    if args.masks is not None and len(args.masks) > 0:
+        proc_config = get_config(args.mask_configuration)["data"]
+        mask_proc = get_processor_from_source("masks", proc_config)
+
+    stage_factories = dict(
+        regrid=lambda: RegridStage(args.reference),
+        rotate=lambda: RotateStage(args.reference, args.vars_to_rotate),
+        missing_time=lambda: MissingTimeStage(args.max_gap, args.nan_threshold),
+        missing_spatial=lambda: MissingSpatialStage(mask_proc, args.masks, args.block_size),
+    )
+
+    for stage in args.stages:
+        if stage not in stage_factories:
+            raise RuntimeError("{} is not a pipeline stage, choose from {}".
+                               format(stage, ", ".join(stage_factories.keys())))
+        elif stage in ["regrid", "rotate"] and args.reference is None:
+            raise RuntimeError("The {} stage needs a reference file".format(stage))
+
+    run_pipeline(ds_config,
+                 [stage_factories[stage]() for stage in args.stages],
+                 args.destination_id,
+                 destination_path=args.destination_path,
+                 var_names=args.var_names)
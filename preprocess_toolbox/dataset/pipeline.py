@@ -0,0 +1,251 @@
+import logging
+import os
+
+import iris
+import numpy as np
+import xarray as xr
+
+from download_toolbox.dataset import DatasetConfig
+
+from preprocess_toolbox.dataset.regrid import get_regridder, load_source_cube
+from preprocess_toolbox.dataset.spatial import (cached_gridcell_angles,
+                                                gridcell_angle_terms,
+                                                spatial_interpolation)
+from preprocess_toolbox.dataset.time import process_missing_dates
+
+
+def _dim_name(coord: object) -> str:
+    return coord.var_name or coord.name()
+
+
+class PipelineStage:
+    """A lazy transform of a dataset, for composing with others in `run_pipeline`
+
+    Stages add to the dask graph of the dataset they're given rather than computing
+    it, so any number of them are written out in a single pass.
+    """
+    name = None
+
+    def __call__(self,
+                 ds: xr.Dataset,
+                 ds_config: DatasetConfig) -> xr.Dataset:
+        raise NotImplementedError("{} is not a usable stage".format(self.__class__.__name__))
+
+
+class RegridStage(PipelineStage):
+    """Regrid every variable on the source grid onto the grid of a reference file
+
+    This applies the same cached weights as regrid_dataset to each chunk of the data.
+
+    :param ref_file: File with the grid to regrid onto.
+    :param cache_path: Directory of cached regrid weights, by default alongside the datasets.
+    """
+    name = "regrid"
+
+    def __init__(self,
+                 ref_file: os.PathLike,
+                 cache_path: os.PathLike = None):
+        self._cache_path = cache_path
+        self._ref_file = ref_file
+
+    def __call__(self,
+                 ds: xr.Dataset,
+                 ds_config: DatasetConfig) -> xr.Dataset:
+        ref_cube = iris.load_cube(self._ref_file)
+        regridded = xr.Dataset(attrs=ds.attrs)
+
+        for var_name in ds.data_vars:
+            src_cube = load_source_cube(ds_config.var_files[var_name][0], ref_cube)
+            regridder = get_regridder(src_cube,
+                                      ref_cube,
+                                      os.path.join(ds_config.base_path, "_regrid_weights")
+                                      if self._cache_path is None else self._cache_path)
+            src_dims = [_dim_name(coord) for coord in reversed(regridder.source_coords)]
+            tgt_dims = [_dim_name(coord) for coord in reversed(regridder.target_coords)]
+
+            da = ds[var_name]
+            dtype = np.promote_types(da.dtype, np.float16) if da.dtype.kind in "iu" else da.dtype
+            da = da.astype(dtype).chunk({dim: -1 for dim in src_dims})
+
+            logging.info("Adding regrid of {} onto {} to pipeline".format(var_name, self._ref_file))
+            regridded[var_name] = xr.apply_ufunc(
+                regridder.apply,
+                da,
+                input_core_dims=[src_dims],
+                output_core_dims=[tgt_dims],
+                dask="parallelized",
+                output_dtypes=[dtype],
+                dask_gufunc_kwargs=dict(output_sizes={_dim_name(coord): len(coord.points)
+                                                      for coord in regridder.target_coords}),
+                keep_attrs=True,
+            ).assign_coords({_dim_name(coord): coord.points for coord in regridder.target_coords})
+        return regridded
+
+
+class RotateStage(PipelineStage):
+    """Rotate a pair of vector components from the reference grid to true east and north
+
+    :param ref_file: File with the grid the vectors are on.
+    :param vars_to_rotate: The names of the X and Y components.
+    :param angles_cache_path: Directory of cached gridcell angles, by default alongside the datasets.
+    """
+    name = "rotate"
+
+    def __init__(self,
+                 ref_file: os.PathLike,
+                 vars_to_rotate: object = ("uas", "vas"),
+                 angles_cache_path: os.PathLike = None):
+        if len(vars_to_rotate) != 2:
+            raise RuntimeError("Two variables only should be supplied, you gave {}".
+                               format(", ".join(vars_to_rotate)))
+
+        self._angles_cache_path = angles_cache_path
+        self._ref_file = ref_file
+        self._vars_to_rotate = vars_to_rotate
+
+    def __call__(self,
+                 ds: xr.Dataset,
+                 ds_config: DatasetConfig) -> xr.Dataset:
+        angles = cached_gridcell_angles(iris.load_cube(self._ref_file),
+                                        os.path.join(ds_config.base_path, "_gridcell_angles")
+                                        if self._angles_cache_path is None else self._angles_cache_path,
+                                        invert=True)
+
+        dims = [_dim_name(angles.coord(dimensions=dim, dim_coords=True)) for dim in range(angles.ndim)]
+        cos_angles, sin_angles = (xr.DataArray(terms, dims=dims) for terms in gridcell_angle_terms(angles))
+
+        logging.info("Adding rotation of {} to pipeline".format(", ".join(self._vars_to_rotate)))
+        u_name, v_name = self._vars_to_rotate
+        uu, vv = ds[u_name], ds[v_name]
+
+        ds = ds.copy()
+        ds[u_name] = (uu * cos_angles - vv * sin_angles).astype(uu.dtype).assign_attrs(uu.attrs)
+        ds[v_name] = (uu * sin_angles + vv * cos_angles).astype(vv.dtype).assign_attrs(vv.attrs)
+        return ds
+
+
+class MissingTimeStage(PipelineStage):
+    """Fill missing dates, as process_missing_dates does, for every variable
+
+    :param max_gap: Longest run of missing dates to interpolate.
+    :param nan_threshold: Fraction of NaN values at which a date is treated as missing.
+    """
+    name = "missing_time"
+
+    def __init__(self,
+                 max_gap: int = None,
+                 nan_threshold: float = None):
+        self._max_gap = max_gap
+        self._nan_threshold = nan_threshold
+
+    def __call__(self,
+                 ds: xr.Dataset,
+                 ds_config: DatasetConfig) -> xr.Dataset:
+        var_names = list(ds.data_vars)
+        logging.info("Adding missing dates for {} to pipeline".format(", ".join(var_names)))
+        return process_missing_dates(ds,
+                                     ds_config,
+                                     var_names,
+                                     max_gap=self._max_gap,
+                                     nan_threshold=self._nan_threshold)
+
+
+def _interpolate_block(da: xr.DataArray,
+                       ds_config: DatasetConfig,
+                       mask_processor: object,
+                       masks: list) -> xr.DataArray:
+    # The block may be shared with other tasks in the graph, so is never filled in place
+    return spatial_interpolation(da.copy(deep=True), ds_config, mask_processor, masks)
+
+
+class MissingSpatialStage(PipelineStage):
+    """Interpolate missing spatial values, as spatial_interpolation does, for every variable
+
+    Each block of dates is interpolated over the whole of its grid as it's computed.
+
+    :param mask_processor: Processor providing masks of cells that aren't to be filled.
+    :param masks: Names of the masks to use from `mask_processor`.
+    :param block_size: Number of dates to interpolate at once.
+    """
+    name = "missing_spatial"
+
+    def __init__(self,
+                 mask_processor: object = None,
+                 masks: list = None,
+                 block_size: int = 100):
+        self._block_size = block_size
+        self._mask_processor = mask_processor
+        self._masks = masks
+
+    def __call__(self,
+                 ds: xr.Dataset,
+                 ds_config: DatasetConfig) -> xr.Dataset:
+        ds = ds.copy()
+
+        for var_name in list(ds.data_vars):
+            logging.info("Adding spatial interpolation of {} to pipeline".format(var_name))
+            da = ds[var_name].chunk({dim: self._block_size if dim == "time" else -1
+                                     for dim in ds[var_name].dims})
+            ds[var_name] = da.map_blocks(_interpolate_block,
+                                         args=(ds_config, self._mask_processor, self._masks),
+                                         template=da)
+        return ds
+
+
+def open_dataset_variables(ds_config: DatasetConfig,
+                           var_names: list = None) -> xr.Dataset:
+    """Open variables of a dataset, each from its own files
+
+    DatasetConfig.get_dataset concatenates the files of every variable in time and keeps
+    the first of each date, leaving all but one variable empty, so the variables are
+    opened separately and merged instead.
+
+    :param ds_config:
+    :param var_names: Variables to open, by default all of them.
+    :return: Dataset of the variables
+    """
+    var_names = [var_config.name for var_config in ds_config.variables] if var_names is None else var_names
+    return xr.merge([ds_config.get_dataset([var_name])[[var_name]] for var_name in var_names], join="outer")
+
+
+def run_pipeline(ds_config: DatasetConfig,
+                 stages: list,
+                 destination_id: str,
+                 destination_path: os.PathLike = None,
+                 var_names: list = None) -> DatasetConfig:
+    """
+    Apply stages to a dataset lazily and write the result once to a new dataset
+
+    Rather than each step reading and rewriting every file, as the individual commands
+    do, the stages are composed into a single graph over the source files which is only
+    computed as the destination dataset is written.
+
+    :param ds_config: Configuration of the source dataset, which is left untouched.
+    :param stages: PipelineStage instances, applied in order.
+    :param destination_id: Identifier of the dataset to write.
+    :param destination_path: Base path of the dataset to write, by default that of the source.
+    :param var_names: Variables to process, by default all of them.
+    :return: The configuration, now of the destination dataset
+    """
+    ds = open_dataset_variables(ds_config, var_names)
+    source_path = ds_config.path
+
+    for stage in stages:
+        ds = stage(ds, ds_config)
+
+    # Only retarget the configuration, the data comes from the source files in the graph
+    ds_config.var_files = dict()
+    ds_config.copy_to(destination_id,
+                      base_path=ds_config.base_path if destination_path is None else destination_path)
+
+    if os.path.abspath(ds_config.path) == os.path.abspath(source_path):
+        raise RuntimeError("The pipeline can't write to {} as it is reading from it".format(source_path))
+
+    # A configuration loaded from file would otherwise be written back over the source's,
+    # with the source files merged into it
+    ds_config.config.clear()
+    ds_config.config_path = ds_config.root_path
+
+    logging.info("Writing {} stages to {}".format(", ".join([stage.name for stage in stages]), ds_config.path))
+    ds_config.save_data_for_config(source_ds=ds)
+    return ds_config
@@ -1,4 +1,7 @@
+import concurrent.futures
+import itertools
 import logging
+import multiprocessing
 import os
 import re
 
@@ -8,14 +11,19 @@ import iris.exceptions
 import numpy as np
 
 from download_toolbox.interface import DatasetConfig
-from preprocess_toolbox.dataset.spatial import (gridcell_angles_from_dim_coords,
-                                                invert_gridcell_angles,
+from preprocess_toolbox.dataset.regrid import regrid_file
+from preprocess_toolbox.dataset.spatial import (cached_gridcell_angles,
+                                                gridcell_angle_terms,
                                                 rotate_grid_vectors)
+from preprocess_toolbox.journal import ProcessingJournal
+from preprocess_toolbox.utils import file_digest, init_worker_process
 
 
 def regrid_dataset(ref_file: os.PathLike,
                    process_config: DatasetConfig,
-                   regrid_processing: callable = None):
+                   regrid_processing: callable = None,
+                   workers: int = 1,
+                   memory_limit: int = None):
     """
 
     TODO: we need to incorporate OSISAF / SIC grounc truth cube generation into the IceNet library
@@ -25,69 +33,142 @@ def regrid_dataset(ref_file: os.PathLike,
     TODO: regrid_processing needs to come from a module:regrid method in icenet.data.regrid.osisaf, for example
      which needs to be specified from the command line
 
+    Regrid weights are calculated once for each source grid and cached under the dataset,
+    after which files are regridded across `workers` processes. regrid_processing must be
+    picklable, such as a module level function, when using more than one worker.
+
+    Progress is journalled against the reference file, so a rerun after an interruption
+    skips the files already regridded rather than regridding them again.
+
     :param ref_file:
     :param process_config:
     :param regrid_processing:
+    :param workers:
+    :param memory_limit:
     """
     logging.info("Regridding dataset")
 
-    # Give me strength with Iris, it's hard to tell what it'll return
-    ref_cube = iris.load_cube(ref_file)
-
-    for datafile in [_
-                     for var_files in process_config.var_files.values()
-                     for _ in var_files]:
-        (datafile_path, datafile_name) = os.path.split(datafile)
-
-        regrid_source_name = "_regrid_{}".format(datafile_name)
-        regrid_datafile = os.path.join(datafile_path, regrid_source_name)
-        os.rename(datafile, regrid_datafile)
-
-        logging.debug("Regridding {}".format(regrid_datafile))
-
-        try:
-            cube = iris.load_cube(regrid_datafile)
-
-            # TODO: there is a lot of assumption here - introduce some defense
-            if cube.coord_system() is None:
-                cs = ref_cube.coord_system().ellipsoid
-
-                for coord in ['longitude', 'latitude']:
-                    cube.coord(coord).coord_system = cs
-
-            cube_regridded = cube.regrid(ref_cube, iris.analysis.Linear())
-
-        except iris.exceptions.CoordinateNotFoundError:
-            logging.warning("{} has no coordinates...".format(datafile_name))
-            continue
-
-        if regrid_processing is not None:
-            logging.debug("Calling regrid processing callable: {}".format(regrid_processing))
-            cube_regridded = regrid_processing(cube_regridded)
-
-        logging.debug("Saving regridded data to {}... ".format(datafile))
-        iris.save(cube_regridded, datafile, fill_value=np.nan)
+    cache_path = os.path.join(process_config.path, "_regrid_weights")
+    journal = ProcessingJournal(os.path.join(process_config.path, "_journal"),
+                                "regrid",
+                                dict(reference=file_digest(ref_file),
+                                     regrid_processing=getattr(regrid_processing, "__qualname__", None)))
+    journal.recover()
+
+    datafiles = [_
+                 for var_files in process_config.var_files.values()
+                 for _ in var_files]
+    pending = [datafile for datafile in datafiles if not journal.is_complete(datafile)]
+    logging.info("{} of {} files already regridded".format(len(datafiles) - len(pending), len(datafiles)))
+
+    if len(pending) < 1:
+        return
+
+    def commit(datafile, temp_datafile):
+        if temp_datafile is not None:
+            journal.commit({datafile: temp_datafile})
+
+    # The first file calculates and caches the weights, so the workers only have to load them
+    commit(pending[0], regrid_file(pending[0], ref_file, cache_path, regrid_processing))
+
+    if workers > 1:
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=init_worker_process,
+                initargs=(logging.getLogger().getEffectiveLevel(), memory_limit, 1)) as executor:
+            for datafile, temp_datafile in zip(pending[1:],
+                                               executor.map(regrid_file,
+                                                            pending[1:],
+                                                            itertools.repeat(ref_file),
+                                                            itertools.repeat(cache_path),
+                                                            itertools.repeat(regrid_processing),
+                                                            chunksize=max(1, len(pending) // (workers * 4)))):
+                commit(datafile, temp_datafile)
+    else:
+        for datafile in pending[1:]:
+            commit(datafile, regrid_file(datafile, ref_file, cache_path, regrid_processing))
+
+    logging.info("Regridded {} files".format(len(pending)))
+
+
+def rotate_files(wind_files: tuple,
+                 angle_terms: tuple,
+                 vars_to_rotate: object = ("uas", "vas")) -> object:
+    """
+    Rotate a pair of wind files, writing the rotated data to temporary files alongside
 
-        if os.path.exists(datafile):
-            os.remove(regrid_datafile)
+    :param wind_files: The pair of files for the variables in vars_to_rotate
+    :param angle_terms: Cosines and sines of the gridcell angles, from gridcell_angle_terms
+    :param vars_to_rotate:
+    :return: dict of temporary file paths by the file they replace, None if the pair can't be rotated
+    """
+    wind_file_0, wind_file_1 = wind_files
+    logging.info("Rotating {} and {}".format(wind_file_0, wind_file_1))
+
+    wind_cubes = dict()
+    wind_cubes_r = dict()
+
+    wind_cubes[vars_to_rotate[0]] = iris.load_cube(wind_file_0)
+    wind_cubes[vars_to_rotate[1]] = iris.load_cube(wind_file_1)
+
+    try:
+        wind_cubes_r[vars_to_rotate[0]], wind_cubes_r[vars_to_rotate[1]] = \
+            rotate_grid_vectors(
+                wind_cubes[vars_to_rotate[0]],
+                wind_cubes[vars_to_rotate[1]],
+                angle_terms,
+            )
+    except iris.exceptions.CoordinateNotFoundError:
+        logging.exception("Failure to rotate due to coordinate issues. "
+                          "moving onto next file")
+        return None
+
+    # Original implementation is in danger of lost updates
+    # due to potential lazy loading
+    replacements = dict()
+    for i, name in enumerate([wind_file_0, wind_file_1]):
+        # NOTE: implementation with temp file caused problems on NFS
+        # mounted filesystem, so avoiding in place of letting iris do it
+        temp_name = os.path.join(os.path.split(name)[0],
+                                 "temp.{}".format(
+                                     os.path.basename(name)))
+        logging.debug("Writing {}".format(temp_name))
+
+        iris.save(wind_cubes_r[vars_to_rotate[i]], temp_name)
+        replacements[name] = temp_name
+    return replacements
 
 
 def rotate_dataset(ref_file: os.PathLike,
                    process_config: DatasetConfig,
-                   vars_to_rotate: object = ("uas", "vas")):
+                   vars_to_rotate: object = ("uas", "vas"),
+                   workers: int = 1,
+                   memory_limit: int = None,
+                   angles_cache_path: os.PathLike = None):
     """
 
+    The gridcell angle terms are calculated once from the reference, after which pairs
+    of files are rotated across `workers` processes. The gridcell angles themselves are
+    cached for the reference grid, by default alongside the datasets in the base path.
+
     :param ref_file:
     :param process_config:
     :param vars_to_rotate:
+    :param workers:
+    :param memory_limit:
+    :param angles_cache_path:
     """
     if len(vars_to_rotate) != 2:
         raise RuntimeError("Two variables only should be supplied, you gave {}".format(", ".join(vars_to_rotate)))
 
     ref_cube = iris.load_cube(ref_file)
 
-    angles = gridcell_angles_from_dim_coords(ref_cube)
-    invert_gridcell_angles(angles)
+    angles = cached_gridcell_angles(ref_cube,
+                                    os.path.join(process_config.base_path, "_gridcell_angles")
+                                    if angles_cache_path is None else angles_cache_path,
+                                    invert=True)
+    angle_terms = gridcell_angle_terms(angles)
 
     wind_files = {
         vars_to_rotate[0]: sorted(process_config.var_files[vars_to_rotate[0]]),
@@ -110,41 +191,46 @@ def rotate_dataset(ref_file: os.PathLike,
             raise RuntimeError("{} is not at the end of {}, something is "
                                "wrong".format(wd0, wind_file_1))
 
-    for idx, wind_file_0 in enumerate(wind_files[vars_to_rotate[0]]):
-        wind_file_1 = wind_files[vars_to_rotate[1]][idx]
-
-        logging.info("Rotating {} and {}".format(wind_file_0, wind_file_1))
-
-        wind_cubes = dict()
-        wind_cubes_r = dict()
-
-        wind_cubes[vars_to_rotate[0]] = iris.load_cube(wind_file_0)
-        wind_cubes[vars_to_rotate[1]] = iris.load_cube(wind_file_1)
-
-        try:
-            wind_cubes_r[vars_to_rotate[0]], wind_cubes_r[vars_to_rotate[1]] = \
-                rotate_grid_vectors(
-                    wind_cubes[vars_to_rotate[0]],
-                    wind_cubes[vars_to_rotate[1]],
-                    angles,
-                )
-        except iris.exceptions.CoordinateNotFoundError:
-            logging.exception("Failure to rotate due to coordinate issues. "
-                              "moving onto next file")
-            continue
-
-        # Original implementation is in danger of lost updates
-        # due to potential lazy loading
-        for i, name in enumerate([wind_file_0, wind_file_1]):
-            # NOTE: implementation with temp file caused problems on NFS
-            # mounted filesystem, so avoiding in place of letting iris do it
-            temp_name = os.path.join(os.path.split(name)[0],
-                                     "temp.{}".format(
-                                         os.path.basename(name)))
-            logging.debug("Writing {}".format(temp_name))
-
-            iris.save(wind_cubes_r[vars_to_rotate[i]], temp_name)
-            os.replace(temp_name, name)
-            logging.debug("Overwritten {}".format(name))
+    journal = ProcessingJournal(os.path.join(process_config.path, "_journal"),
+                                "rotate",
+                                dict(reference=file_digest(ref_file),
+                                     vars_to_rotate=list(vars_to_rotate)))
+    journal.recover()
+
+    pending = [wind_pair for wind_pair in zip(wind_files[vars_to_rotate[0]], wind_files[vars_to_rotate[1]])
+               if not all([journal.is_complete(wind_file) for wind_file in wind_pair])]
+    logging.info("{} of {} file pairs already rotated".
+                 format(len(wind_files[vars_to_rotate[0]]) - len(pending), len(wind_files[vars_to_rotate[0]])))
+
+    failures = list()
+
+    def commit(wind_pair, replacements):
+        # Both files are replaced under the journal, so the pair is never left half rotated
+        if replacements is not None:
+            journal.commit(replacements)
+            logging.debug("Overwritten {}".format(", ".join(replacements.keys())))
+        else:
+            failures.append(wind_pair)
+
+    if workers > 1 and len(pending) > 1:
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=init_worker_process,
+                initargs=(logging.getLogger().getEffectiveLevel(), memory_limit, 1)) as executor:
+            rotated = executor.map(rotate_files,
+                                   pending,
+                                   itertools.repeat(angle_terms),
+                                   itertools.repeat(vars_to_rotate),
+                                   chunksize=max(1, len(pending) // (workers * 4)))
+            for wind_pair, replacements in zip(pending, rotated):
+                commit(wind_pair, replacements)
+    else:
+        for wind_pair in pending:
+            commit(wind_pair, rotate_files(wind_pair, angle_terms, vars_to_rotate))
+
+    if len(failures) > 0:
+        logging.error("{} of {} file pairs could not be rotated, from {}".
+                      format(len(failures), len(pending), ", ".join(failures[0])))
 
     # merge_files(new_datafile, moved_datafile, self._drop_vars)
@@ -0,0 +1,317 @@
+import copy
+import functools
+import hashlib
+import logging
+import os
+
+import iris
+import iris.cube
+import iris.exceptions
+import numpy as np
+import scipy.sparse as sparse
+
+
+def _axis_weights(points: np.ndarray,
+                  samples: np.ndarray,
+                  circular: bool = False,
+                  modulus: float = None) -> tuple:
+    """
+    Linear interpolation indices and weights along a single source axis
+
+    This follows the interpolation iris.analysis.Linear performs: points are sorted
+    ascending, circular axes gain a wrapped point, samples are mapped into the range
+    of a modular axis and those beyond the axis are linearly extrapolated.
+
+    Args:
+        points: the source coordinate points
+        samples: the target locations in source coordinates
+        circular: whether the axis wraps around
+        modulus: the modulus of the axis units, if any
+
+    Returns:
+        tuple of lower and upper indices into `points` and the weight of the upper
+
+    """
+    points = np.asarray(points, dtype=np.float64)
+    idxs = np.argsort(points)
+    points = points[idxs]
+
+    if circular:
+        points = np.append(points, points[0] + modulus)
+        idxs = np.append(idxs, idxs[0])
+
+    samples = np.asarray(samples, dtype=np.float64)
+
+    if modulus:
+        offset = (points.max() + points.min() - modulus) * 0.5
+        samples = ((samples - offset) % modulus) + offset
+
+    lower = np.clip(np.searchsorted(points, samples) - 1, 0, len(points) - 2)
+    weight = (samples - points[lower]) / (points[lower + 1] - points[lower])
+    return idxs[lower], idxs[lower + 1], weight
+
+
+def _grid_coords(cube: iris.cube.Cube) -> tuple:
+    return cube.coord(axis="x", dim_coords=True), cube.coord(axis="y", dim_coords=True)
+
+
+def grid_key(src_cube: iris.cube.Cube,
+             tgt_cube: iris.cube.Cube) -> str:
+    """
+    Identify a source and target grid pair by the content of their coordinates
+
+    Args:
+        src_cube:
+        tgt_cube:
+
+    Returns:
+        hex digest identifying the pair
+
+    """
+    digest = hashlib.sha256()
+
+    for coord in [*_grid_coords(src_cube), *_grid_coords(tgt_cube)]:
+        digest.update(np.ascontiguousarray(coord.points, dtype=np.float64).tobytes())
+        digest.update(repr((coord.coord_system, str(coord.units), coord.circular)).encode())
+    return digest.hexdigest()[:16]
+
+
+def linear_regrid_weights(src_cube: iris.cube.Cube,
+                          tgt_cube: iris.cube.Cube) -> sparse.csr_matrix:
+    """
+    Sparse bilinear weights mapping a rectilinear source grid onto a target grid
+
+    The target grid is transformed into the source coordinate system and each target
+    cell weighted from the four source cells around it, as iris.analysis.Linear does,
+    but once for the grid pair rather than for every cube regridded.
+
+    Args:
+        src_cube:
+        tgt_cube:
+
+    Returns:
+        matrix of shape (target cells, source cells), both flattened y then x
+
+    """
+    src_x, src_y = _grid_coords(src_cube)
+    tgt_x, tgt_y = _grid_coords(tgt_cube)
+
+    sample_x, sample_y = np.meshgrid(tgt_x.points, tgt_y.points)
+
+    # Skip the transform where we can, as iris does, to avoid precision problems
+    if src_x.coord_system != tgt_x.coord_system:
+        sample_xyz = src_x.coord_system.as_cartopy_crs().transform_points(
+            tgt_x.coord_system.as_cartopy_crs(), sample_x, sample_y)
+        sample_x, sample_y = sample_xyz[..., 0], sample_xyz[..., 1]
+
+    x_lower, x_upper, x_weight = _axis_weights(src_x.points, sample_x.ravel(),
+                                               src_x.circular, src_x.units.modulus)
+    y_lower, y_upper, y_weight = _axis_weights(src_y.points, sample_y.ravel(), False, src_y.units.modulus)
+
+    rows = np.tile(np.arange(sample_x.size), 4)
+    cols = np.concatenate([y_lower * len(src_x.points) + x_lower,
+                           y_lower * len(src_x.points) + x_upper,
+                           y_upper * len(src_x.points) + x_lower,
+                           y_upper * len(src_x.points) + x_upper])
+    weights = np.concatenate([(1 - y_weight) * (1 - x_weight),
+                              (1 - y_weight) * x_weight,
+                              y_weight * (1 - x_weight),
+                              y_weight * x_weight])
+
+    # Zero weights are retained so that NaNs propagate from neighbours as with iris
+    return sparse.csr_matrix((weights, (rows, cols)),
+                             shape=(sample_x.size, len(src_x.points) * len(src_y.points)))
+
+
+class LinearRegridder:
+    """Bilinear regridding between a source and target grid, with weights cached to disk
+
+    Weights are calculated once for each pair of grids and stored in `cache_path` by the
+    content of the grid coordinates, so every cube on the same grid, in this or any other
+    process, is regridded with a single sparse product.
+
+    :param src_cube: A cube on the source grid.
+    :param tgt_cube: A cube on the target grid.
+    :param cache_path: Directory to store weights in, None to calculate without caching.
+    """
+
+    def __init__(self,
+                 src_cube: iris.cube.Cube,
+                 tgt_cube: iris.cube.Cube,
+                 cache_path: os.PathLike = None):
+        self._key = grid_key(src_cube, tgt_cube)
+        self._src_coords = _grid_coords(src_cube)
+        self._tgt_coords = _grid_coords(tgt_cube)
+        self._weights = None
+
+        weights_path = None if cache_path is None else os.path.join(cache_path, "{}.npz".format(self._key))
+
+        if weights_path is not None and os.path.exists(weights_path):
+            logging.debug("Loading regrid weights from {}".format(weights_path))
+            self._weights = sparse.load_npz(weights_path)
+        else:
+            logging.info("Calculating regrid weights for grids {}".format(self._key))
+            self._weights = linear_regrid_weights(src_cube, tgt_cube)
+
+            if weights_path is not None:
+                os.makedirs(cache_path, exist_ok=True)
+                temp_path = os.path.join(cache_path, "{}.{}.tmp.npz".format(self._key, os.getpid()))
+                sparse.save_npz(temp_path, self._weights)
+                os.replace(temp_path, weights_path)
+
+    def __call__(self, cube: iris.cube.Cube) -> iris.cube.Cube:
+        """Regrid `cube`, which must be on the source grid of this regridder
+
+        :param cube:
+        :return: A cube on the target grid, with the other coordinates and metadata of `cube`
+        """
+        src_x, src_y = _grid_coords(cube)
+
+        if src_x != self._src_coords[0] or src_y != self._src_coords[1]:
+            raise ValueError("{} is not on the source grid of this regridder".format(cube.name()))
+
+        x_dim, y_dim = cube.coord_dims(src_x)[0], cube.coord_dims(src_y)[0]
+        tgt_x, tgt_y = self._tgt_coords
+
+        data = cube.data
+        dtype = np.promote_types(data.dtype, np.float16) if data.dtype.kind in "iu" else data.dtype
+        data = np.ma.filled(data.astype(dtype), np.nan) if np.ma.isMaskedArray(data) else data.astype(dtype)
+
+        data = np.moveaxis(self.apply(np.moveaxis(data, (y_dim, x_dim), (-2, -1))), (-2, -1), (y_dim, x_dim))
+
+        result = iris.cube.Cube(data)
+        result.metadata = copy.deepcopy(cube.metadata)
+        result.add_dim_coord(tgt_x.copy(), x_dim)
+        result.add_dim_coord(tgt_y.copy(), y_dim)
+
+        for coord in cube.dim_coords + cube.aux_coords:
+            dims = cube.coord_dims(coord)
+
+            if x_dim in dims or y_dim in dims:
+                continue
+            elif coord in cube.dim_coords:
+                result.add_dim_coord(coord.copy(), dims)
+            else:
+                result.add_aux_coord(coord.copy(), dims)
+        return result
+
+    def apply(self, data: np.ndarray) -> np.ndarray:
+        """Regrid an array whose final two dimensions are the source Y and X
+
+        :param data: floating point array, with NaNs for missing values
+        :return: array with the final two dimensions being the target Y and X
+        """
+        tgt_x, tgt_y = self._tgt_coords
+        leading_shape = data.shape[:-2]
+        result = (self._weights @ data.reshape(-1, data.shape[-2] * data.shape[-1]).T).T
+        return result.reshape(*leading_shape, len(tgt_y.points), len(tgt_x.points)).astype(data.dtype)
+
+    @property
+    def key(self) -> str:
+        return self._key
+
+    @property
+    def source_coords(self) -> tuple:
+        return self._src_coords
+
+    @property
+    def target_coords(self) -> tuple:
+        return self._tgt_coords
+
+
+@functools.lru_cache(maxsize=8)
+def _load_ref_cube(ref_file: os.PathLike) -> iris.cube.Cube:
+    return iris.load_cube(ref_file)
+
+
+def load_source_cube(datafile: os.PathLike,
+                     ref_cube: iris.cube.Cube) -> iris.cube.Cube:
+    """
+    Load a cube to regrid, assuming the ellipsoid of the reference if it has no coordinate system
+
+    Args:
+        datafile:
+        ref_cube:
+
+    Returns:
+        the cube from `datafile`
+
+    """
+    cube = iris.load_cube(datafile)
+
+    # TODO: there is a lot of assumption here - introduce some defense
+    if cube.coord_system() is None:
+        cs = ref_cube.coord_system().ellipsoid
+
+        for coord in ['longitude', 'latitude']:
+            cube.coord(coord).coord_system = cs
+    return cube
+
+
+def regrid_file(datafile: os.PathLike,
+                ref_file: os.PathLike,
+                cache_path: os.PathLike = None,
+                regrid_processing: callable = None) -> object:
+    """
+    Regrid a data file onto the grid of a reference file
+
+    The regridded data is written to a temporary file alongside, for the caller to
+    rename over the original, so the original is left intact should this fail or be
+    interrupted.
+
+    Args:
+        datafile:
+        ref_file:
+        cache_path: directory of cached regrid weights
+        regrid_processing: callable to apply to the regridded cube before saving
+
+    Returns:
+        the path of the regridded temporary file, None if the file can't be regridded
+
+    """
+    ref_cube = _load_ref_cube(ref_file)
+    (datafile_path, datafile_name) = os.path.split(datafile)
+
+    logging.debug("Regridding {}".format(datafile))
+
+    try:
+        cube = load_source_cube(datafile, ref_cube)
+        cube_regridded = get_regridder(cube, ref_cube, cache_path)(cube)
+
+    except iris.exceptions.CoordinateNotFoundError:
+        logging.warning("{} has no coordinates...".format(datafile_name))
+        return None
+
+    if regrid_processing is not None:
+        logging.debug("Calling regrid processing callable: {}".format(regrid_processing))
+        cube_regridded = regrid_processing(cube_regridded)
+
+    temp_datafile = os.path.join(datafile_path, "_regrid_{}".format(datafile_name))
+    logging.debug("Saving regridded data for {} to {}... ".format(datafile, temp_datafile))
+    iris.save(cube_regridded, temp_datafile, fill_value=np.nan)
+    return temp_datafile
+
+
+_regridders = dict()
+
+
+def get_regridder(src_cube: iris.cube.Cube,
+                  tgt_cube: iris.cube.Cube,
+                  cache_path: os.PathLike = None) -> LinearRegridder:
+    """
+    Get the regridder for a pair of grids, held for reuse within the process
+
+    Args:
+        src_cube:
+        tgt_cube:
+        cache_path:
+
+    Returns:
+        LinearRegridder
+
+    """
+    key = (grid_key(src_cube, tgt_cube), cache_path)
+
+    if key not in _regridders:
+        _regridders[key] = LinearRegridder(src_cube, tgt_cube, cache_path)
+    return _regridders[key]
@@ -1,4 +1,8 @@
+import concurrent.futures
+import functools
+import hashlib
 import logging
+import multiprocessing
 import os
 
 import cartopy.crs as ccrs
@@ -8,10 +12,111 @@ import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
 import xarray as xr
-import scipy.interpolate as interpolate
+import scipy.sparse as sparse
+import scipy.spatial as spatial
 
 from download_toolbox.dataset import DatasetConfig
 
+from preprocess_toolbox.utils import init_worker_process
+
+
+@functools.lru_cache(maxsize=32)
+def interpolation_weights(invalid_pattern: bytes,
+                          shape: tuple) -> tuple:
+    """
+    Sparse bilinear interpolation weights for filling the invalid cells of a grid
+
+    The cells bordering each invalid region, along rows and columns, are triangulated
+    once for the pattern and the barycentric weights of every invalid cell within that
+    triangulation stored, so any number of fields sharing the pattern can be filled
+    with a single sparse product. This is the calculation scipy.interpolate.griddata
+    performs with linear interpolation, without recomputing the triangulation.
+
+    Args:
+        invalid_pattern: packed bits of the boolean invalid cell array, as from np.packbits
+        shape: the 2D shape of the grid
+
+    Returns:
+        tuple of flat invalid cell indices, flat neighbour cell indices, and the sparse
+        weights mapping neighbour values to invalid cells, the latter None if there is
+        nothing to interpolate with
+
+    """
+    x_len, y_len = shape
+    invalid = np.unpackbits(np.frombuffer(invalid_pattern, dtype=np.uint8),
+                            count=x_len * y_len).astype(bool).reshape(shape)
+    yy, xx = np.indices(shape)
+
+    # Find grid cell locations surrounding NaN regions for bilinear
+    # interpolation
+    nan_mask = np.ma.masked_array(np.full((x_len, y_len), 0.))
+    nan_mask[invalid] = np.ma.masked
+
+    nan_neighbour_arrs = {}
+    # C - horizontal, F - vertical
+    for order in 'C', 'F':
+        # starts and ends indexes of masked element chunks
+        slice_ends = np.ma.clump_masked(nan_mask.ravel(order=order))
+
+        nan_neighbour_idxs = []
+        nan_neighbour_idxs.extend([s.start - 1 for s in slice_ends])
+        nan_neighbour_idxs.extend([s.stop for s in slice_ends])
+        nan_neighbour_idxs = [el for el in nan_neighbour_idxs
+                              if 0 <= el < np.prod((x_len, y_len))]
+
+        nan_neighbour_arr_i = np.array(
+            np.full(shape=(x_len, y_len), fill_value=False),
+            order=order)
+        nan_neighbour_arr_i.ravel(order=order)[nan_neighbour_idxs] = True
+        nan_neighbour_arrs[order] = nan_neighbour_arr_i
+
+    nan_neighbour_arr = nan_neighbour_arrs['C'] + nan_neighbour_arrs['F']
+    # Remove artefacts along edge of the grid
+    nan_neighbour_arr[:, 0] = \
+        nan_neighbour_arr[0, :] = \
+        nan_neighbour_arr[:, -1] = \
+        nan_neighbour_arr[-1, :] = False
+
+    if np.sum(nan_neighbour_arr) == 1:
+        res = np.where(np.array(nan_neighbour_arr) == True)  # noqa: E712
+        logging.warning(
+            "Not enough nans for interpolation, extending {}".format(res))
+
+        x_idx, y_idx = res[0][0], res[1][0]
+        nan_neighbour_arr[x_idx - 1:x_idx + 2, y_idx] = True
+        nan_neighbour_arr[x_idx, y_idx - 1:y_idx + 2] = True
+        logging.debug(
+            np.where(np.array(nan_neighbour_arr) == True))  # noqa: E712
+
+    invalid_idxs = np.flatnonzero(invalid)
+    neighbour_idxs = np.flatnonzero(nan_neighbour_arr)
+
+    if len(neighbour_idxs) < 1:
+        return invalid_idxs, neighbour_idxs, None
+
+    points = np.c_[xx.ravel()[neighbour_idxs], yy.ravel()[neighbour_idxs]].astype(np.float64)
+    xi = np.c_[xx.ravel()[invalid_idxs], yy.ravel()[invalid_idxs]].astype(np.float64)
+
+    triangulation = spatial.Delaunay(points)
+    simplices = triangulation.find_simplex(xi)
+    inside = simplices >= 0
+
+    # Barycentric coordinates of each interpolated cell within its enclosing triangle
+    transform = triangulation.transform[simplices[inside]]
+    barycentric = np.einsum("ijk,ik->ij", transform[:, :2], xi[inside] - transform[:, 2])
+    weights = np.c_[barycentric, 1 - barycentric.sum(axis=1)]
+
+    rows = np.repeat(np.flatnonzero(inside), 3)
+    columns = triangulation.simplices[simplices[inside]].ravel()
+    interpolation = sparse.csr_matrix((weights.ravel(), (rows, columns)),
+                                      shape=(len(invalid_idxs), len(neighbour_idxs)))
+
+    # Cells outside the triangulation have no weights, but must come out as NaN
+    outside = sparse.csr_matrix((np.full((~inside).sum(), np.nan),
+                                 (np.flatnonzero(~inside), np.zeros((~inside).sum(), dtype=int))),
+                                shape=interpolation.shape)
+    return invalid_idxs, neighbour_idxs, interpolation + outside
+
 
 def spatial_interpolation(da: xr.DataArray,
                           ds_config: DatasetConfig,
@@ -21,6 +126,9 @@ def spatial_interpolation(da: xr.DataArray,
     """
     TODO: method inherited from icenet2 draft code from Tom, not sure it's generalisable
 
+    Dates are grouped by their pattern of invalid cells, so that the interpolation
+    weights are calculated once per pattern and each group filled in one operation.
+
     Args:
         da:
         ds_config:
@@ -29,8 +137,15 @@ def spatial_interpolation(da: xr.DataArray,
         save_comparison_fig:
 
     """
+    if len(da.shape) > 3:
+        raise RuntimeError("Spatial interpolation is only available for 2D data: {} - {} spatial dims found".
+                           format(len(da.shape) - 1, "x".join([str(el) for el in da.shape[1:]])))
+
+    data = da.values
+    shape = data.shape[1:]
+    patterns = dict()
 
-    for date in da.time.values:
+    for date_idx, date in enumerate(da.time.values):
         mask = None
         if mask_processor is not None:
             logging.debug("Getting masks {} from {}".format(", ".join(masks), mask_processor))
@@ -41,105 +156,130 @@ def spatial_interpolation(da: xr.DataArray,
                     add_mask = getattr(mask_processor, mask_type)(date)
                     mask[add_mask] = True
 
-        da_el = da.sel(time=date).copy()
-        if len(da_el.shape) > 2:
-            raise RuntimeError("Spatial interpolation is only available for 2D data: {} - {} spatial dims found".
-                               format(len(da_el.shape), "x".format(da_el.shape)))
-        x_len, y_len = da_el.shape
-        xx, yy = np.meshgrid(np.arange(x_len), np.arange(y_len))
-
         # Grid cells outside NaN regions
-        valid = ~np.isnan(da_el.data)
+        valid = ~np.isnan(data[date_idx])
         if mask is not None:
             valid = valid | mask
 
         # Interpolate if there is more than one missing grid cell
         if np.sum(~valid) >= 1:
-            date_str = pd.to_datetime(date).strftime(ds_config.frequency.date_format)
-            logging.info("Interpolating spatial data for {}".format(date_str))
-
-            # Find grid cell locations surrounding NaN regions for bilinear
-            # interpolation
-            nan_mask = np.ma.masked_array(np.full((x_len, y_len), 0.))
-            nan_mask[~valid] = np.ma.masked
-
-            nan_neighbour_arrs = {}
-            # C - horizontal, F - vertical
-            for order in 'C', 'F':
-                # starts and ends indexes of masked element chunks
-                slice_ends = np.ma.clump_masked(nan_mask.ravel(order=order))
-
-                nan_neighbour_idxs = []
-                nan_neighbour_idxs.extend([s.start - 1 for s in slice_ends])
-                nan_neighbour_idxs.extend([s.stop for s in slice_ends])
-                nan_neighbour_idxs = [el for el in nan_neighbour_idxs
-                                      if 0 <= el < np.prod((x_len, y_len))]
-
-                nan_neighbour_arr_i = np.array(
-                    np.full(shape=(x_len, y_len), fill_value=False),
-                    order=order)
-                nan_neighbour_arr_i.ravel(order=order)[nan_neighbour_idxs] = True
-                nan_neighbour_arrs[order] = nan_neighbour_arr_i
-
-            nan_neighbour_arr = nan_neighbour_arrs['C'] + nan_neighbour_arrs['F']
-            # Remove artefacts along edge of the grid
-            nan_neighbour_arr[:, 0] = \
-                nan_neighbour_arr[0, :] = \
-                nan_neighbour_arr[:, -1] = \
-                nan_neighbour_arr[-1, :] = False
-
-            if np.sum(nan_neighbour_arr) == 1:
-                res = np.where(np.array(nan_neighbour_arr) == True)  # noqa: E712
-                logging.warning(
-                    "Not enough nans for interpolation, extending {}".format(res))
-
-                x_idx, y_idx = res[0][0], res[1][0]
-                nan_neighbour_arr[x_idx - 1:x_idx + 2, y_idx] = True
-                nan_neighbour_arr[x_idx, y_idx - 1:y_idx + 2] = True
-                logging.debug(
-                    np.where(np.array(nan_neighbour_arr) == True))  # noqa: E712
-
-            # Perform bilinear interpolation
-            x_valid = xx[nan_neighbour_arr]
-            y_valid = yy[nan_neighbour_arr]
-            values = da_el.data[nan_neighbour_arr]
-
-            x_interp = xx[~valid]
-            y_interp = yy[~valid]
-
-            before = da_el.copy()
-
-            try:
-                if len(x_valid) or len(y_valid):
-                    interp_vals = interpolate.griddata((x_valid, y_valid),
-                                                       values,
-                                                       (x_interp, y_interp),
-                                                       method='linear')
-                    da_el.data[~valid] = interp_vals
-                else:
-                    logging.warning("No valid values to interpolate with on {}".format(date_str))
-            except Exception as e:
-                logging.warning("Interpolation failed for {}, assignment will not take place: {}".format(date_str, e))
-            else:
-                da.loc[dict(time=date)] = da_el
-
-                if save_comparison_fig:
-                    plt.rcParams['figure.figsize'] = [13, 4]
-                    fig, axs = plt.subplots(ncols=3)
-                    plt.tight_layout()
-                    before.plot.contourf(ax=axs[0], levels=20)
-                    da_el.plot.contourf(ax=axs[1], levels=20)
-                    (da_el - before).plot.contour(ax=axs[2], levels=2)
-                    output_path = os.path.join(ds_config.path,
-                                               "_interpd_data",
-                                               "display.{}.png".format(date_str))
-                    os.makedirs(os.path.dirname(output_path), exist_ok=True)
-                    logging.info("Saving interpolation figure for analysis: {}".format(output_path))
-                    fig.savefig(output_path)
-                    plt.close()
+            patterns.setdefault(np.packbits(~valid).tobytes(), list()).append(date_idx)
+
+    logging.info("Interpolating spatial data for {} dates with {} distinct missing data patterns".
+                 format(sum([len(el) for el in patterns.values()]), len(patterns)))
+
+    for pattern, date_idxs in patterns.items():
+        date_strs = [pd.to_datetime(date).strftime(ds_config.frequency.date_format)
+                     for date in da.time.values[date_idxs]]
+        logging.debug("Interpolating spatial data for {}".format(", ".join(date_strs)))
+
+        try:
+            invalid_idxs, neighbour_idxs, interpolation = interpolation_weights(pattern, shape)
+        except Exception as e:
+            logging.warning("Interpolation failed for {}, assignment will not take place: {}".
+                            format(", ".join(date_strs), e))
+            continue
+
+        if interpolation is None:
+            logging.warning("No valid values to interpolate with on {}".format(", ".join(date_strs)))
+            continue
+
+        flat_data = data[date_idxs].reshape(len(date_idxs), -1)
+        before = flat_data.copy()
+        flat_data[:, invalid_idxs] = (interpolation @ flat_data[:, neighbour_idxs].T).T
+        data[date_idxs] = flat_data.reshape(len(date_idxs), *shape)
+
+        if save_comparison_fig:
+            for date_str, date_before, date_after in zip(date_strs, before, flat_data):
+                before_el = da.isel(time=0).copy(data=date_before.reshape(shape))
+                da_el = da.isel(time=0).copy(data=date_after.reshape(shape))
+
+                plt.rcParams['figure.figsize'] = [13, 4]
+                fig, axs = plt.subplots(ncols=3)
+                plt.tight_layout()
+                before_el.plot.contourf(ax=axs[0], levels=20)
+                da_el.plot.contourf(ax=axs[1], levels=20)
+                (da_el - before_el).plot.contour(ax=axs[2], levels=2)
+                output_path = os.path.join(ds_config.path,
+                                           "_interpd_data",
+                                           "display.{}.png".format(date_str))
+                os.makedirs(os.path.dirname(output_path), exist_ok=True)
+                logging.info("Saving interpolation figure for analysis: {}".format(output_path))
+                fig.savefig(output_path)
+                plt.close()
+
+    da.data = data
     return da
 
 
+def spatial_interpolation_blocks(da: xr.DataArray,
+                                 ds_config: DatasetConfig,
+                                 mask_processor: object = None,
+                                 masks: list = None,
+                                 block_size: int = 100,
+                                 workers: int = 1,
+                                 memory_limit: int = None) -> object:
+    """
+    Stream spatially interpolated blocks of dates from a lazily loaded DataArray
+
+    Only `block_size` dates are loaded at once, each block being split across the
+    worker processes by contiguous dates and reassembled before it is yielded, so
+    the caller can write it back before the next is read and peak memory is bounded
+    by the block size rather than the length of the dataset. Interpolation weights
+    are cached within each worker, so blocks sharing missing data patterns across
+    a worker's dates reuse them.
+
+    Args:
+        da: DataArray to interpolate, ideally backed by dask
+        ds_config:
+        mask_processor:
+        masks:
+        block_size: the number of dates to load and interpolate at once
+        workers: the number of processes to interpolate each block across
+        memory_limit: bytes each worker process may allocate
+
+    Returns:
+        generator of interpolated DataArrays, in time order
+
+    """
+    if block_size < 1:
+        raise ValueError("Block size must be a positive number of dates, not {}".format(block_size))
+
+    num_dates = len(da.time)
+    executor = None
+
+    if workers > 1:
+        executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=init_worker_process,
+            initargs=(logging.getLogger().getEffectiveLevel(), memory_limit, 1))
+
+    try:
+        for block_start in range(0, num_dates, block_size):
+            block = da.isel(time=slice(block_start, block_start + block_size)).load()
+            logging.info("Interpolating block of {} dates from {}, {}/{} dates processed".
+                         format(len(block.time),
+                                pd.to_datetime(block.time.values[0]).strftime(ds_config.frequency.date_format),
+                                block_start, num_dates))
+
+            if executor is None or len(block.time) < 2:
+                yield spatial_interpolation(block, ds_config, mask_processor, masks)
+                continue
+
+            futures = [executor.submit(spatial_interpolation,
+                                       block.isel(time=date_idxs),
+                                       ds_config,
+                                       mask_processor,
+                                       masks)
+                       for date_idxs in np.array_split(np.arange(len(block.time)), workers)
+                       if len(date_idxs) > 0]
+            yield xr.concat([future.result() for future in futures], dim="time")
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+
 def assign_lat_lon_coord_system(cube: object):
     """Assign coordinate system to iris cube to allow regridding.
 
@@ -161,43 +301,56 @@ def assign_lat_lon_coord_system(cube: object):
     return cube
 
 
+def gridcell_angle_terms(angles: object) -> tuple:
+    """
+    The cosines and sines of a cube of gridcell angles, for use with rotate_grid_vectors
+
+    These need only be calculated once for a grid, however many vectors are rotated.
+
+    :param angles: Cube of gridcell angles, as from gridcell_angles_from_dim_coords
+    :return: tuple of cosine and sine arrays, shaped as the angles
+    """
+    angles = angles.copy()
+    angles.convert_units("radians")
+    return np.cos(angles.data), np.sin(angles.data)
+
+
 def rotate_grid_vectors(u_cube: object, v_cube: object, angles: object):
     """
     Author: Tony Phillips (BAS)
 
-    Wrapper for :func:`~iris.analysis.cartography.rotate_grid_vectors`
-    that can rotate multiple masked spatial fields in one go by iterating
-    over the horizontal spatial axes in slices
+    Rotate multiple masked spatial fields in one go, as
+    :func:`~iris.analysis.cartography.rotate_grid_vectors` does for single fields
+
+    The rotation is broadcast over the whole of each cube, rather than iterating over
+    the horizontal spatial slices, using the cosines and sines of the angles which can
+    be provided precomputed from gridcell_angle_terms. The angles must share the
+    ordering of the horizontal dimensions of the cubes.
 
     :param u_cube:
     :param v_cube:
-    :param angles:
+    :param angles: Cube of gridcell angles or tuple of their cosines and sines
     :return:
 
     """
-    # lists to hold slices of rotated vectors
-    u_r_all = iris.cube.CubeList()
-    v_r_all = iris.cube.CubeList()
-
-    # get the X and Y dimension coordinates for each source cube
-    u_xy_coords = [
-        u_cube.coord(axis='x', dim_coords=True),
-        u_cube.coord(axis='y', dim_coords=True)
-    ]
-    v_xy_coords = [
-        v_cube.coord(axis='x', dim_coords=True),
-        v_cube.coord(axis='y', dim_coords=True)
-    ]
-
-    # iterate over X, Y slices of the source cubes, rotating each in turn
-    for u, v in zip(u_cube.slices(u_xy_coords, ordered=False),
-                    v_cube.slices(v_xy_coords, ordered=False)):
-        u_r, v_r = iris.analysis.cartography.rotate_grid_vectors(u, v, angles)
-        u_r_all.append(u_r)
-        v_r_all.append(v_r)
-
-    # return the slices, merged back together into a pair of cubes
-    return u_r_all.merge_cube(), v_r_all.merge_cube()
+    cos_angles, sin_angles = gridcell_angle_terms(angles) if isinstance(angles, iris.cube.Cube) else angles
+
+    # broadcast the angle terms along every dimension of the cubes but X and Y
+    xy_dims = sorted([u_cube.coord_dims(u_cube.coord(axis=axis, dim_coords=True))[0] for axis in ['x', 'y']])
+    shape = [u_cube.shape[dim] if dim in xy_dims else 1 for dim in range(u_cube.ndim)]
+    cos_angles, sin_angles = cos_angles.reshape(shape), sin_angles.reshape(shape)
+
+    uu, vv = u_cube.data, v_cube.data
+    u_r = uu * cos_angles - vv * sin_angles
+    v_r = uu * sin_angles + vv * cos_angles
+
+    # mask at bad (NaN) angles along with anything masked in the source cubes
+    mask = np.broadcast_to(np.isnan(cos_angles), u_cube.shape) \
+        | np.ma.getmaskarray(uu) | np.ma.getmaskarray(vv)
+
+    u_out, v_out = (cube.copy(data=np.ma.masked_array(np.ma.getdata(data), mask=mask))
+                    for cube, data in ((u_cube, u_r), (v_cube, v_r)))
+    return u_out, v_out
 
 
 def gridcell_angles_from_dim_coords(cube: object):
@@ -271,6 +424,69 @@ def gridcell_angles_from_dim_coords(cube: object):
     return angles
 
 
+def _grid_dim_coords(cube: object) -> tuple:
+    """The X and Y dimension coordinates of a cube, with bounds guessed if necessary"""
+    coords = []
+
+    for axis in ['x', 'y']:
+        coord = cube.coord(axis=axis, dim_coords=True)
+
+        if not coord.has_bounds():
+            coord = coord.copy()
+            coord.guess_bounds()
+        coords.append(coord)
+    return tuple(coords)
+
+
+def cached_gridcell_angles(cube: object,
+                           cache_path: os.PathLike,
+                           invert: bool = False) -> object:
+    """
+    gridcell_angles_from_dim_coords, with the angles cached to disk for the grid
+
+    Angles are stored keyed by the coordinate system and the X and Y bounds of the grid,
+    so any run on any dataset sharing the grid reuses them. Cached angles are memory
+    mapped read-only, so concurrent jobs share one copy of them: inversion is therefore
+    applied before caching rather than in place by the caller.
+
+    The cube returned carries the X and Y dimension coordinates of the grid but, unlike
+    gridcell_angles_from_dim_coords, not the 2D longitudes and latitudes.
+
+    :param cube:
+    :param cache_path: Directory holding cached angles
+    :param invert: Return the angles as inverted by invert_gridcell_angles
+    :return:
+    """
+    x_coord, y_coord = _grid_dim_coords(cube)
+    x_first = cube.coord_dims(x_coord)[0] < cube.coord_dims(y_coord)[0]
+    names = ['gridcell_angle_from_true_east', 'true_east_from_gridcell_angle']
+
+    digest = hashlib.sha256(repr((cube.coord_system(), x_first, invert)).encode())
+    for coord in [x_coord, y_coord]:
+        digest.update(np.ascontiguousarray(coord.bounds, dtype=np.float64).tobytes())
+    angles_path = os.path.join(cache_path, "{}.npy".format(digest.hexdigest()[:16]))
+
+    if os.path.exists(angles_path):
+        logging.info("Loading cached gridcell angles from {}".format(angles_path))
+        angles = iris.cube.Cube(np.load(angles_path, mmap_mode="r"),
+                                long_name=names[int(invert)],
+                                units="degrees")
+        angles.add_dim_coord(x_coord, 0 if x_first else 1)
+        angles.add_dim_coord(y_coord, 1 if x_first else 0)
+        return angles
+
+    angles = gridcell_angles_from_dim_coords(cube)
+    if invert:
+        invert_gridcell_angles(angles)
+
+    os.makedirs(cache_path, exist_ok=True)
+    temp_path = os.path.join(cache_path, "{}.{}.tmp.npy".format(digest.hexdigest()[:16], os.getpid()))
+    np.save(temp_path, np.ma.filled(angles.data, np.nan))
+    os.replace(temp_path, angles_path)
+    logging.info("Cached gridcell angles to {}".format(angles_path))
+    return angles
+
+
 def invert_gridcell_angles(angles: object):
     """
     Author: Tony Phillips (BAS)
@@ -8,53 +8,227 @@ import xarray as xr
 
 from download_toolbox.dataset import DatasetConfig
 
+from preprocess_toolbox.utils import date_range_freq
+
+
+def detect_invalid_dates(da: xr.DataArray,
+                         threshold: float = 1.) -> pd.DatetimeIndex:
+    """Find the dates where at least `threshold` of the spatial field is NaN
+
+    The NaN fraction of every date is reduced chunk by chunk in a single pass over the
+    (dask) array, so only the fractions and never the variable itself are loaded.
+
+    Args:
+        da:
+        threshold: the fraction of NaN grid cells at which a date is considered invalid
+
+    Returns:
+        the invalid dates
+
+    """
+    nan_fraction = _nan_fraction(da).compute()
+    invalid_dates = nan_fraction.time.to_index()[nan_fraction.values >= threshold]
+
+    logging.info("Detected {} dates with at least {:.0%} of values missing".format(len(invalid_dates), threshold))
+    return invalid_dates
+
+
+def _nan_fraction(da: xr.DataArray) -> xr.DataArray:
+    """The fraction of the spatial field of each date that is NaN, lazily for dask arrays"""
+    return da.isnull().mean(dim=[dim for dim in da.dims if dim != "time"])
+
+
+# Key the invalid dates this package detects are recorded under in dataset configurations
+INVALID_DATES_KEY = "preprocess_invalid_dates"
+
+
+def _recorded_invalid_dates(ds_config: DatasetConfig) -> list:
+    """The invalid dates recorded against the dataset, or in its loaded configuration"""
+    recorded = getattr(ds_config, INVALID_DATES_KEY, None)
+
+    if recorded is None:
+        config = getattr(ds_config, "config", None)
+        recorded = config.data.get(INVALID_DATES_KEY) if config is not None else None
+    return list() if recorded is None else list(recorded)
+
+
+def get_invalid_dates(ds_config: DatasetConfig) -> pd.DatetimeIndex:
+    """The dates known to be invalid for a dataset
+
+    These are those the dataset implementation provides, plus those previously detected
+    and recorded in its configuration, which implementations don't read back themselves.
+
+    Args:
+        ds_config:
+
+    Returns:
+        the invalid dates
+
+    """
+    invalid_dates = list(getattr(ds_config, "invalid_dates", list())) + _recorded_invalid_dates(ds_config)
+    return pd.DatetimeIndex(pd.to_datetime(invalid_dates)).unique().sort_values()
+
+
+def set_invalid_dates(ds_config: DatasetConfig,
+                      invalid_dates: pd.DatetimeIndex) -> None:
+    """Record invalid dates against the dataset, to be written out with its configuration
+
+    The dates are kept under this package's own key, leaving those of the dataset
+    implementation alone.
+
+    Args:
+        ds_config:
+        invalid_dates:
+
+    """
+    setattr(ds_config, INVALID_DATES_KEY, [date.strftime("%Y-%m-%d")
+                                           for date in pd.DatetimeIndex(invalid_dates).unique().sort_values()])
+
+
+def load_invalid_dates(ds_config: DatasetConfig) -> None:
+    """Carry the invalid dates recorded in a loaded configuration over to the dataset
+
+    Dataset implementations drop the key when they're recreated from their configuration,
+    so without this the dates would be lost when the configuration is next saved.
+
+    Args:
+        ds_config:
+
+    """
+    recorded = _recorded_invalid_dates(ds_config)
+
+    if len(recorded) > 0:
+        set_invalid_dates(ds_config, pd.to_datetime(recorded))
+
 
 def process_missing_dates(ds: xr.Dataset,
                           ds_config: DatasetConfig,
-                          variable: str,
+                          variable: object,
                           end_date: dt.date = None,
-                          start_date: dt.date = None):
+                          start_date: dt.date = None,
+                          max_gap: int = None,
+                          nan_threshold: float = None):
     """
 
-    TODO: we need to be able to add more missing dates as detected spatially (full of nans)
-    TODO: we should be limiting interpolation or doing the above when over n steps
+    Missing dates are filled in a single pass: each is linearly interpolated from the
+    observations either side of it and the variables reindexed onto the full date range
+    once, rather than interpolating and concatenating date by date.
+
+    Dates are missing if they're absent, invalid for the dataset or entirely NaN for the
+    variable, which is how absent dates appear once a dataset's variables are opened
+    together. When
+    `nan_threshold` is given, mostly NaN dates are also missing, and are recorded as
+    invalid for the dataset, so are known to have been filled when its configuration is
+    next saved. The NaN fractions of all the variables are found in a single pass.
+
+    All the variables to fill should be given at once, so that they're reindexed onto
+    the full date range together.
 
     Args:
         ds:
         ds_config:
-        variable:
+        variable: the name of the variable, or list of names, to fill
         end_date:
         start_date:
+        max_gap: the longest run of missing dates to interpolate, longer gaps are left as NaN
+        nan_threshold: the fraction of NaN grid cells at which a date is considered missing
 
     Returns:
 
     """
-    da = getattr(ds, variable)
-    da = da.sortby('time')
-
-    dates_obs = [pd.to_datetime(date).date() for date in da.time.values]
-    dates_all = [pd.to_datetime(date).date() for date in
-                 pd.date_range(min(dates_obs) if not start_date else start_date,
-                               max(dates_obs) if not end_date else end_date,
-                               freq="1{}".format(ds_config.frequency.freq))]
-
-    invalid_dates = list() if not hasattr(ds_config, "invalid_dates") else ds_config.invalid_dates
-    drop_dates = [pd.Timestamp(el) for el in invalid_dates if pd.Timestamp(el) in da.time.values]
-    da = da.drop_sel(time=drop_dates)
-    missing_dates = [date for date in dates_all
-                     if date not in dates_obs or date in invalid_dates]
-
-    logging.info("Interpolating {} missing dates".format(len(missing_dates)))
-
-    for date in missing_dates:
-        if pd.Timestamp(date) not in da.time.values:
-            logging.info("Interpolating {}".format(date))
-            da = xr.concat([da,
-                            da.interp(time=pd.to_datetime(date))],
-                           dim='time')
+    var_names = [variable] if isinstance(variable, str) else list(variable)
+    ds = ds.sortby('time')
+
+    dates_obs = ds.time.to_index()
+    dates_all = pd.date_range(dates_obs.min() if not start_date else start_date,
+                              dates_obs.max() if not end_date else end_date,
+                              freq=date_range_freq(ds_config.frequency))
+    dates_full = dates_obs.union(dates_all)
+
+    invalid_dates = get_invalid_dates(ds_config)
+    nan_fractions = xr.Dataset({var_name: _nan_fraction(ds[var_name]) for var_name in var_names}).compute()
+
+    if nan_threshold is not None:
+        for var_name in var_names:
+            detected = dates_obs[nan_fractions[var_name].values >= nan_threshold]
+            logging.info("Detected {} dates with at least {:.0%} of {} missing".
+                         format(len(detected), nan_threshold, var_name))
+            invalid_dates = invalid_dates.union(detected)
+        set_invalid_dates(ds_config, invalid_dates)
+
+    valid_obs = dates_obs.difference(invalid_dates)
+    filled_vars = dict()
+
+    for var_name in var_names:
+        var_obs = valid_obs.difference(dates_obs[nan_fractions[var_name].values >= 1.])
+        missing_dates = dates_all.difference(var_obs)
+        da = ds[var_name].sel(time=var_obs)
+        logging.info("Interpolating {} missing dates for {}".format(len(missing_dates), var_name))
+
+        if len(var_obs) < 1:
+            logging.warning("{} has no dates with data, so its missing dates can't be interpolated".format(var_name))
+        elif len(missing_dates) > 0:
+            if da.chunks is not None:
+                # Reindexing along single date chunks, as datasets are opened with, is very slow
+                da = da.chunk(dict(time="auto"))
+
+            filled = _interpolate_missing_dates(da, missing_dates, dates_full, max_gap)
+            da = da.reindex(time=dates_full).combine_first(filled)
+        filled_vars[var_name] = da
 
     logging.debug("Finished interpolation")
 
-    da = da.sortby('time')
-    ds[variable] = da
+    # Assigning alone would align the variables to the existing dates, dropping those filled
+    ds = ds.reindex(time=dates_full)
+    for var_name, da in filled_vars.items():
+        ds[var_name] = da
     return ds
+
+
+def _interpolate_missing_dates(da: xr.DataArray,
+                               missing_dates: pd.DatetimeIndex,
+                               dates_full: pd.DatetimeIndex,
+                               max_gap: int = None) -> xr.DataArray:
+    """Linearly interpolate all `missing_dates` at once from the observations bounding them
+
+    Dates outside the observed range, or in a gap of more than `max_gap` consecutive
+    missing dates, can't be interpolated and are NaN.
+
+    Args:
+        da: the observations, sorted by time
+        missing_dates:
+        dates_full: the observed and missing dates together, sorted
+        max_gap:
+
+    Returns:
+        DataArray of interpolated values for the missing dates
+
+    """
+    dates_obs = da.time.to_index()
+    next_idxs = dates_obs.searchsorted(missing_dates)
+    prev_idxs = next_idxs - 1
+    bounded = (prev_idxs >= 0) & (next_idxs < len(dates_obs))
+
+    prev_idxs = np.clip(prev_idxs, 0, len(dates_obs) - 1)
+    next_idxs = np.clip(next_idxs, 0, len(dates_obs) - 1)
+    prev_dates, next_dates = dates_obs[prev_idxs], dates_obs[next_idxs]
+
+    if max_gap is not None:
+        gaps = dates_full.get_indexer(next_dates) - dates_full.get_indexer(prev_dates) - 1
+        over_gap = bounded & (gaps > max_gap)
+
+        if over_gap.any():
+            logging.warning("Not interpolating {} dates in gaps of more than {} missing dates, from {} to {}".
+                            format(over_gap.sum(), max_gap, missing_dates[over_gap].min(), missing_dates[over_gap].max()))
+        bounded &= ~over_gap
+
+    span = (next_dates - prev_dates).values.astype(np.float64)
+    weights = np.divide((missing_dates - prev_dates).values.astype(np.float64), span,
+                        out=np.zeros(len(missing_dates)), where=span > 0)
+    weights = xr.DataArray(np.where(bounded, weights, np.nan),
+                           dims="time",
+                           coords=dict(time=missing_dates))
+
+    prev_da = da.isel(time=prev_idxs).assign_coords(time=missing_dates)
+    next_da = da.isel(time=next_idxs).assign_coords(time=missing_dates)
+    return (prev_da * (1 - weights) + next_da * weights).astype(da.dtype)
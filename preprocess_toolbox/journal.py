@@ -0,0 +1,143 @@
+import hashlib
+import logging
+import os
+import uuid
+
+import orjson
+
+from preprocess_toolbox.utils import file_digest
+
+
+class ProcessingJournal:
+    """An append-only record of the files an in place operation has completed
+
+    Results are written to temporary files and committed with `commit`, which records
+    the intended replacements, renames the temporaries over their destinations and then
+    records completion along with the content hash of each file. A run that is
+    interrupted part way through a commit is finished by `recover` on the next, so files
+    are never processed twice, and `is_complete` lets the rerun skip everything already
+    done. Files changed since they were recorded, such as by a fresh download, are
+    no longer complete.
+
+    Entries are flushed to disk as they're made and a partially written final entry is
+    ignored, so the journal survives being interrupted at any point.
+
+    Journals are keyed by the parameters of the operation, so a change of them, such as
+    a different reference grid, starts afresh.
+
+    :param path: The directory to hold journals.
+    :param operation: The name of the operation being journalled.
+    :param parameters: The inputs that determine the operation's results.
+    """
+
+    def __init__(self,
+                 path: os.PathLike,
+                 operation: str,
+                 parameters: dict):
+        key = hashlib.sha256(orjson.dumps(parameters, option=orjson.OPT_SORT_KEYS)).hexdigest()[:16]
+
+        os.makedirs(path, exist_ok=True)
+        self._completed = dict()
+        self._journal_path = os.path.join(path, "{}.{}.jsonl".format(operation, key))
+        self._parameters = parameters
+        self._prepared = dict()
+
+        if os.path.exists(self._journal_path):
+            self._load()
+            logging.info("Loaded journal of {} completed files from {}".
+                         format(len(self._completed), self._journal_path))
+        else:
+            self._append(dict(event="started", parameters=parameters))
+
+    def _append(self, entry: dict) -> None:
+        with open(self._journal_path, "ab") as fh:
+            fh.write(orjson.dumps(entry) + b"\n")
+            fh.flush()
+            os.fsync(fh.fileno())
+
+    def _load(self) -> None:
+        with open(self._journal_path, "rb") as fh:
+            lines = fh.readlines()
+
+        # Terminate an entry cut short by an interruption, so it doesn't run into the next
+        if len(lines) > 0 and not lines[-1].endswith(b"\n"):
+            with open(self._journal_path, "ab") as fh:
+                fh.write(b"\n")
+
+        for line in lines:
+            try:
+                entry = orjson.loads(line)
+            except orjson.JSONDecodeError:
+                logging.warning("Ignoring incomplete journal entry in {}".format(self._journal_path))
+                continue
+
+            if entry["event"] == "prepared":
+                self._prepared[entry["commit"]] = entry["files"]
+            elif entry["event"] == "done":
+                self._prepared.pop(entry["commit"], None)
+                self._completed.update(entry["files"])
+
+    @staticmethod
+    def _record(file_path: os.PathLike) -> dict:
+        stat = os.stat(file_path)
+        return dict(mtime_ns=stat.st_mtime_ns,
+                    sha256=file_digest(file_path),
+                    size=stat.st_size)
+
+    def commit(self, replacements: dict) -> None:
+        """Replace destination files with their processed temporaries and record them as complete
+
+        :param replacements: dict of temporary file paths by destination
+        """
+        commit = uuid.uuid4().hex
+        files = {destination: dict(temporary=temporary, sha256=file_digest(temporary))
+                 for destination, temporary in replacements.items()}
+        self._append(dict(event="prepared", commit=commit, files=files))
+
+        for destination, temporary in replacements.items():
+            os.replace(temporary, destination)
+        self._complete(commit, list(replacements.keys()))
+
+    def _complete(self, commit: str, destinations: list) -> None:
+        files = {destination: self._record(destination) for destination in destinations}
+        self._append(dict(event="done", commit=commit, files=files))
+        self._completed.update(files)
+
+    def is_complete(self, file_path: os.PathLike) -> bool:
+        """Whether `file_path` has been processed and is unchanged since
+
+        The size and modification time are checked before resorting to the content hash.
+
+        :param file_path:
+        :return:
+        """
+        record = self._completed.get(file_path)
+
+        if record is None or not os.path.exists(file_path):
+            return False
+
+        stat = os.stat(file_path)
+        if stat.st_size != record["size"]:
+            return False
+        elif stat.st_mtime_ns == record["mtime_ns"]:
+            return True
+        return file_digest(file_path) == record["sha256"]
+
+    def recover(self) -> None:
+        """Finish any commits that were interrupted before they were recorded as complete"""
+        for commit, files in list(self._prepared.items()):
+            recoverable = True
+
+            for destination, details in files.items():
+                if os.path.exists(details["temporary"]) \
+                        and file_digest(details["temporary"]) == details["sha256"]:
+                    logging.info("Recovering interrupted replacement of {}".format(destination))
+                    os.replace(details["temporary"], destination)
+                elif not os.path.exists(destination) or file_digest(destination) != details["sha256"]:
+                    logging.warning("Unable to recover interrupted replacement of {}, it will be reprocessed".
+                                    format(destination))
+                    recoverable = False
+
+            if recoverable:
+                self._complete(commit, list(files.keys()))
+            self._prepared.pop(commit)
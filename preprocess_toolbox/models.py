@@ -42,3 +42,53 @@ def linear_trend_forecast(
     output_map[output_map > 1] = 1.
 
     return output_map
+
+
+def linear_trend_forecasts(
+    history: object,
+    counts: object,
+    mask: object = None,
+) -> object:
+    """Batched, closed-form equivalent of linear_trend_forecast
+
+    Each forecast fits the first n samples of history against x = 0..n-1 and projects
+    the fit to x = n, exactly as linear_trend_forecast does via lstsq. Running sums of
+    y and xy are accumulated once, so every count is solved in one operation across
+    all grid cells rather than one lstsq per forecast date.
+
+    :param history: array of samples ordered by time, with time as the leading dimension
+    :param counts: the number of leading history samples usable for each forecast
+    :param mask:
+    :return: array of shape (len(counts), *history.shape[1:])
+    """
+    counts = np.asarray(counts, dtype=int)
+    shape = history.shape[1:]
+
+    y = np.asarray(history, dtype=np.float64).reshape(len(history), -1)
+    x = np.arange(len(y), dtype=np.float64)
+
+    # Prepending zeros means index n of the cumulative sums covers the first n samples
+    zeros = np.zeros((1, y.shape[1]))
+    sum_y = np.concatenate([zeros, np.cumsum(y, axis=0)])[counts]
+    sum_xy = np.concatenate([zeros, np.cumsum(x[:, np.newaxis] * y, axis=0)])[counts]
+
+    n = counts.astype(np.float64)[:, np.newaxis]
+    sum_x = n * (n - 1) / 2
+    sum_xx = (n - 1) * n * (2 * n - 1) / 6
+    denominator = n * sum_xx - sum_x ** 2
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        # A single sample is rank deficient, where lstsq gives the minimum norm
+        # solution of a flat line through that sample; no samples gives NaN
+        slope = np.where(denominator > 0,
+                         (n * sum_xy - sum_x * sum_y) / denominator,
+                         0.)
+        intercept = (sum_y - slope * sum_x) / n
+        output_maps = (slope * n + intercept).reshape(len(counts), *shape)
+
+        if mask is not None:
+            output_maps[:, mask] = 0.
+        output_maps[output_maps < 0] = 0.
+        output_maps[output_maps > 1] = 1.
+
+    return output_maps
@@ -1,4 +1,6 @@
+import concurrent.futures
 import logging
+import multiprocessing
 import os
 
 from dateutil.relativedelta import relativedelta
@@ -7,12 +9,21 @@ from pprint import pformat
 import dask
 import dask.array
 import numpy as np
+import orjson
 import pandas as pd
 import xarray as xr
 
 from preprocess_toolbox.base import Processor, ProcessingError
-from preprocess_toolbox.models import linear_trend_forecast
-from preprocess_toolbox.utils import get_extension_dates
+from preprocess_toolbox.cache import ClimatologyCache, DatasetHandleCache, FileIndex, TrendCache
+from preprocess_toolbox.climatology import climatology_group, compute_climatology, subtract_climatology
+from preprocess_toolbox.models import linear_trend_forecasts
+from preprocess_toolbox.profiling import get_tracer, span
+from preprocess_toolbox.statistics import SufficientStatistics
+from preprocess_toolbox.utils import (date_range_freq,
+                                     file_fingerprints,
+                                     get_extension_dates,
+                                     init_worker_process,
+                                     parameters_key)
 
 from download_toolbox.interface import DatasetConfig, Frequency
 
@@ -32,16 +43,19 @@ class NormalisingChannelProcessor(Processor):
                  *args,
                  anom_clim_splits: list = None,
                  clim_frequency: Frequency = Frequency.MONTH,
+                 incremental: bool = False,
                  init_source: bool = True,
                  lag_time: int = 1,
                  lead_time: int = 3,
                  linear_trends: list = None,
                  linear_trend_steps: int = 7,
+                 memory_limit: int = None,
                  minmax: bool = True,
                  no_normalise: tuple = None,
                  normalisation_splits: list = None,
                  parallel_opens: bool = True,
                  ref_procdir: os.PathLike = None,
+                 workers: int = 1,
                  **kwargs):
         """
 
@@ -51,35 +65,40 @@ class NormalisingChannelProcessor(Processor):
             splits:
             *args:
             anom_clim_splits:
-            clim_frequency:
+            clim_frequency: frequency of climatologies for anomalies, either monthly or by day of the year
+            incremental: append the dates after the end of existing outputs to them, rather than skipping them
             lag_time:
             lead_time:
             linear_trends:
             linear_trend_steps:
+            memory_limit: bytes of memory each worker may use, when processing with more than one worker
             minmax:
             no_normalise:
             normalisation_splits:
             parallel_opens:
             ref_procdir:
+            workers: number of processes to run channels across
             **kwargs:
         """
         super().__init__(dataset_config, *args, **kwargs)
 
-        if clim_frequency != Frequency.MONTH:
-            raise NotImplementedError("We only generate climatologies at a monthly resolution, "
-                                      "this needs implementation")
+        # Fail early on a climatology we can't generate
+        climatology_group(clim_frequency)
 
         self._anom_clim_splits = [] if anom_clim_splits is None else anom_clim_splits
         self._anom_vars = anomoly_vars if anomoly_vars else []
+        self._clim_frequency = clim_frequency
         self._dataset_config = dataset_config.config_file
         # This is important to inherit from the dataset and carry forward, it has a lot of downstream impact
         # TODO: time and spatial information validation - if the source changes what do we do!?
         self._frequency = dataset_config.frequency
+        self._incremental = incremental
         self._lag_time = lag_time
         self._lead_time = lead_time
         self._linear_trends = linear_trends
         # TODO: spatial information has been overlooked so far, but needs to carry forward and validate
         self._location = dataset_config.location
+        self._memory_limit = memory_limit
 
         if type(linear_trend_steps) is int:
             logging.debug(
@@ -97,10 +116,17 @@ class NormalisingChannelProcessor(Processor):
         self._refdir = ref_procdir
         # TODO: splits -> { dates, sources }, but currently sources are separate...
         self._splits = splits
+        self._source_file_ends = dict()
+        self._source_file_starts = dict()
+        # The last date of the existing output of each channel, when appending to it
+        self._append_afters = dict()
         self._source_files = dict()
+        self._source_handles = DatasetHandleCache()
+        self._workers = workers
 
         if init_source:
-            self._init_source_data(dataset_config)
+            with span("file_discovery"):
+                self._init_source_data(dataset_config)
 
     def _build_linear_trend_da(self,
                                input_da: object,
@@ -122,7 +148,6 @@ class NormalisingChannelProcessor(Processor):
             ref_da = input_da
         data_dates = sorted([pd.Timestamp(date) for date in input_da.time.values])
 
-        trend_dates = set()
         trend_steps = max(self._linear_trend_steps)
 
         extract_date_map = dict(
@@ -137,79 +162,124 @@ class NormalisingChannelProcessor(Processor):
         trend_range = pd.date_range(pd.to_datetime(extract_date_map[self._frequency.attribute](data_dates[0])),
                                     pd.to_datetime(extract_date_map[self._frequency.attribute](data_dates[-1])) +
                                     relativedelta(**{"{}s".format(self._frequency.attribute): trend_steps + 1}),
-                                    freq=self._frequency.freq)
+                                    freq=date_range_freq(self._frequency))
 
         logging.info("Generating trend data up to {} steps ahead for {} dates".
                      format(trend_steps, len(data_dates)))
 
-        for dat_date in data_dates:
-            base_idx = list(trend_range).index(dat_date)
-            trend_dates = trend_dates.union([
-                trend_range[base_idx + idx]
-                for idx in self._linear_trend_steps
-            ])
+        base_idxs = trend_range.get_indexer(data_dates)
+        if (base_idxs < 0).any():
+            raise ProcessingError("Data dates are not aligned to the {} trend range".
+                                  format(self._frequency.attribute))
 
-        trend_dates = list(sorted(trend_dates))
+        trend_idxs = base_idxs[:, np.newaxis] + np.array(self._linear_trend_steps)
+        trend_dates = list(sorted(set(trend_range[trend_idxs.ravel()])))
         logging.info("Generating {} trend dates".format(len(trend_dates)))
 
         linear_trend_da = \
             xr.broadcast(input_da, xr.DataArray(trend_range, dims="time"))[0]
         linear_trend_da = linear_trend_da.sel(time=trend_dates)
-        linear_trend_da.data = dask.array.zeros(linear_trend_da.shape)
 
         # TODO: what are we applying this for here?
         # land_mask = Masks(north=self.north, south=self.south).get_land_mask()
 
-        # Could use shelve, but more likely we'll run into concurrency issues
-        # pickleshare might be an option but a little over-engineery
-        trend_cache_path = os.path.join(self.path,
-                                        "{}_linear_trend.nc".format(var_name))
-        trend_cache = linear_trend_da.copy()
-        trend_cache.data = dask.array.full_like(linear_trend_da.data, np.nan)
-
-        if os.path.exists(trend_cache_path):
-            trend_cache = xr.open_dataarray(trend_cache_path)
-            logging.info("Loaded {} entries from {}".format(
-                len(trend_cache.time), trend_cache_path))
-
-        def data_selector(da, processing_date, missing_dates=tuple()):
-            target_date = pd.to_datetime(processing_date)
-
-            # TODO: We're assuming the linear trend as a day-res year long application
-            # TODO: I've hacked a leap year in for the mo, but this should be using loc, a simplified clause and isel
-            #  such as by starting with date_da = da.loc[target_date:]
-            date_da = da[(da.time['time.month'] == target_date.month) &
-                         ((da.time['time.day'] == target_date.day) |
-                          (da.time["time.day"] == target_date.day - 1)) &
-                         (da.time <= target_date) &
-                         ~da.time.isin(missing_dates)].\
-                isel(time=slice(0, max_years))
-            return date_da
-
-        for forecast_date in sorted(trend_dates, reverse=True):
-            if not trend_cache.sel(time=forecast_date).isnull().all():
-                output_map = trend_cache.sel(time=forecast_date)
-            else:
-                output_map = linear_trend_forecast(
-                    data_selector,
-                    forecast_date,
-                    ref_da,
-                    None,  # masks
-                    missing_dates=[], # TODO: self._missing_dates,
-                    shape=ref_da.isel(time=0).shape, # shape
-                )
-
-            linear_trend_da.loc[dict(time=forecast_date)] = output_map
-
-        logging.info("Writing new trend cache for {}".format(var_name))
-        trend_cache.close()
+        # Only dates with their full history in the source are cached, trends beyond
+        # the end of the source data are recalculated on each run
+        source_end = ref_da.indexes["time"].max()
+        sources = [os.path.join(self._refdir, self._storage.filename("{}_abs.nc".format(var_name)))] \
+            if self._refdir is not None else self._split_source_files(list(self._splits.keys()), var_name)
+        file_starts = self._source_file_starts.get(var_name, dict())
+        source_starts = {os.path.abspath(source): file_starts[source] for source in sources if source in file_starts}
+        trend_cache = TrendCache(self.get_data_var_folder("cache"), var_name, dict(
+            dtype=np.dtype(self.dtype).name,
+            max_years=max_years,
+            reference=self._refdir,
+            source_start=ref_da.indexes["time"].min().isoformat(),
+            steps=self._linear_trend_steps,
+        ), sources=file_fingerprints(sources), source_starts=source_starts)
+
+        trend_dates = pd.DatetimeIndex(trend_dates)
+        cached_dates = trend_dates.intersection(trend_cache.dates)
+        forecast_dates = trend_dates.difference(cached_dates)
+        trend_data = np.empty(linear_trend_da.shape)
+
+        if len(cached_dates) > 0:
+            logging.info("Reusing {} cached trend dates".format(len(cached_dates)))
+            trend_data[trend_dates.get_indexer(cached_dates)] = trend_cache.get(cached_dates).values
+
+        trend_data[trend_dates.get_indexer(forecast_dates)] = \
+            self._linear_trend_maps(ref_da,
+                                    forecast_dates,
+                                    max_years=max_years,
+                                    missing_dates=[])  # TODO: self._missing_dates
+        linear_trend_da.data = trend_data
+
+        trend_cache.append(linear_trend_da.sel(time=forecast_dates[forecast_dates <= source_end]))
+
         linear_trend_da = linear_trend_da.rename("{}_linear_trend".format(var_name))
         self.save_processed_file("{}_linear_trend".format(var_name),
                                  "{}_linear_trend.nc".format(var_name),
-                                 linear_trend_da)
+                                 linear_trend_da,
+                                 overwrite=True)
 
         return linear_trend_da
 
+    def _linear_trend_maps(self,
+                           da: object,
+                           forecast_dates: list,
+                           max_years: int = 35,
+                           missing_dates: object = ()) -> object:
+        """
+        Produce linear trend forecasts for all `forecast_dates` from `da`.
+
+        Each forecast uses the same and preceding day of the forecast month, in years up to
+        the forecast date, taking the earliest `max_years` of these. Dates sharing a day
+        of year share that history, so the forecast dates are grouped by day of year and
+        each group is read once and solved in closed form by `linear_trend_forecasts`.
+
+        TODO: We're assuming the linear trend as a day-res year long application
+
+        :param da:
+        :param forecast_dates:
+        :param max_years:
+        :param missing_dates:
+        :return: array of forecast maps, ordered as `forecast_dates`
+        """
+        trend_maps = np.full((len(forecast_dates), *da.shape[1:]), np.nan)
+
+        if len(forecast_dates) < 1:
+            return trend_maps
+
+        if not da.indexes["time"].is_monotonic_increasing:
+            da = da.sortby("time")
+        times = da.indexes["time"]
+        usable = ~times.isin(pd.to_datetime(list(missing_dates)))
+
+        forecast_dates = pd.DatetimeIndex(forecast_dates)
+        date_groups = pd.Series(np.arange(len(forecast_dates))).\
+            groupby([forecast_dates.month, forecast_dates.day]).indices
+
+        logging.debug("Solving {} trend dates in {} day of year groups".
+                      format(len(forecast_dates), len(date_groups)))
+
+        for (month, day), group_idxs in date_groups.items():
+            history_idxs = np.flatnonzero(usable &
+                                          (times.month == month) &
+                                          ((times.day == day) | (times.day == day - 1)))
+            counts = np.minimum(
+                times[history_idxs].searchsorted(forecast_dates[group_idxs], side="right"),
+                max_years)
+
+            if counts.max() < 1:
+                continue
+
+            history = da.isel(time=history_idxs[:counts.max()]).data
+            if hasattr(history, "compute"):
+                history = history.compute()
+
+            trend_maps[group_idxs] = linear_trend_forecasts(history, counts)
+        return trend_maps
+
     def _init_source_data(self,
                           ds_config: DatasetConfig) -> None:
         """
@@ -217,6 +287,7 @@ class NormalisingChannelProcessor(Processor):
         :return:
         """
 
+        file_index = FileIndex(ds_config, os.path.join(self.base_path, "_file_index"))
         split_dates_required = dict()
         drop_dates = dict()
 
@@ -234,198 +305,395 @@ class NormalisingChannelProcessor(Processor):
             # Calculating lead and lag dates that aren't already accounted for in splits
             if self._lag_time > 0:
                 logging.info("Including lag of {} {}s".format(self._lag_time, ds_config.frequency.attribute))
-                additional_lag_dates, dropped_lag_dates = get_extension_dates(ds_config, dates, self._lag_time, reverse=True)
+                additional_lag_dates, dropped_lag_dates = \
+                    get_extension_dates(ds_config, dates, self._lag_time, reverse=True, file_index=file_index)
                 dates += additional_lag_dates
                 drop_dates[split] += dropped_lag_dates
 
             if self._lead_time > 0:
                 logging.info("Including lead of {} {}s".format(self._lead_time, ds_config.frequency.attribute))
-                additional_lead_dates, dropped_lead_dates = get_extension_dates(ds_config, dates, self._lead_time)
+                additional_lead_dates, dropped_lead_dates = \
+                    get_extension_dates(ds_config, dates, self._lead_time, file_index=file_index)
                 dates += additional_lead_dates
                 drop_dates[split] += dropped_lead_dates
 
-            split_dates_required[split] = sorted([_ for _ in dates if _ not in drop_dates[split]])
+            split_dates_required[split] = sorted(set(dates).difference(drop_dates[split]))
+
+            unavailable = (~file_index.has_dates(split_dates_required[split])).sum() \
+                if len(split_dates_required[split]) > 0 else 0
+            if unavailable > 0:
+                logging.warning("{} of {} dates for {} have no source data".
+                                format(unavailable, len(split_dates_required[split]), split))
 
         for split in self._splits.keys():
-            self._source_files[split] = {var_config.name: ds_config.var_filepaths(var_config, split_dates_required[split])
+            self._source_files[split] = {var_config.name: file_index.files(var_config.name,
+                                                                           split_dates_required[split])
                                          for var_config in ds_config.variables}
 
             for var_name, var_files in self._source_files[split].items():
                 logging.info("Got {} files for {}:{}".format(len(var_files), split, var_name))
         logging.debug(pformat(self._source_files))
 
-    def _normalise_array_mean(self, var_name: str, da: object):
+        # The first and last date of each file, for opening only those with dates to append
+        # and telling which cached trends read a file
+        for var_config in ds_config.variables:
+            date_files = file_index.date_files(var_config.name)
+            file_dates = pd.Series(date_files.index, index=date_files.values).groupby(level=0)
+            self._source_file_ends[var_config.name] = file_dates.max().to_dict()
+            self._source_file_starts[var_config.name] = file_dates.min().to_dict()
+
+    def _get_source_da(self,
+                       var_name: str,
+                       after: object = None) -> object:
         """
-        Using the *training* data only, compute the mean and
-        standard deviation of the input raw satellite DataArray (`da`)
-        and return a normalised version. If minmax=True,
-        instead normalise to lie between min and max of the elements of `array`.
+        Open the source data for `var_name`, with the opened dataset being
+        shared between the channels of a variable via the source handle cache.
 
-        If min, max, mean, or std are given values other than None,
-        those values are used rather than being computed from the training
-        months.
+        :param var_name:
+        :param after: only open the files with dates after this, such as the last already processed
+        :return: DataArray cast to the processor dtype, or None without source files
+        """
+        source_files = list(sorted(set([file
+                                        for split, var_files in self.source_files.items()
+                                        for vn, files in var_files.items()
+                                        for file in files
+                                        if var_name == vn])))
+
+        if after is not None:
+            file_ends = self._source_file_ends.get(var_name, dict())
+            source_files = [file for file in source_files if file not in file_ends or file_ends[file] > after]
+            logging.info("Opening the {} {} files with dates after {}".format(len(source_files), var_name, after))
+
+        if len(source_files) < 1:
+            return None
+
+        ds = self._source_handles.get(var_name, source_files, self._open_source_files)
+        return getattr(ds, var_name).astype(self.dtype)
+
+    def _normalisation_parameters(self,
+                                  var_name: str,
+                                  da: object,
+                                  method: str,
+                                  var_suffix: str = "abs") -> tuple:
+        """
+        Retrieve the normalisation parameters for `method`, being either "mean"
+        for the mean and standard deviation or "scale" for the minimum and maximum.
+
+        Parameter files are keyed by their inputs: the normalisation split dates, the
+        source files covering them along with their modification times and sizes, the
+        dtype, the method and the channel. Parameters whose key is unchanged are reused as is, otherwise
+        they're derived from the sufficient statistics persisted in normalisation.stats,
+        which only need the dates that are new to the normalisation splits merging in.
+        Without normalisation split dates, or from a reference directory, parameter
+        files are reused as is.
+
+        Each channel of a variable is normalised separately, as anomalies and absolute
+        values have little in common. Parameters of absolute values stay in the files named
+        for the variable, as they always have been, whilst other channels have their own
+        files named for the channel.
 
         :param var_name:
         :param da:
-        :return:
+        :param method:
+        :param var_suffix: the channel being normalised, such as abs or anom
+        :return: tuple of both parameters
         """
+        channel_name = var_name if var_suffix == "abs" else "{}_{}".format(var_name, var_suffix)
 
         if self._refdir is not None:
             logging.info("Using alternate processing directory {} for "
-                         "mean".format(self._refdir))
-            proc_dir = os.path.join(self._refdir, "normalisation.mean")
-        else:
-            proc_dir = self.get_data_var_folder("normalisation.mean")
-
-        mean_path = os.path.join(proc_dir, "{}".format(var_name))
+                         "{}".format(self._refdir, method))
+            param_path = os.path.join(self._refdir, "normalisation.{}".format(method), channel_name)
 
-        if os.path.exists(mean_path):
-            logging.debug(
-                "Loading norm-average mean-std from {}".format(mean_path))
-            mean, std = tuple([
-                self.dtype(el)
-                for el in open(mean_path, "r").read().split(",")
-            ])
-        elif len(self.norm_split_dates) > 0:
-            logging.debug("Generating norm-average mean-std from {} training "
-                          "dates".format(len(self.norm_split_dates)))
-            norm_samples = da.sel(time=self.norm_split_dates).data
-            norm_samples = norm_samples.ravel()
-
-            mean, std = Processor.mean_and_std(norm_samples)
+            if not os.path.exists(param_path):
+                # Reference directories from before channels other than absolute values had their own
+                param_path = os.path.join(self._refdir, "normalisation.{}".format(method), var_name)
+            stats_path = None
+        else:
+            param_path = os.path.join(self.get_data_var_folder("normalisation.{}".format(method)), channel_name)
+            stats_path = os.path.join(self.get_data_var_folder("normalisation.stats"), channel_name)
+
+        key_path = "{}.key".format(param_path)
+        sources = file_fingerprints(self._split_source_files(self._normalisation_splits, var_name))
+        key = parameters_key(dict(
+            dates=[pd.Timestamp(date).isoformat() for date in sorted(set(self.norm_split_dates))],
+            dtype=np.dtype(self.dtype).name,
+            method=method,
+            sources=sources,
+            var_name=var_name,
+            var_suffix=var_suffix,
+        ))
+
+        if stats_path is not None and len(self.norm_split_dates) > 0:
+            if os.path.exists(param_path) and os.path.exists(key_path) and open(key_path, "r").read() == key:
+                logging.debug("Reusing norm-{} parameters from {}, their inputs are unchanged".
+                              format(method, param_path))
+                params = open(param_path, "r").read().split(",")
+            else:
+                stats = self._update_normalisation_statistics(stats_path, da, sources,
+                                                              after=self._append_afters.get(
+                                                                  "{}_{}".format(var_name, var_suffix)))
+                params = (stats.mean, stats.std) if method == "mean" else (stats.minimum, stats.maximum)
+        elif os.path.exists(param_path):
+            logging.debug("Loading norm-{} parameters from {}".format(method, param_path))
+            params = open(param_path, "r").read().split(",")
         else:
             raise RuntimeError("Either a normalisation file or normalisation split dates "
                                "must be supplied")
 
-        new_da = (da - mean) / std
+        params = tuple([self.dtype(el) for el in params])
 
         if self._refdir is None:
-            open(mean_path, "w").write(",".join([str(f) for f in [float(mean), float(std)]]))
-        return new_da
+            open(param_path, "w").write(",".join([str(float(f)) for f in params]))
+
+            if len(self.norm_split_dates) > 0:
+                open(key_path, "w").write(key)
+        return params
 
-    def _normalise_array_scaling(self, var_name: str, da: object):
+    def _open_source_files(self,
+                           var_name: str,
+                           source_files: list) -> object:
+        """
+
+        :param var_name:
+        :param source_files:
+        :return:
+        """
+        logging.info("Opening {} files for {}".format(len(source_files), var_name))
+
+        # In the old IceNet library there was dubiousness about the source of the
+        # data so this was harder. Now we work with whatever we get from download-toolbox
+        with span("open_mfdataset", var=var_name, files=len(source_files)):
+            return xr.open_mfdataset(
+                source_files,
+                # Solves issue with inheriting files without
+                # time dimension (only having coordinate)
+                combine="nested",
+                concat_dim="time",
+                coords="minimal",
+                compat="override",
+                # TODO: review this, but if lat-lon is in the file, it's signalling bigger issues
+                # drop_variables=("lat", "lon"),
+                parallel=self._parallel)
+
+    def _normalise_array_mean(self, var_name: str, da: object, var_suffix: str = "abs"):
         """
+        Using the *training* data only, compute the mean and
+        standard deviation of the input raw satellite DataArray (`da`)
+        and return a normalised version.
 
         :param var_name:
         :param da:
+        :param var_suffix:
         :return:
         """
-        if self._refdir is not None:
-            logging.info("Using alternate processing directory {} for "
-                         "scaling".format(self._refdir))
-            proc_dir = os.path.join(self._refdir, "normalisation.scale")
-        else:
-            proc_dir = self.get_data_var_folder("normalisation.scale")
+        mean, std = self._normalisation_parameters(var_name, da, "mean", var_suffix)
+        logging.info("Mean: {:.3f}, std: {:.3f}".format(mean, std))
 
-        scale_path = os.path.join(proc_dir, "{}".format(var_name))
+        return (da - mean) / std
 
-        if os.path.exists(scale_path):
-            logging.debug(
-                "Loading norm-scaling min-max from {}".format(scale_path))
-            minimum, maximum = tuple([
-                self.dtype(el)
-                for el in open(scale_path, "r").read().split(",")
-            ])
-        elif self.norm_split_dates:
-            logging.debug("Generating norm-scaling min-max from {} training "
-                          "dates".format(len(self.norm_split_dates)))
-
-            norm_samples = da.sel(time=self.norm_split_dates).data
-            norm_samples = norm_samples.ravel()
-
-            minimum = dask.array.nanmin(norm_samples).astype(self.dtype)
-            maximum = dask.array.nanmax(norm_samples).astype(self.dtype)
+    def _normalise_array_scaling(self, var_name: str, da: object, var_suffix: str = "abs"):
+        """
+        Using the *training* data only, compute the minimum and maximum of
+        the input DataArray (`da`) and return a version scaled to lie between them.
+
+        :param var_name:
+        :param da:
+        :param var_suffix:
+        :return:
+        """
+        minimum, maximum = self._normalisation_parameters(var_name, da, "scale", var_suffix)
+        logging.info("Minimum: {:.3f}, maximum: {:.3f}".format(minimum, maximum))
+
+        return (da - minimum) / (maximum - minimum)
+
+    def _update_normalisation_statistics(self,
+                                         stats_path: os.PathLike,
+                                         da: object,
+                                         sources: dict,
+                                         after: object = None) -> SufficientStatistics:
+        """
+        Bring the statistics at `stats_path` up to date with the normalisation
+        split dates, scanning only the dates not already accounted for.
+
+        Statistics covering dates that are no longer in the splits can't have them
+        removed, nor can those from source files that have since changed or from
+        data of another dtype, so these are regenerated from scratch. Dates without
+        source data are left out, unless only those after `after` were opened to append.
+
+        :param stats_path:
+        :param da:
+        :param sources: fingerprints of the source files, as from file_fingerprints
+        :param after: the last date of the output being appended to, if any
+        :return:
+        """
+        norm_dates = pd.DatetimeIndex(self.norm_split_dates).unique()
+        sources_path = "{}.sources.json".format(stats_path)
+        stats = SufficientStatistics()
+        stats_sources = dict()
+
+        if os.path.exists(stats_path):
+            stats = SufficientStatistics.load(stats_path)
+
+            if os.path.exists(sources_path):
+                with open(sources_path, "rb") as fh:
+                    stats_inputs = orjson.loads(fh.read())
+            else:
+                stats_inputs = dict(dtype=None, sources=dict())
+
+            if not stats.dates.isin(norm_dates).all():
+                logging.warning("Statistics in {} cover dates outside the normalisation splits, "
+                                "regenerating".format(stats_path))
+                stats = SufficientStatistics()
+            elif stats_inputs["dtype"] != np.dtype(self.dtype).name or \
+                    stats_inputs["sources"] != file_fingerprints(stats_inputs["sources"].keys()):
+                logging.warning("Statistics in {} are not from the current source files and dtype, "
+                                "regenerating".format(stats_path))
+                stats = SufficientStatistics()
+            else:
+                stats_sources = stats_inputs["sources"]
+
+        new_dates = norm_dates.difference(stats.dates)
+
+        missing_dates = new_dates.difference(da.indexes["time"])
+
+        if len(missing_dates) > 0:
+            if after is not None and (missing_dates <= after).any():
+                # Only the files to append were opened, expecting the normalisation to be unchanged
+                raise ProcessingError("The normalisation for {} has changed since its outputs were processed, "
+                                      "so they can't be appended to, reprocess them in full".format(stats_path))
+
+            logging.warning("{} normalisation dates have no source data, leaving them out of {}".
+                            format(len(missing_dates), stats_path))
+            new_dates = new_dates.intersection(da.indexes["time"])
+
+        if len(new_dates) > 0:
+            logging.debug("Generating statistics from {} new training "
+                          "dates".format(len(new_dates)))
+            stats = stats.merge(SufficientStatistics.from_array(da.sel(time=new_dates).data, new_dates))
+            stats.save(stats_path)
+
+            with open(sources_path, "wb") as fh:
+                fh.write(orjson.dumps(dict(dtype=np.dtype(self.dtype).name,
+                                           sources=dict(stats_sources, **sources)), option=orjson.OPT_INDENT_2))
         else:
-            raise RuntimeError("Either a normalisation file or training data "
-                               "must be supplied")
+            logging.debug("Reusing statistics from {}".format(stats_path))
+        return stats
 
-        new_da = (da - minimum) / (maximum - minimum)
-        if self._refdir is None:
-            open(scale_path, "w").write(",".join([str(f) for f in [float(minimum), float(maximum)]]))
-        return new_da
+    def _split_source_files(self,
+                            splits: list,
+                            var_name: str) -> list:
+        """
+
+        :param splits:
+        :param var_name:
+        :return: the source files of `var_name` for any of `splits`
+        """
+        return sorted(set([file
+                           for split in splits
+                           for file in self.source_files.get(split, dict()).get(var_name, [])]))
+
+    def _climatology(self,
+                     var_name: str,
+                     da: object) -> object:
+        """
+        Retrieve the climatology of `var_name` over the climatology split dates, from the
+        climatology cache shared by the processors under the base path if it's there,
+        otherwise generating and caching it.
+
+        :param var_name:
+        :param da:
+        :return: DataArray of the climatology
+        """
+        clim_dates = sorted(set(self.anom_split_dates))
+        clim_cache = ClimatologyCache(os.path.join(self.base_path, "_climatology"), var_name, dict(
+            dates=[pd.Timestamp(date).isoformat() for date in clim_dates],
+            dtype=np.dtype(self.dtype).name,
+            frequency=self._clim_frequency.attribute,
+            sources=file_fingerprints(self._split_source_files(self._anom_clim_splits, var_name)),
+        ))
+
+        climatology = clim_cache.get()
+        if climatology is None:
+            if not pd.DatetimeIndex(clim_dates).isin(da.indexes["time"]).all():
+                # As when only the files to append have been opened
+                da = self._get_source_da(var_name)
+
+            logging.info("Generating climatology {}".format(clim_cache.path))
+            climatology = compute_climatology(da, clim_dates, self._clim_frequency).compute()
+            clim_cache.put(climatology)
+        return climatology
+
+    def _append_after(self,
+                      var_name: str,
+                      var_suffix: str) -> object:
+        """The last date of the existing output of a channel, if processing incrementally
+
+        :param var_name:
+        :param var_suffix:
+        :return: Timestamp, or None if not processing incrementally or there's no output yet
+        """
+        file_path = os.path.join(self.path, self._storage.filename("{}_{}.nc".format(var_name, var_suffix)))
+
+        if not self._incremental or not os.path.exists(file_path):
+            return None
+
+        existing = self._storage.open_dataarray(file_path)
+        existing_dates = existing.indexes["time"]
+        existing.close()
+        self._record_date_range(file_path, existing_dates)
+        return existing_dates.max()
 
     def _process_channel(self,
                          var_name: str,
                          var_suffix: str):
         """
 
+        Processing incrementally, only the source files with dates after the end of
+        an existing output are opened for it.
+
         :param var_name:
         :param var_suffix:
         """
 
         with dask.config.set(**{'array.slicing.split_large_chunks': True}):
-            source_files = list(sorted(set([file
-                                            for split, var_files in self.source_files.items()
-                                            for vn, files in var_files.items()
-                                            for file in files
-                                            if var_name == vn])))
-
-            if len(source_files) > 0:
-                logging.info("Opening {} files for {}".format(len(source_files), var_name))
-
-                # In the old IceNet library there was dubiousness about the source of the
-                # data so this was harder. Now we work with whatever we get from download-toolbox
-                ds = xr.open_mfdataset(
-                    source_files,
-                    # Solves issue with inheriting files without
-                    # time dimension (only having coordinate)
-                    combine="nested",
-                    concat_dim="time",
-                    coords="minimal",
-                    compat="override",
-                    # TODO: review this, but if lat-lon is in the file, it's signalling bigger issues
-                    # drop_variables=("lat", "lon"),
-                    parallel=self._parallel)
-                da = getattr(ds, var_name)
-                da = da.astype(self.dtype)
-
-                # FIXME: we should ideally store train dates against the
-                #  normalisation and climatology, to ensure recalculation on
-                #  reprocess. All this need be is in the path, to be honest
-
+            after = self._append_after(var_name, var_suffix)
+            self._append_afters["{}_{}".format(var_name, var_suffix)] = after
+            da = self._get_source_da(var_name, after=after)
+
+            if da is None and after is not None:
+                logging.info("No source files with dates after {} for {}_{}".format(after, var_name, var_suffix))
+                # Still recording the output, as its dates don't need appending to
+                self.save_processed_file("{}_{}".format(var_name, var_suffix),
+                                         "{}_{}.nc".format(var_name, var_suffix),
+                                         None)
+            elif da is not None:
                 if var_suffix == "anom":
-                    if len(self._anom_clim_splits) < 1 and self._refdir is None:
-                        raise ProcessingError("You must provide a list of splits via "
-                                              "anom_clim_splits if you have anomoly channels")
-
-                    if self._refdir is not None:
-                        logging.info("Loading climatology from alternate directory: {}".format(self._refdir))
-                        clim_path = os.path.join(self._refdir, "params", "climatology.{}".format(var_name))
-                    else:
-                        clim_path = os.path.join(self.get_data_var_folder("params"), "climatology.{}".format(var_name))
-
-                    # TODO: farm out with adaptive frequency the generation of climatologies
-                    if not os.path.exists(clim_path):
-                        logging.info("Generating climatology {}".format(clim_path))
+                    with span("climatology", var=var_name):
+                        if len(self._anom_clim_splits) < 1 and self._refdir is None:
+                            raise ProcessingError("You must provide a list of splits via "
+                                                  "anom_clim_splits if you have anomoly channels")
 
-                        if len(self.anom_split_dates) > 0:
-                            climatology = da.sel(time=self.anom_split_dates).\
-                                groupby('time.month', restore_coord_dims=True).\
-                                mean()
+                        if self._refdir is not None:
+                            logging.info("Loading climatology from alternate directory: {}".format(self._refdir))
+                            clim_path = os.path.join(self._refdir, "params", "climatology.{}".format(var_name))
+                        else:
+                            clim_path = os.path.join(self.get_data_var_folder("params"),
+                                                     "climatology.{}".format(var_name))
 
+                        if self._refdir is None and len(self.anom_split_dates) > 0:
+                            climatology = self._climatology(var_name, da)
                             climatology.to_netcdf(clim_path)
+                        elif os.path.exists(clim_path):
+                            logging.info("Reusing climatology {}".format(clim_path))
+                            with xr.open_dataarray(clim_path) as clim_da:
+                                climatology = clim_da.load()
                         else:
                             raise ProcessingError(
                                 "{} does not exist and no dates are supplied valid for generation".
                                 format(clim_path))
-                    else:
-                        logging.info("Reusing climatology {}".format(clim_path))
-                        climatology = xr.open_dataarray(clim_path)
-
-                    if not set(da.groupby("time.month").all().month.values).\
-                            issubset(set(climatology.month.values)):
-                        logging.warning(
-                            "We don't have a full climatology ({}) "
-                            "compared with data ({})".format(
-                                ",".join(
-                                    [str(i) for i in climatology.month.values]),
-                                ",".join([
-                                    str(i) for i in da.groupby(
-                                        "time.month").all().month.values
-                                ])))
-                        da = da - climatology.mean()
-                    else:
-                        da = da.groupby("time.month") - climatology
+
+                        da = subtract_climatology(da, climatology, self._clim_frequency)
 
                 da = self.pre_normalisation(var_name, da)
                 # We don't do this (https://github.com/tom-andersson/icenet2/
@@ -442,10 +710,15 @@ class NormalisingChannelProcessor(Processor):
                                 "We have a reference {}, so will load "
                                 "and supply abs from that for linear trend of "
                                 "{}".format(self._refdir, var_name))
-                            ref_da = xr.open_dataarray(
-                                os.path.join(self._refdir, "{}_{}.nc".format(var_name, var_suffix)))
+                            ref_da = self._storage.open_dataarray(os.path.join(
+                                self._refdir, self._storage.filename("{}_{}".format(var_name, var_suffix))))
+
+                        # Trends are forecast from the years before each date, so need the full history
+                        trend_da = da if after is None else self.pre_normalisation(var_name,
+                                                                                   self._get_source_da(var_name))
 
-                        self._build_linear_trend_da(da, var_name, ref_da=ref_da)
+                        with span("linear_trend", var=var_name):
+                            self._build_linear_trend_da(trend_da, var_name, ref_da=ref_da)
 
                     elif var_name in self._linear_trends \
                             and var_name not in self._abs_vars:
@@ -457,14 +730,16 @@ class NormalisingChannelProcessor(Processor):
                     logging.info("No normalisation for {}".format(var_name))
                 else:
                     logging.info("Normalising {}".format(var_name))
-                    da = self._normalise(var_name, da)
+                    with span("normalisation", var=var_name):
+                        da = self._normalise(var_name, da, var_suffix)
 
                 da = self.post_normalisation(var_name, da)
 
                 self.save_processed_file(
                     "{}_{}".format(var_name, var_suffix),
                     "{}_{}.nc".format(var_name, var_suffix),
-                    da.rename("_".join([var_name, var_suffix])))
+                    da.rename("_".join([var_name, var_suffix])),
+                    append=self._incremental)
 
     def get_config(self, **kwargs):
         """
@@ -479,6 +754,7 @@ class NormalisingChannelProcessor(Processor):
             "anomoly_vars": self._anom_vars,
             "absolute_vars": self.abs_vars,
             "dataset_config": self._dataset_config,
+            "date_ranges": self.processed_date_ranges(),
             "lag_time": self._lag_time,
             "lead_time": self._lead_time,
             "linear_trends": self._linear_trends,
@@ -487,6 +763,8 @@ class NormalisingChannelProcessor(Processor):
             "processed_files": self._processed_files,
             "source_files": self._source_files,
             "splits": self.splits,
+            "storage": self.storage.name,
+            "storage_options": self.storage.options,
         }
 
     @staticmethod
@@ -530,19 +808,121 @@ class NormalisingChannelProcessor(Processor):
         return da
 
     def process(self):
-        var_suffixes = ["abs", "anom"]
-        var_lists = [getattr(self, "_{}_vars".format(vs)) for vs in var_suffixes]
-        for var_suffix, var_list in zip(var_suffixes, var_lists):
-            for var_name in var_list:
-                if var_name not in set([source_name
-                                        for split, split_vars in self.source_files.items()
-                                        for source_name in split_vars.keys()]):
+        """
+        Process all channels, running variables concurrently across a process pool
+        if more than one worker is configured.
+
+        The channels of a single variable share normalisation and climatology
+        parameters, so they are always processed together by the same worker.
+        """
+        source_names = set([source_name
+                            for split, split_vars in self.source_files.items()
+                            for source_name in split_vars.keys()])
+        var_channels = dict()
+
+        for var_suffix in ["abs", "anom"]:
+            for var_name in getattr(self, "_{}_vars".format(var_suffix)):
+                if var_name not in source_names:
                     logging.warning("{} does not exist in data, you can't use it as a variable".format(var_name))
                 else:
-                    self._process_channel(var_name, var_suffix)
+                    var_channels.setdefault(var_name, []).append(var_suffix)
+
+        with span("process", variables=len(var_channels)):
+            if self._workers > 1 and len(var_channels) > 1:
+                self._process_concurrently(var_channels)
+            else:
+                for var_name, var_suffixes in var_channels.items():
+                    self._process_channels(var_name, var_suffixes)
 
         self.save_config()
 
+    def _process_channels(self,
+                          var_name: str,
+                          var_suffixes: list,
+                          drain_trace: bool = False) -> dict:
+        """Process and write the channels of a variable
+
+        The writes of the channels are deferred and computed together, but the normalisation
+        statistics, climatology and linear trend are each computed as the channels need them,
+        so without a cached copy each of those is a further read of the source.
+
+        :param var_name:
+        :param var_suffixes:
+        :param drain_trace: take the trace events recorded, as a worker of _process_concurrently returning them
+        :return: the processed files, their date ranges, storage report and any trace events drained, for
+            merging back from a worker process
+        """
+        try:
+            with span("variable", var=var_name), self.deferred_writes():
+                for var_suffix in var_suffixes:
+                    with span("channel", var=var_name, suffix=var_suffix):
+                        self._process_channel(var_name, var_suffix)
+        finally:
+            self._source_handles.evict(var_name)
+
+        # Trace events only need returning from a worker, otherwise they're already where they belong
+        tracer = get_tracer() if drain_trace else None
+        return self.processed_files, self.date_ranges, self.storage_report, \
+            tracer.drain() if tracer is not None else None
+
+    def _process_concurrently(self,
+                              var_channels: dict) -> None:
+        """
+        Run the channels for each variable in a separate process, merging the
+        processed files from each back in as they complete.
+
+        Each worker is limited to an even share of the physical memory, unless
+        a memory limit is given, so that large variables fail on their own
+        rather than exhausting the node between them.
+
+        :param var_channels: the channel suffixes to process for each variable
+        """
+        workers = min(self._workers, len(var_channels))
+        memory_limit = self._memory_limit if self._memory_limit is not None else \
+            os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") // workers
+        num_threads = max(1, os.cpu_count() // workers)
+
+        logging.info("Processing {} variables across {} workers, each with {} threads and "
+                     "{:.1f}GB memory".format(len(var_channels), workers, num_threads, memory_limit / 2 ** 30))
+
+        failures = dict()
+        tracer = get_tracer()
+        # Spawn rather than fork, as neither HDF5 nor dask's thread pools survive forking
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers,
+                                                    mp_context=multiprocessing.get_context("spawn"),
+                                                    initializer=init_worker_process,
+                                                    initargs=(logging.getLogger().level,
+                                                              memory_limit,
+                                                              num_threads,
+                                                              tracer is not None)) as executor:
+            futures = {executor.submit(self._process_channels, var_name, var_suffixes, drain_trace=True): var_name
+                       for var_name, var_suffixes in var_channels.items()}
+
+            for future in concurrent.futures.as_completed(futures):
+                var_name = futures[future]
+
+                try:
+                    processed_files, date_ranges, storage_report, trace_events = future.result()
+                    self.merge_processed_files(processed_files, date_ranges)
+                    self.storage_report.update(storage_report)
+
+                    if tracer is not None:
+                        tracer.merge(trace_events)
+                except MemoryError:
+                    logging.exception("{} exceeded the worker memory limit".format(var_name))
+                    failures[var_name] = "exceeded memory limit of {} bytes".format(memory_limit)
+                except Exception as e:
+                    logging.exception("{} failed to process".format(var_name))
+                    failures[var_name] = str(e)
+                else:
+                    logging.info("Completed processing for {}".format(var_name))
+
+        if len(failures) > 0:
+            # Retain the outputs for those that did succeed
+            self.save_config()
+            raise ProcessingError("Failed to process {}".format(
+                ", ".join(["{} ({})".format(k, v) for k, v in failures.items()])))
+
     @property
     def anom_split_dates(self) -> list:
         # TODO: functools.cached_property, though slightly odd behaviour re. write-ability
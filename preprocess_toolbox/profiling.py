@@ -0,0 +1,238 @@
+"""Timing spans for finding where processing spends its time
+
+Tracing is off unless `enable_tracing` is called, as it is by the `--trace` argument
+of the commands, in which case `span` records how long each block it wraps takes.
+Alongside the spans, the duration of every dask task and the resident memory of the
+process are recorded, and the lot are written as trace events for loading into a
+trace viewer such as Perfetto or chrome://tracing.
+
+When tracing is off `span` returns a shared, empty context manager, so instrumented
+code costs little more than a function call.
+"""
+import atexit
+import contextlib
+import logging
+import os
+import resource
+import threading
+import time
+
+import orjson
+
+from dask.callbacks import Callback
+from dask.utils import key_split
+
+
+class _DaskTaskCallback(Callback):
+    """Record each dask task run, named by the prefix of the task's key"""
+
+    def __init__(self, tracer: "Tracer"):
+        super().__init__()
+        self._starts = dict()
+        self._tracer = tracer
+
+    def _pretask(self, key, dask, state):
+        self._starts[key] = self._tracer.timestamp()
+
+    def _posttask(self, key, result, dask, state, worker_id):
+        start = self._starts.pop(key, None)
+
+        if start is not None:
+            self._tracer.complete(key_split(key), start, self._tracer.timestamp() - start, category="dask")
+
+
+class Tracer:
+    """Collects trace events for the current process
+
+    Timestamps are in microseconds since the epoch, so that events recorded in worker
+    processes line up with those of the process that started them.
+
+    :param memory_interval: Seconds between samples of resident memory, or None not to sample.
+    :param dask_tasks: Whether to record each dask task.
+    """
+
+    def __init__(self,
+                 memory_interval: float = 0.1,
+                 dask_tasks: bool = True):
+        self._dask_callback = _DaskTaskCallback(self) if dask_tasks else None
+        self._events = list()
+        self._lock = threading.Lock()
+        self._memory_interval = memory_interval
+        self._memory_thread = None
+        self._offset_ns = time.time_ns() - time.perf_counter_ns()
+        self._pid = os.getpid()
+        self._started = False
+        self._stopped = threading.Event()
+
+    def timestamp(self) -> float:
+        return (time.perf_counter_ns() + self._offset_ns) / 1000
+
+    def complete(self,
+                 name: str,
+                 start: float,
+                 duration: float,
+                 category: str = "processing",
+                 args: dict = None) -> None:
+        """Record a complete event, one with a start and duration
+
+        :param name:
+        :param start: Start in microseconds, as from `timestamp`
+        :param duration: Duration in microseconds
+        :param category:
+        :param args: Values to show against the event
+        """
+        event = dict(name=name, cat=category, ph="X", ts=start, dur=duration,
+                     pid=self._pid, tid=threading.get_ident())
+        if args:
+            event["args"] = args
+
+        with self._lock:
+            self._events.append(event)
+
+    @contextlib.contextmanager
+    def span(self,
+             name: str,
+             **kwargs):
+        start = self.timestamp()
+
+        try:
+            yield
+        finally:
+            self.complete(name, start, self.timestamp() - start, args=kwargs)
+
+    def _sample_memory(self) -> None:
+        page_size = os.sysconf("SC_PAGE_SIZE")
+
+        while not self._stopped.wait(self._memory_interval):
+            try:
+                with open("/proc/self/statm") as fh:
+                    rss = int(fh.read().split()[1]) * page_size
+            except OSError:
+                # Not having /proc, the peak is the best available, in kilobytes on Linux
+                rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+            with self._lock:
+                self._events.append(dict(name="memory", ph="C", ts=self.timestamp(), pid=self._pid,
+                                         args=dict(rss_bytes=rss)))
+
+    def start(self) -> None:
+        if self._started:
+            return
+        self._started = True
+        self._stopped.clear()
+
+        if self._dask_callback is not None:
+            self._dask_callback.register()
+
+        if self._memory_interval is not None:
+            self._memory_thread = threading.Thread(target=self._sample_memory, name="trace-memory", daemon=True)
+            self._memory_thread.start()
+
+    def stop(self) -> None:
+        if not self._started:
+            return
+        self._started = False
+
+        if self._dask_callback is not None:
+            self._dask_callback.unregister()
+
+        if self._memory_thread is not None:
+            self._stopped.set()
+            self._memory_thread.join()
+            self._memory_thread = None
+
+    def drain(self) -> list:
+        """Take the events recorded so far, such as for returning from a worker process
+
+        :return: list of trace events
+        """
+        with self._lock:
+            events, self._events = self._events, list()
+        return events
+
+    def merge(self, events: list) -> None:
+        """Add events recorded elsewhere, such as by a worker process
+
+        :param events:
+        """
+        with self._lock:
+            self._events.extend(events)
+
+    def save(self, trace_path: os.PathLike) -> None:
+        """Write the events recorded so far as a trace event file
+
+        The totals of time spent in each span and each kind of dask task are included
+        for a quick summary without a trace viewer.
+
+        :param trace_path:
+        """
+        with self._lock:
+            events = list(self._events)
+
+        totals = dict()
+        for event in events:
+            if event["ph"] == "X":
+                total = totals.setdefault(event["cat"], dict()).setdefault(event["name"], dict(count=0, seconds=0.))
+                total["count"] += 1
+                total["seconds"] += event["dur"] / 1e6
+
+        with open(trace_path, "wb") as fh:
+            fh.write(orjson.dumps(dict(traceEvents=events, displayTimeUnit="ms", otherData=dict(totals=totals))))
+        logging.info("Written {} trace events to {}".format(len(events), trace_path))
+
+
+_NO_SPAN = contextlib.nullcontext()
+_tracer = None
+
+
+def get_tracer() -> Tracer:
+    """The tracer of this process, or None if tracing is off"""
+    return _tracer
+
+
+def enable_tracing(trace_path: os.PathLike = None,
+                   **kwargs) -> Tracer:
+    """Start tracing this process
+
+    :param trace_path: File to write the trace to on exit, or None to leave it to the caller.
+    :param kwargs: Arguments for Tracer
+    :return: the tracer
+    """
+    global _tracer
+
+    if _tracer is not None:
+        return _tracer
+
+    tracer = _tracer = Tracer(**kwargs)
+    tracer.start()
+
+    if trace_path is not None:
+        logging.info("Tracing to {}".format(trace_path))
+
+        def _save():
+            tracer.stop()
+            tracer.save(trace_path)
+        atexit.register(_save)
+    return tracer
+
+
+def disable_tracing() -> None:
+    """Stop tracing this process, discarding anything not yet saved"""
+    global _tracer
+
+    if _tracer is not None:
+        _tracer.stop()
+        _tracer = None
+
+
+def span(name: str,
+         **kwargs) -> contextlib.AbstractContextManager:
+    """Time the block this wraps, if tracing
+
+    :param name: Name of the stage.
+    :param kwargs: Values to show against the span, such as the variable being processed.
+    :return: context manager
+    """
+    if _tracer is None:
+        return _NO_SPAN
+    return _tracer.span(name, **kwargs)
@@ -0,0 +1,147 @@
+import logging
+import os
+
+import dask
+import numpy as np
+import orjson
+import pandas as pd
+
+
+def _block_statistics(block: np.ndarray) -> tuple:
+    """Sufficient statistics for the non-NaN values of a single block
+
+    :param block:
+    :return: count, mean, sum of squared differences from the mean, minimum, maximum
+    """
+    values = np.asarray(block, dtype=np.float64)
+    values = values[~np.isnan(values)]
+
+    if values.size < 1:
+        return 0, 0., 0., np.inf, -np.inf
+
+    mean = values.mean()
+    return values.size, mean, ((values - mean) ** 2).sum(), values.min(), values.max()
+
+
+class SufficientStatistics:
+    """Count, mean, sum of squares, minimum and maximum of a sample, plus the dates it covers
+
+    Statistics from separate samples are combined with the parallel merge of Chan et al.,
+    so they can be accumulated a chunk at a time in a single pass over the data and
+    extended with new dates without revisiting those already included.
+
+    :param count: Number of non-NaN values.
+    :param mean: Mean of the values.
+    :param m2: Sum of squared differences from the mean.
+    :param minimum: Minimum of the values.
+    :param maximum: Maximum of the values.
+    :param dates: Dates the values were drawn from.
+    """
+
+    def __init__(self,
+                 count: int = 0,
+                 mean: float = 0.,
+                 m2: float = 0.,
+                 minimum: float = np.inf,
+                 maximum: float = -np.inf,
+                 dates: object = ()):
+        self._count = int(count)
+        self._mean = float(mean)
+        self._m2 = float(m2)
+        self._minimum = float(minimum)
+        self._maximum = float(maximum)
+        self._dates = pd.DatetimeIndex(dates)
+
+    @classmethod
+    def from_array(cls,
+                   array: object,
+                   dates: object = ()) -> object:
+        """Accumulate statistics over every block of a (dask) array in a single compute
+
+        :param array:
+        :param dates: The dates represented by `array`.
+        :return: SufficientStatistics
+        """
+        blocks = array.to_delayed().ravel() if hasattr(array, "to_delayed") else [array]
+        block_stats = dask.compute(*[dask.delayed(_block_statistics)(block) for block in blocks])
+
+        stats = cls(dates=dates)
+        for block_stat in block_stats:
+            stats = stats.merge(cls(*block_stat))
+        return stats
+
+    @classmethod
+    def load(cls, path: os.PathLike) -> object:
+        with open(path, "r") as fh:
+            data = orjson.loads(fh.read())
+
+        # JSON has no infinities, so bounds of an empty sample are stored as null
+        return cls(count=data["count"],
+                   mean=data["mean"],
+                   m2=data["m2"],
+                   minimum=data["minimum"] if data["minimum"] is not None else np.inf,
+                   maximum=data["maximum"] if data["maximum"] is not None else -np.inf,
+                   dates=data["dates"])
+
+    def merge(self, other: object) -> object:
+        """Combine with statistics over a disjoint sample
+
+        :param other:
+        :return: SufficientStatistics covering both samples
+        """
+        count = self._count + other.count
+        dates = self._dates.append(other.dates)
+
+        if count == 0:
+            return SufficientStatistics(dates=dates)
+
+        delta = other.mean - self._mean
+        return SufficientStatistics(
+            count=count,
+            mean=self._mean + delta * other.count / count,
+            m2=self._m2 + other.m2 + delta ** 2 * self._count * other.count / count,
+            minimum=min(self._minimum, other.minimum),
+            maximum=max(self._maximum, other.maximum),
+            dates=dates,
+        )
+
+    def save(self, path: os.PathLike) -> None:
+        logging.debug("Writing statistics for {} dates to {}".format(len(self._dates), path))
+        with open(path, "w") as fh:
+            fh.write(orjson.dumps(dict(
+                count=self._count,
+                mean=self._mean,
+                m2=self._m2,
+                minimum=self._minimum if self._count > 0 else None,
+                maximum=self._maximum if self._count > 0 else None,
+                dates=[date.isoformat() for date in self._dates.sort_values()],
+            ), option=orjson.OPT_INDENT_2).decode())
+
+    @property
+    def count(self) -> int:
+        return self._count
+
+    @property
+    def dates(self) -> pd.DatetimeIndex:
+        return self._dates
+
+    @property
+    def m2(self) -> float:
+        return self._m2
+
+    @property
+    def maximum(self) -> float:
+        return self._maximum
+
+    @property
+    def mean(self) -> float:
+        return self._mean
+
+    @property
+    def minimum(self) -> float:
+        return self._minimum
+
+    @property
+    def std(self) -> float:
+        """Population standard deviation, as per numpy.nanstd"""
+        return np.sqrt(self._m2 / self._count) if self._count > 0 else np.nan
@@ -0,0 +1,364 @@
+import logging
+import os
+
+import dask
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+
+def quantise(data: object,
+             least_significant_digit: int) -> object:
+    """Round data to a power of two precision retaining `least_significant_digit` decimal places
+
+    This is the same lossy quantisation that netCDF4 applies for least_significant_digit,
+    leaving trailing bits zeroed so that the data compresses far better.
+
+    :param data:
+    :param least_significant_digit:
+    :return:
+    """
+    scale = 2. ** np.ceil(np.log2(10. ** least_significant_digit))
+    return (data * scale).round() / scale
+
+
+def storage_size(file_path: os.PathLike) -> int:
+    """The bytes used on disk by a file, or all files beneath a directory
+
+    :param file_path:
+    :return:
+    """
+    if not os.path.isdir(file_path):
+        return os.path.getsize(file_path)
+
+    return sum([os.path.getsize(os.path.join(root, name))
+                for root, _, names in os.walk(file_path)
+                for name in names])
+
+
+class StorageBackend:
+    """Writes and reopens processed data in a particular storage format.
+
+    Data is chunked for writing along `chunks`, with any dimension not named
+    left whole, so the default of a single time step per chunk with full
+    spatial tiles suits the per-date access of training loaders.
+
+    Compression options apply to every variable written, unless overridden
+    for a variable by name in `variables`.
+
+    :param chunks: Chunk sizes by dimension name.
+    :param codec: Name of the compression codec, None for the backend default or "none".
+    :param level: Compression level for the codec.
+    :param shuffle: Whether to apply the byte shuffle filter ahead of compression.
+    :param least_significant_digit: Decimal places to retain with lossy quantisation, None for lossless.
+    :param variables: Overrides of codec, level, shuffle or least_significant_digit by variable name.
+    """
+
+    default_codec = None
+    extension = None
+    name = None
+
+    def __init__(self,
+                 chunks: dict = None,
+                 codec: str = None,
+                 level: int = None,
+                 shuffle: bool = True,
+                 least_significant_digit: int = None,
+                 variables: dict = None):
+        self._chunks = dict(time=1) if chunks is None else dict(chunks)
+        self._codec = codec if codec is not None else self.default_codec
+        self._least_significant_digit = least_significant_digit
+        self._level = level
+        self._shuffle = shuffle
+        self._variables = dict() if variables is None else variables
+
+    def chunks_for(self, data: object) -> dict:
+        """The chunk sizes to write `data` with, for each of its dimensions
+
+        :param data:
+        :return: dict of chunk sizes by dimension
+        """
+        return {dim: min(self._chunks.get(dim, size), size)
+                for dim, size in data.sizes.items()}
+
+    def compression_for(self, var_name: str) -> dict:
+        """The compression options for `var_name`, including any overrides
+
+        :param var_name:
+        :return: dict of codec, level, shuffle and least_significant_digit
+        """
+        options = dict(codec=self._codec,
+                       level=self._level,
+                       shuffle=self._shuffle,
+                       least_significant_digit=self._least_significant_digit)
+        options.update(self._variables.get(var_name, dict()))
+
+        if options["codec"] == "none":
+            options["codec"] = None
+        return options
+
+    def filename(self, name: str) -> str:
+        """Swap the extension of `name` for the one used by this backend
+
+        :param name:
+        :return:
+        """
+        return "{}.{}".format(os.path.splitext(name)[0], self.extension)
+
+    def append(self,
+               data: object,
+               file_path: os.PathLike,
+               compute: bool = True) -> object:
+        raise NotImplementedError("{} does not implement append".format(self.__class__.__name__))
+
+    def open_dataarray(self, file_path: os.PathLike) -> xr.DataArray:
+        raise NotImplementedError("{} does not implement open_dataarray".format(self.__class__.__name__))
+
+    def open_dataset(self, file_paths: list) -> xr.Dataset:
+        raise NotImplementedError("{} does not implement open_dataset".format(self.__class__.__name__))
+
+    def write(self,
+              data: object,
+              file_path: os.PathLike,
+              compute: bool = True) -> object:
+        raise NotImplementedError("{} does not implement write".format(self.__class__.__name__))
+
+    def report(self,
+               file_path: os.PathLike,
+               data_bytes: int) -> dict:
+        """Log and return the bytes written for `file_path` against those of the data
+
+        :param file_path:
+        :param data_bytes: The size of the data in memory
+        :return: dict of bytes written, data bytes and the compression ratio
+        """
+        written_bytes = storage_size(file_path)
+        ratio = data_bytes / written_bytes if written_bytes > 0 else np.nan
+
+        logging.info("Wrote {:.1f}MB to {} from {:.1f}MB of data, a compression ratio of {:.2f}".
+                     format(written_bytes / 2 ** 20, file_path, data_bytes / 2 ** 20, ratio))
+        return dict(bytes=written_bytes,
+                    data_bytes=data_bytes,
+                    ratio=ratio)
+
+    @property
+    def options(self) -> dict:
+        """The options to recreate this backend, as recorded in processor configurations"""
+        return dict(chunks=self._chunks,
+                    codec=self._codec,
+                    level=self._level,
+                    shuffle=self._shuffle,
+                    least_significant_digit=self._least_significant_digit,
+                    variables=self._variables)
+
+
+class NetCDFBackend(StorageBackend):
+    """Monolithic netCDF files, one per processed output
+
+    Variables are compressed with zlib by default. Other codecs, such as
+    blosc_lz4 or zstd, depend on the plugins available to the netCDF4 library.
+
+    Time is written as an unlimited dimension, so that dates can be appended in place.
+    """
+
+    default_codec = "zlib"
+    extension = "nc"
+    name = "netcdf"
+
+    def _encoding(self, ds: xr.Dataset) -> dict:
+        chunks = self.chunks_for(ds)
+        encoding = dict()
+
+        for var_name, da in ds.data_vars.items():
+            options = self.compression_for(var_name)
+            encoding[var_name] = dict(chunksizes=tuple([chunks[dim] for dim in da.dims]),
+                                      shuffle=options["shuffle"])
+
+            if options["codec"] == "zlib":
+                encoding[var_name].update(zlib=True)
+            elif options["codec"] is not None:
+                encoding[var_name].update(compression=options["codec"])
+
+            if options["codec"] is not None and options["level"] is not None:
+                encoding[var_name].update(complevel=options["level"])
+
+            if options["least_significant_digit"] is not None:
+                encoding[var_name].update(least_significant_digit=options["least_significant_digit"])
+        return encoding
+
+    def _append(self,
+                data: object,
+                file_path: os.PathLike) -> None:
+        import netCDF4
+
+        ds = data.to_dataset() if isinstance(data, xr.DataArray) else data
+
+        with netCDF4.Dataset(file_path, "a") as nc:
+            if nc.dimensions["time"].isunlimited():
+                logging.debug("Appending {} dates to netCDF {}".format(ds.sizes["time"], file_path))
+                time_var = nc.variables["time"]
+                offset = len(nc.dimensions["time"])
+
+                time_var[offset:] = netCDF4.date2num(pd.DatetimeIndex(ds.time.values).to_pydatetime(),
+                                                     time_var.units,
+                                                     getattr(time_var, "calendar", "standard"))
+                for var_name, da in ds.data_vars.items():
+                    nc_var = nc.variables[var_name]
+                    nc_var[tuple([slice(offset, None) if dim == "time" else slice(None)
+                                  for dim in nc_var.dimensions])] = da.transpose(*nc_var.dimensions).values
+                return
+
+        # Files written before time was unlimited can't be extended, so are rewritten the once
+        logging.info("Rewriting {} with an unlimited time dimension to append to it".format(file_path))
+        temp_path = "{}.{}.tmp".format(file_path, os.getpid())
+
+        with xr.open_dataset(file_path, chunks=dict()) as existing_ds:
+            self.write(xr.concat([existing_ds, ds], dim="time"), temp_path)
+        os.replace(temp_path, file_path)
+
+    def append(self,
+               data: object,
+               file_path: os.PathLike,
+               compute: bool = True) -> object:
+        if not compute:
+            # Dask computes the data as it's passed, so only the new dates are read
+            return dask.delayed(self._append)(data, file_path)
+        return self._append(data.compute(), file_path)
+
+    def open_dataarray(self, file_path: os.PathLike) -> xr.DataArray:
+        return xr.open_dataarray(file_path)
+
+    def open_dataset(self, file_paths: list) -> xr.Dataset:
+        # TODO: where's my parallel mfdataset please!?
+        return xr.open_mfdataset(
+            file_paths,
+            combine="nested",
+            concat_dim="time",
+            coords="minimal",
+            compat="override",
+            chunks=dict(time=1, ),
+        )
+
+    def write(self,
+              data: object,
+              file_path: os.PathLike,
+              compute: bool = True) -> object:
+        ds = data.to_dataset() if isinstance(data, xr.DataArray) else data
+        encoding = self._encoding(ds)
+
+        logging.debug("Writing netCDF {} with encoding {}".format(file_path, encoding))
+        return ds.to_netcdf(file_path,
+                            compute=compute,
+                            encoding=encoding,
+                            engine="netcdf4",
+                            unlimited_dims=["time"] if "time" in ds.dims else None)
+
+
+class ZarrBackend(StorageBackend):
+    """Zarr stores with consolidated metadata, written chunk by chunk in parallel through dask
+
+    Codecs are those provided by blosc, such as lz4 or zstd, with no compression by default.
+    """
+
+    extension = "zarr"
+    name = "zarr"
+
+    def _encoding(self, ds: xr.Dataset) -> dict:
+        import zarr
+
+        encoding = dict()
+
+        for var_name in ds.data_vars:
+            options = self.compression_for(var_name)
+
+            if options["codec"] is None:
+                continue
+
+            level = 5 if options["level"] is None else options["level"]
+
+            if int(zarr.__version__.split(".")[0]) >= 3:
+                from zarr.codecs import BloscCodec
+                encoding[var_name] = dict(compressors=[BloscCodec(
+                    cname=options["codec"],
+                    clevel=level,
+                    shuffle="shuffle" if options["shuffle"] else "noshuffle")])
+            else:
+                from numcodecs import Blosc
+                encoding[var_name] = dict(compressor=Blosc(
+                    cname=options["codec"],
+                    clevel=level,
+                    shuffle=Blosc.SHUFFLE if options["shuffle"] else Blosc.NOSHUFFLE))
+        return encoding
+
+    def _prepare(self, data: object) -> xr.Dataset:
+        ds = data.to_dataset() if isinstance(data, xr.DataArray) else data
+        ds = ds.chunk(self.chunks_for(ds))
+
+        for var_name in list(ds.data_vars):
+            least_significant_digit = self.compression_for(var_name)["least_significant_digit"]
+
+            if least_significant_digit is not None:
+                ds[var_name] = quantise(ds[var_name], least_significant_digit).astype(ds[var_name].dtype)
+
+        # Encoding from the source would otherwise override our chunking and compression
+        for var_name in ds.variables:
+            ds[var_name].encoding = dict()
+        return ds
+
+    def append(self,
+               data: object,
+               file_path: os.PathLike,
+               compute: bool = True) -> object:
+        ds = self._prepare(data)
+
+        logging.debug("Appending {} dates to zarr store {}".format(ds.sizes["time"], file_path))
+        return ds.to_zarr(file_path,
+                          append_dim="time",
+                          consolidated=True,
+                          compute=compute)
+
+    def open_dataarray(self, file_path: os.PathLike) -> xr.DataArray:
+        ds = xr.open_zarr(file_path, consolidated=True)
+        data_vars = list(ds.data_vars)
+
+        if len(data_vars) != 1:
+            raise ValueError("{} should contain a single variable, found {}".format(file_path, data_vars))
+        return ds[data_vars[0]]
+
+    def open_dataset(self, file_paths: list) -> xr.Dataset:
+        return xr.combine_by_coords([xr.open_zarr(file_path,
+                                                  chunks=dict(time=1, ),
+                                                  consolidated=True)
+                                     for file_path in file_paths],
+                                    coords="minimal",
+                                    compat="override")
+
+    def write(self,
+              data: object,
+              file_path: os.PathLike,
+              compute: bool = True) -> object:
+        ds = self._prepare(data)
+
+        logging.debug("Writing zarr store {} with chunks {}".format(file_path, self.chunks_for(ds)))
+        return ds.to_zarr(file_path,
+                          mode="w",
+                          consolidated=True,
+                          encoding=self._encoding(ds),
+                          compute=compute)
+
+
+STORAGE_BACKENDS = dict([(backend.name, backend) for backend in [NetCDFBackend, ZarrBackend]])
+
+
+def get_storage_backend(name: str = NetCDFBackend.name,
+                        options: dict = None) -> StorageBackend:
+    """Create a storage backend from its name and options, as recorded in configurations
+
+    :param name: One of the keys of STORAGE_BACKENDS
+    :param options:
+    :return:
+    """
+    if name not in STORAGE_BACKENDS:
+        raise ValueError("{} is not a storage backend, choose from {}".
+                         format(name, ", ".join(STORAGE_BACKENDS.keys())))
+    return STORAGE_BACKENDS[name](**(options if options is not None else dict()))
@@ -1,14 +1,77 @@
+import datetime as dt
+import hashlib
 import importlib
+import itertools
 import logging
 import operator
 import os
+import resource
 
-from dateutil.relativedelta import relativedelta
-
+import dask
 import orjson
+import pandas as pd
 
 from download_toolbox.interface import get_implementation, DatasetConfig
 
+from preprocess_toolbox.cache import FileIndex
+from preprocess_toolbox.profiling import enable_tracing
+
+
+def file_digest(file_path: os.PathLike,
+                block_size: int = 2 ** 20) -> str:
+    """The sha256 hex digest of a file's content, read a block at a time
+
+    :param file_path:
+    :param block_size: Bytes to read at once
+    :return:
+    """
+    digest = hashlib.sha256()
+
+    with open(file_path, "rb") as fh:
+        for block in iter(lambda: fh.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def file_fingerprints(file_paths: list) -> dict:
+    """The modification time and size of each file, for telling if any have changed
+
+    :param file_paths:
+    :return: dict of [mtime_ns, size] by absolute path, or None for those that don't exist
+    """
+    fingerprints = dict()
+
+    for file_path in file_paths:
+        try:
+            stat = os.stat(file_path)
+            fingerprints[os.path.abspath(file_path)] = [stat.st_mtime_ns, stat.st_size]
+        except FileNotFoundError:
+            fingerprints[os.path.abspath(file_path)] = None
+    return fingerprints
+
+
+# Pandas offsets for the dates of each dataset frequency, which are stamped at the start of
+# each period. Pandas no longer takes the period aliases of the frequencies for date ranges
+_DATE_RANGE_FREQUENCIES = dict(Y="YS", M="MS", H="h")
+
+
+def date_range_freq(frequency: object) -> str:
+    """The pandas offset for a range of dates at a dataset frequency
+
+    :param frequency: Frequency of the dataset
+    :return: offset alias for pd.date_range
+    """
+    return _DATE_RANGE_FREQUENCIES.get(frequency.freq, frequency.freq)
+
+
+def parameters_key(parameters: dict) -> str:
+    """A short hash of the inputs that determine a result, for keying it by them
+
+    :param parameters: JSON serialisable inputs
+    :return:
+    """
+    return hashlib.sha256(orjson.dumps(parameters, option=orjson.OPT_SORT_KEYS)).hexdigest()[:16]
+
 
 def get_config(loader_config: os.PathLike):
     with open(loader_config, "r") as fh:
@@ -17,27 +80,75 @@ def get_config(loader_config: os.PathLike):
     return cfg_data
 
 
+def init_worker_process(log_level: int,
+                        memory_limit: int = None,
+                        num_threads: int = None,
+                        trace: bool = False) -> None:
+    """Configure a process pool worker
+
+    :param log_level: Logging level to carry over from the parent process
+    :param memory_limit: Bytes of memory the worker may allocate before failing with MemoryError
+    :param num_threads: Number of threads for dask to use within the worker
+    :param trace: Whether to trace the worker, for returning its events to the parent process
+    """
+    logging.basicConfig(level=log_level)
+
+    if trace:
+        enable_tracing()
+
+    if memory_limit is not None:
+        resource.setrlimit(resource.RLIMIT_DATA, (memory_limit, memory_limit))
+
+    if num_threads is not None:
+        dask.config.set(num_workers=num_threads)
+
+
 def get_extension_dates(ds_config: DatasetConfig,
                         dates: list,
                         num_steps: int,
-                        reverse=False):
-    additional_dates, dropped_dates = [], []
-
-    for date in dates:
-        for time in range(num_steps):
-            attrs = {"{}s".format(ds_config.frequency.attribute): time + 1}
-            op = operator.sub if reverse else operator.add
-            extended_date = op(date, relativedelta(**attrs))
-
-            if extended_date not in dates:
-                if all([os.path.exists(ds_config.var_filepath(var_config, [extended_date]))
-                        for var_config in ds_config.variables]):
-                    # We only add these dates into the mix if all necessary files exist
-                    additional_dates.append(extended_date)
-                else:
-                    # Otherwise, warn that the lag data means this is being dropped
-                    logging.warning("{} will be dropped due to missing data {}".
-                                    format(date, extended_date))
-                    dropped_dates.append(date)
-
-    return sorted(list(set(additional_dates))), sorted(list(set(dropped_dates)))
+                        reverse=False,
+                        file_index: FileIndex = None):
+    """Dates needed to extend `dates` by a number of time steps, and those that can't be extended
+
+    Availability comes from the file index of the dataset, with the extension dates
+    checked against the dates held for every variable once each, however many dates
+    they extend.
+
+    :param ds_config:
+    :param dates:
+    :param num_steps: Number of time steps to extend each date by
+    :param reverse: Extend backwards in time, for lags, rather than forwards
+    :param file_index: The index of the dataset, if already opened
+    :return: sorted lists of the additional dates and the dates dropped for lack of data
+    """
+    op = operator.sub if reverse else operator.add
+    date_set = set(dates)
+    unique_dates = sorted(date_set)
+
+    # Offsetting the dates in one go per step, as relativedelta arithmetic is slow
+    index = pd.DatetimeIndex(unique_dates)
+    steps = [op(index, pd.DateOffset(**{"{}s".format(ds_config.frequency.attribute): step + 1}))
+             for step in range(num_steps)]
+    steps = [step.to_pydatetime() if isinstance(unique_dates[0], dt.datetime) else step.date
+             for step in steps] if len(unique_dates) > 0 else []
+
+    extensions = {date: set(date_extensions) - date_set
+                  for date, *date_extensions in zip(unique_dates, *steps)}
+    extended_dates = sorted(set().union(*extensions.values()))
+
+    file_index = FileIndex(ds_config) if file_index is None else file_index
+    # We only add dates into the mix if all variables have data for them
+    available_dates = set(itertools.compress(extended_dates, file_index.has_dates(extended_dates))) \
+        if len(extended_dates) > 0 else set()
+
+    dropped_dates = list()
+    for date, date_extensions in extensions.items():
+        missing_dates = date_extensions - available_dates
+
+        if len(missing_dates) > 0:
+            # Otherwise, warn that the lag data means this is being dropped
+            logging.warning("{} will be dropped due to missing data {}".
+                            format(date, ", ".join([str(missing_date) for missing_date in sorted(missing_dates)])))
+            dropped_dates.append(date)
+
+    return sorted(available_dates), sorted(dropped_dates)
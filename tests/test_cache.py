@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+
+"""Tests for `preprocess_toolbox.cache`."""
+
+import os
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from download_toolbox.dataset import DatasetConfig
+from download_toolbox.location import Location
+
+import preprocess_toolbox.cache
+from preprocess_toolbox.cache import FileIndex, TrendCache
+from preprocess_toolbox.utils import file_fingerprints, get_extension_dates
+
+
+def test_file_index_refreshes_incrementally(tmp_path, monkeypatch):
+    ds_config = DatasetConfig(location=Location("test", north=True),
+                              var_names=["sic"],
+                              path_components=[],
+                              identifier="source",
+                              levels=[None],
+                              base_path=str(tmp_path))
+
+    def save(start, end):
+        dates = pd.date_range(start, end, freq="D")
+        ds_config.save_data_for_config(source_ds=xr.Dataset(
+            dict(sic=(("time", "yc", "xc"), np.zeros((len(dates), 2, 2)))), coords=dict(time=dates)))
+
+    save("2000-12-01", "2001-01-10")
+    cache_path = os.path.join(tmp_path, "_file_index")
+    index = FileIndex(ds_config, cache_path)
+    assert index.files("sic", [pd.Timestamp("2001-01-05")]) == [os.path.join(ds_config.path, "sic", "2001.nc")]
+    np.testing.assert_array_equal(index.has_dates(pd.to_datetime(["2000-12-31", "2001-01-11"])), [True, False])
+
+    save("2002-01-01", "2002-01-10")
+    read_files = list()
+    read_dates = FileIndex._read_dates
+
+    def tracked_read_dates(file_path):
+        read_files.append(os.path.basename(file_path))
+        return read_dates(file_path)
+
+    monkeypatch.setattr(preprocess_toolbox.cache.FileIndex, "_read_dates", staticmethod(tracked_read_dates))
+    index = FileIndex(ds_config, cache_path)
+    assert read_files == ["2002.nc"]
+    assert len(os.listdir(cache_path)) == 1
+    assert not any(name.endswith(".tmp") or "index" in name for name in os.listdir(ds_config.path))
+    assert len(index.dates("sic")) == 51
+
+    additional_dates, dropped_dates = get_extension_dates(ds_config,
+                                                          [date.date() for date in pd.date_range("2001-01-03",
+                                                                                                 "2001-01-09")],
+                                                          2,
+                                                          file_index=index)
+    assert additional_dates == [pd.Timestamp("2001-01-10").date()]
+    assert dropped_dates == [pd.Timestamp("2001-01-09").date()]
+
+    assert index.files_between("sic", pd.Timestamp("2001-01-11"), pd.Timestamp("2001-12-31")) == []
+    assert index.files_between("sic", pd.Timestamp("1999-06-01"), pd.Timestamp("2001-06-01")) == \
+        [os.path.join(ds_config.path, "sic", "{}.nc".format(year)) for year in (2000, 2001)]
+
+    FileIndex(ds_config, cache_path)
+    assert read_files == ["2002.nc"]
+
+    # Without a cache path the index is held in memory only, so is built afresh
+    FileIndex(ds_config)
+    assert sorted(read_files) == ["2000.nc", "2001.nc", "2002.nc", "2002.nc"]
+    assert len(os.listdir(cache_path)) == 1
+
+
+def test_file_index_follows_replaced_files(tmp_path):
+    ds_config = DatasetConfig(location=Location("test", north=True),
+                              var_names=["sic"],
+                              path_components=[],
+                              identifier="source",
+                              levels=[None],
+                              base_path=str(tmp_path))
+    dates = pd.date_range("2001-01-01", "2001-01-10", freq="D")
+    ds_config.save_data_for_config(source_ds=xr.Dataset(
+        dict(sic=(("time", "yc", "xc"), np.zeros((len(dates), 2, 2)))), coords=dict(time=dates)))
+    index = FileIndex(ds_config)
+    assert len(index.dates("sic")) == 10
+
+    # Replacing a file within the resolution of the directory's modification time leaves that unchanged
+    var_path = os.path.join(ds_config.path, "sic")
+    file_path = os.path.join(var_path, "2001.nc")
+    dir_stat, file_stat = os.stat(var_path), os.stat(file_path)
+    temp_path = os.path.join(tmp_path, "replacement.nc")
+    dates = pd.date_range("2001-01-01", "2001-01-20", freq="D")
+    xr.Dataset(dict(sic=(("time", "yc", "xc"), np.zeros((len(dates), 2, 2)))),
+               coords=dict(time=dates)).to_netcdf(temp_path)
+    os.utime(temp_path, ns=(file_stat.st_atime_ns, file_stat.st_mtime_ns + 1))
+    os.replace(temp_path, file_path)
+    os.utime(var_path, ns=(dir_stat.st_atime_ns, dir_stat.st_mtime_ns))
+
+    index = FileIndex(ds_config)
+    assert len(index.dates("sic")) == 20
+
+    os.remove(file_path)
+    os.utime(var_path, ns=(dir_stat.st_atime_ns, dir_stat.st_mtime_ns))
+    index.refresh()
+    assert len(index.dates("sic")) == 0
+
+
+def test_trend_cache_follows_sources(tmp_path):
+    sources = [str(tmp_path / "{}.nc".format(year)) for year in (2000, 2001)]
+    source_starts = dict(zip(sources, pd.to_datetime(["2000-01-01", "2001-01-01"])))
+    for source in sources:
+        with open(source, "w") as fh:
+            fh.write("data")
+
+    def trend_cache(cache_sources, **kwargs):
+        return TrendCache(tmp_path / "cache", "sic", dict(dtype="float32", source_start="2000-01-01"),
+                          sources=file_fingerprints(cache_sources), **kwargs)
+
+    def trends(value):
+        return xr.DataArray(np.full((4, 2, 2), value, dtype=np.float32), dims=("time", "yc", "xc"),
+                            coords=dict(time=dates))
+
+    dates = pd.date_range("2000-12-30", periods=4, freq="D")
+    trend_cache(sources[:1], source_starts=source_starts).append(trends(1))
+
+    # Files new to the cache, or not in this run, don't change the trends already in it
+    pd.testing.assert_index_equal(trend_cache(sources, source_starts=source_starts).dates, dates)
+    pd.testing.assert_index_equal(trend_cache(sources[1:], source_starts=source_starts).dates, dates)
+    assert len(TrendCache(tmp_path / "cache", "sic", dict(dtype="float64", source_start="2000-01-01")).dates) == 0
+
+    # Rewriting a file drops only the trends from its first date, which are then cached in place
+    with open(sources[1], "a") as fh:
+        fh.write("changed")
+    cache = trend_cache(sources, source_starts=source_starts)
+    pd.testing.assert_index_equal(cache.dates, dates[:2])
+    cache.append(trends(2))
+
+    cache = trend_cache(sources, source_starts=source_starts)
+    pd.testing.assert_index_equal(cache.dates, dates)
+    np.testing.assert_array_equal(cache.get(dates).values[:, 0, 0], [1, 1, 2, 2])
+    with xr.open_zarr(next((tmp_path / "cache").glob("*.zarr"))) as store:
+        assert store.sizes["time"] == 4
+
+    # Without knowing where a changed file starts, every trend is dropped
+    with open(sources[0], "a") as fh:
+        fh.write("changed")
+    assert len(trend_cache(sources).dates) == 0
@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+
+"""Tests for `preprocess_toolbox.climatology`."""
+
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+
+from download_toolbox.interface import Frequency
+
+from preprocess_toolbox.climatology import compute_climatology, subtract_climatology
+
+
+@pytest.mark.parametrize("frequency, group", [(Frequency.MONTH, "month"), (Frequency.DAY, "dayofyear")])
+def test_climatology_matches_groupby(frequency, group):
+    rng = np.random.default_rng(42)
+    dates = pd.date_range("2000-01-01", "2002-12-31", freq="D")
+    data = rng.random((len(dates), 3, 4)).astype(np.float32)
+    data[rng.random(data.shape) < 0.1] = np.nan
+    da = xr.DataArray(data, dims=("time", "yc", "xc"), coords=dict(time=dates), name="sic").chunk(time=50)
+
+    clim_dates = dates[dates < "2002-03-01"]
+    expected = da.sel(time=clim_dates).groupby("time.{}".format(group)).mean()
+    climatology = compute_climatology(da, clim_dates, frequency)
+
+    assert climatology.dtype == da.dtype
+    np.testing.assert_array_equal(climatology[group].values, expected[group].values)
+    np.testing.assert_allclose(climatology.values, expected.values, rtol=1e-6)
+    np.testing.assert_allclose(subtract_climatology(da, climatology, frequency).values,
+                               (da.groupby("time.{}".format(group)) - expected).values, rtol=1e-5, atol=1e-6)
+
+
+@pytest.mark.parametrize("chunks", [dict(time=1), dict(time=400, xc=2)])
+def test_daily_climatology_chunking(chunks):
+    rng = np.random.default_rng(42)
+    dates = pd.date_range("2000-01-01", "2003-12-31", freq="D")
+    data = rng.random((len(dates), 3, 4)).astype(np.float32)
+    data[rng.random(data.shape) < 0.1] = np.nan
+    da = xr.DataArray(data, dims=("time", "yc", "xc"), coords=dict(time=dates), name="sic")
+
+    expected = da.groupby("time.dayofyear").mean()
+    climatology = compute_climatology(da.chunk(**chunks), dates, Frequency.DAY)
+
+    np.testing.assert_array_equal(climatology.dayofyear.values, np.arange(1, 367))
+    np.testing.assert_allclose(climatology.values, expected.values, rtol=1e-6)
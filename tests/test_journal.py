@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+
+"""Tests for `preprocess_toolbox.journal`."""
+
+import os
+
+import pytest
+
+import preprocess_toolbox.journal
+from preprocess_toolbox.journal import ProcessingJournal
+
+
+def test_journal_recovers_interrupted_commit(tmp_path, monkeypatch):
+    files = {name: str(tmp_path / "{}.nc".format(name)) for name in ("u", "v")}
+    temporaries = {name: str(tmp_path / "temp.{}.nc".format(name)) for name in ("u", "v")}
+
+    for name in files:
+        (tmp_path / "{}.nc".format(name)).write_text("raw")
+        (tmp_path / "temp.{}.nc".format(name)).write_text("rotated")
+
+    replace = os.replace
+
+    def interrupted_replace(src, dst):
+        if src == temporaries["v"]:
+            raise KeyboardInterrupt
+        replace(src, dst)
+
+    journal = ProcessingJournal(str(tmp_path / "journal"), "rotate", dict(reference="abc"))
+    monkeypatch.setattr(preprocess_toolbox.journal.os, "replace", interrupted_replace)
+
+    with pytest.raises(KeyboardInterrupt):
+        journal.commit({files[name]: temporaries[name] for name in files})
+
+    monkeypatch.setattr(preprocess_toolbox.journal.os, "replace", replace)
+    journal = ProcessingJournal(str(tmp_path / "journal"), "rotate", dict(reference="abc"))
+    assert not any([journal.is_complete(file_path) for file_path in files.values()])
+
+    journal.recover()
+    assert all([journal.is_complete(file_path) for file_path in files.values()])
+    assert all([open(file_path).read() == "rotated" for file_path in files.values()])
+
+    (tmp_path / "u.nc").write_text("new")
+    assert not journal.is_complete(files["u"])
@@ -0,0 +1,33 @@
+#!/usr/bin/env python
+
+"""Tests for `preprocess_toolbox.models`."""
+
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+
+from preprocess_toolbox.models import linear_trend_forecast, linear_trend_forecasts
+
+
+@pytest.fixture
+def history():
+    rng = np.random.default_rng(42)
+    data = rng.random((12, 4, 3))
+    data[5, 1, 1] = np.nan
+    return xr.DataArray(data,
+                        dims=("time", "yc", "xc"),
+                        coords=dict(time=pd.date_range("2000-01-01", periods=12, freq="D")))
+
+
+def test_linear_trend_forecasts_matches_lstsq(history):
+    counts = np.arange(len(history.time) + 1)
+    batched = linear_trend_forecasts(history.data, counts)
+
+    for count, output_map in zip(counts, batched):
+        expected = linear_trend_forecast(lambda da, date, missing: da.isel(time=slice(0, count)),
+                                         None,
+                                         history,
+                                         None,
+                                         shape=history.shape[1:])
+        np.testing.assert_allclose(output_map, expected, atol=1e-10)
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+
+"""Tests for `preprocess_toolbox.dataset.pipeline`."""
+
+import os
+
+import iris
+import iris.coord_systems
+import iris.coords
+import iris.cube
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from download_toolbox.dataset import DatasetConfig
+from download_toolbox.location import Location
+
+from preprocess_toolbox.dataset.pipeline import (MissingSpatialStage,
+                                                 MissingTimeStage,
+                                                 RegridStage,
+                                                 RotateStage,
+                                                 open_dataset_variables,
+                                                 run_pipeline)
+
+
+def test_open_dataset_variables(tmp_path):
+    rng = np.random.default_rng(42)
+    dates = pd.date_range("2000-12-20", periods=20, freq="D")
+    var_names = ["uas", "vas"]
+    ds = xr.Dataset({var_name: (("time", "yc", "xc"), rng.random((len(dates), 3, 4))) for var_name in var_names},
+                    coords=dict(time=dates))
+    ds_config = DatasetConfig(location=Location("test", north=True),
+                              var_names=var_names,
+                              path_components=[],
+                              identifier="source",
+                              levels=[None, None],
+                              base_path=str(tmp_path))
+    ds_config.save_data_for_config(source_ds=ds)
+
+    # Each variable has its own data, rather than that of the first to be opened
+    for opened in (open_dataset_variables(ds_config), open_dataset_variables(ds_config, ["vas"])):
+        for var_name in opened.data_vars:
+            np.testing.assert_allclose(opened[var_name].sortby("time").values, ds[var_name].values)
+    assert list(open_dataset_variables(ds_config, ["vas"]).data_vars) == ["vas"]
+
+
+def test_run_pipeline_writes_destination_once(tmp_path):
+    rng = np.random.default_rng(42)
+    dates = pd.date_range("2000-12-20", periods=20, freq="D")
+    observed = dates.delete([5, 14, 15])
+    var_names = ["uas", "vas"]
+    ds = xr.Dataset({var_name: (("time", "yc", "xc"), rng.random((len(observed), 3, 4)))
+                     for var_name in var_names},
+                    coords=dict(time=observed))
+
+    ds_config = DatasetConfig(location=Location("test", north=True),
+                              var_names=var_names,
+                              path_components=[],
+                              identifier="source",
+                              levels=[None, None],
+                              base_path=str(tmp_path))
+    ds_config.save_data_for_config(source_ds=ds)
+    source_files = sorted([source_file for var_files in ds_config.var_files.values() for source_file in var_files])
+    source_mtimes = [os.stat(source_file).st_mtime_ns for source_file in source_files]
+
+    run_pipeline(ds_config, [MissingTimeStage()], "destination")
+
+    assert ds_config.path == str(tmp_path / "destination")
+    assert [os.stat(source_file).st_mtime_ns for source_file in source_files] == source_mtimes
+
+    for var_name in var_names:
+        assert sorted(ds_config.var_files[var_name]) == \
+            [str(tmp_path / "destination" / var_name / "{}.nc".format(year)) for year in (2000, 2001)]
+
+        with xr.open_mfdataset(sorted(ds_config.var_files[var_name])) as filled_ds:
+            np.testing.assert_array_equal(filled_ds.time.values, dates.values)
+            np.testing.assert_allclose(filled_ds[var_name].values, ds[var_name].interp(time=dates).values)
+
+
+def reference_file(tmp_path, grid=8, extent=4e6):
+    cs = iris.coord_systems.LambertAzimuthalEqualArea(90, 0, ellipsoid=iris.coord_systems.GeogCS(6371228.0))
+    cube = iris.cube.Cube(np.zeros((grid, grid), dtype=np.float32), var_name="ref")
+    cube.add_dim_coord(iris.coords.DimCoord(np.linspace(extent, -extent, grid), "projection_y_coordinate",
+                                            var_name="yc", units="m", coord_system=cs), 0)
+    cube.add_dim_coord(iris.coords.DimCoord(np.linspace(-extent, extent, grid), "projection_x_coordinate",
+                                            var_name="xc", units="m", coord_system=cs), 1)
+    ref_file = str(tmp_path / "ref.nc")
+    iris.save(cube, ref_file)
+    return ref_file
+
+
+def test_run_pipeline_chains_spatial_stages(tmp_path):
+    rng = np.random.default_rng(42)
+    dates = pd.date_range("2000-01-01", periods=4, freq="D")
+    coords = dict(
+        time=dates,
+        latitude=xr.DataArray(np.linspace(90, 30, 31), dims="latitude",
+                              attrs=dict(standard_name="latitude", units="degrees_north")),
+        longitude=xr.DataArray(np.linspace(0, 360, 72, endpoint=False), dims="longitude",
+                               attrs=dict(standard_name="longitude", units="degrees_east")),
+    )
+    ds = xr.Dataset({var_name: (("time", "latitude", "longitude"), rng.random((len(dates), 31, 72)))
+                     for var_name in ("uas", "vas")}, coords=coords)
+    ds["uas"][1, 10:14, 20:24] = np.nan
+
+    ds_config = DatasetConfig(location=Location("test", north=True),
+                              var_names=["uas", "vas"],
+                              path_components=[],
+                              identifier="source",
+                              levels=[None, None],
+                              base_path=str(tmp_path))
+    ds_config.save_data_for_config(source_ds=ds)
+    source_files = sorted([source_file for var_files in ds_config.var_files.values() for source_file in var_files])
+    source_mtimes = [os.stat(source_file).st_mtime_ns for source_file in source_files]
+    ref_file = reference_file(tmp_path)
+    regridded = RegridStage(ref_file)(ds, ds_config).compute()
+
+    run_pipeline(ds_config,
+                 [RegridStage(ref_file), RotateStage(ref_file), MissingSpatialStage(block_size=2)],
+                 "destination")
+
+    assert [os.stat(source_file).st_mtime_ns for source_file in source_files] == source_mtimes
+    assert sorted(ds_config.var_files["uas"]) == [str(tmp_path / "destination" / "uas" / "2000.nc")]
+
+    ref_cube = iris.load_cube(ref_file)
+    with xr.open_mfdataset(sorted(ds_config.var_files["uas"] + ds_config.var_files["vas"])) as pipeline_ds:
+        assert pipeline_ds.uas.dims == ("time", "yc", "xc")
+        np.testing.assert_allclose(pipeline_ds.xc.values, ref_cube.coord("projection_x_coordinate").points)
+        np.testing.assert_array_equal(pipeline_ds.time.values, dates.values)
+        assert not pipeline_ds.uas.isnull().any() and not pipeline_ds.vas.isnull().any()
+
+        # Rotation keeps the magnitude of the regridded vectors
+        np.testing.assert_allclose(np.hypot(pipeline_ds.uas, pipeline_ds.vas)[[0, 2, 3]],
+                                   np.hypot(regridded.uas, regridded.vas)[[0, 2, 3]], rtol=1e-5)
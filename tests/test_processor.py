@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+
+"""Tests for `preprocess_toolbox.processor`."""
+
+import multiprocessing
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+
+from download_toolbox.dataset import DatasetConfig
+from download_toolbox.location import Location
+
+from preprocess_toolbox.processor import NormalisingChannelProcessor
+from preprocess_toolbox.profiling import disable_tracing, enable_tracing
+
+
+class ProcessingDatasetConfig(DatasetConfig):
+    """Processors record the configuration file of their source dataset"""
+
+    @property
+    def config_file(self) -> os.PathLike:
+        return self.config_path
+
+
+@pytest.fixture
+def ds_config(tmp_path):
+    rng = np.random.default_rng(42)
+    dates = pd.date_range("2000-01-01", "2001-12-31", freq="D")
+    seasonal = np.sin(2 * np.pi * dates.dayofyear.values / 365.25)[:, np.newaxis, np.newaxis]
+
+    ds_config = ProcessingDatasetConfig(location=Location("test", north=True),
+                                        var_names=["sic"],
+                                        path_components=[],
+                                        identifier="source",
+                                        levels=[None],
+                                        base_path=str(tmp_path))
+    ds_config.save_data_for_config(source_ds=xr.Dataset(
+        dict(sic=(("time", "yc", "xc"), (10 + seasonal + rng.random((len(dates), 2, 3))).astype(np.float32))),
+        coords=dict(time=dates)))
+    ds_config.save_config()
+    return ds_config
+
+
+def processor(ds_config, splits, identifier="processed", normalisation_splits=("train",), **kwargs):
+    return NormalisingChannelProcessor(ds_config,
+                                       ["sic"],
+                                       {split: [date.date() for date in dates] for split, dates in splits.items()},
+                                       ["sic"],
+                                       anom_clim_splits=["train"],
+                                       identifier=identifier,
+                                       base_path=os.path.join(ds_config.base_path, "processed"),
+                                       lag_time=0,
+                                       lead_time=0,
+                                       normalisation_splits=list(normalisation_splits),
+                                       parallel_opens=False,
+                                       **kwargs)
+
+
+def test_channels_are_normalised_separately(ds_config):
+    proc = processor(ds_config, dict(train=pd.date_range("2000-01-01", "2000-12-31")))
+    proc.process()
+
+    params = dict()
+    # Absolute values keep the parameter file named for the variable
+    for channel, param_name in (("sic_abs", "sic"), ("sic_anom", "sic_anom")):
+        with open(os.path.join(proc.path, "normalisation.scale", param_name)) as fh:
+            params[channel] = [float(param) for param in fh.read().split(",")]
+
+        with xr.open_dataarray(os.path.join(proc.path, "{}.nc".format(channel))) as da:
+            train_da = da.sel(time=slice("2000-01-01", "2000-12-31"))
+            np.testing.assert_allclose([train_da.min(), train_da.max()], [0, 1], atol=1e-5)
+
+    assert params["sic_abs"][0] > 9
+    assert params["sic_anom"][0] < 0
+
+
+def test_normalisation_dates_without_data(ds_config):
+    full = processor(ds_config, dict(train=pd.date_range("2000-01-01", "2000-12-31")), identifier="full")
+    full.process()
+    # Dates before the source data are left out of the statistics, rather than failing
+    proc = processor(ds_config,
+                     dict(train=pd.date_range("2000-01-01", "2000-12-31"),
+                          early=pd.date_range("1999-12-01", "1999-12-31")),
+                     normalisation_splits=("early", "train"))
+    proc.process()
+
+    for param_name in ("sic", "sic_anom"):
+        with open(os.path.join(proc.path, "normalisation.scale", param_name)) as fh, \
+                open(os.path.join(full.path, "normalisation.scale", param_name)) as full_fh:
+            np.testing.assert_allclose([float(param) for param in fh.read().split(",")],
+                                       [float(param) for param in full_fh.read().split(",")])
+
+
+def test_incremental_opens_only_new_files(ds_config, tmp_path, monkeypatch):
+    splits = dict(train=pd.date_range("2000-01-01", "2000-12-31"), test=pd.date_range("2001-01-01", "2001-12-31"))
+    new_file = os.path.join(ds_config.path, "sic", "2001.nc")
+    os.rename(new_file, tmp_path / "2001.nc")
+    processor(ds_config, splits).process()
+    os.rename(tmp_path / "2001.nc", new_file)
+
+    proc = processor(ds_config, splits, incremental=True)
+    opened = list()
+    open_source_files = proc._open_source_files
+    monkeypatch.setattr(proc, "_open_source_files",
+                        lambda var_name, source_files: opened.append(source_files) or
+                        open_source_files(var_name, source_files))
+    proc.process()
+    full = processor(ds_config, splits, identifier="full")
+    full.process()
+
+    assert opened == [[new_file]]
+    assert proc.get_config()["date_ranges"] == full.get_config()["date_ranges"] == \
+        dict(sic_abs=["2000-01-01T00:00:00", "2001-12-31T00:00:00"],
+             sic_anom=["2000-01-01T00:00:00", "2001-12-31T00:00:00"])
+
+    for channel in ("sic_abs", "sic_anom"):
+        with xr.open_dataarray(os.path.join(proc.path, "{}.nc".format(channel))) as da, \
+                xr.open_dataarray(os.path.join(full.path, "{}.nc".format(channel))) as full_da:
+            xr.testing.assert_allclose(da, full_da)
+
+
+def test_trace_kept_without_worker_pool(ds_config, monkeypatch):
+    # As when processing runs within some other child process, such as a pipeline worker
+    monkeypatch.setattr(multiprocessing, "parent_process", lambda: object())
+    proc = processor(ds_config, dict(train=pd.date_range("2000-01-01", "2000-03-31")))
+
+    tracer = enable_tracing(memory_interval=None, dask_tasks=False)
+    try:
+        proc.process()
+        events = tracer.drain()
+    finally:
+        disable_tracing()
+
+    assert [event["args"] for event in events if event["name"] == "variable"] == [dict(var="sic")]
@@ -0,0 +1,33 @@
+#!/usr/bin/env python
+
+"""Tests for `preprocess_toolbox.profiling`."""
+
+import time
+
+import dask.array
+import orjson
+
+from preprocess_toolbox.profiling import disable_tracing, enable_tracing, span
+
+
+def test_spans_and_dask_tasks_are_traced(tmp_path):
+    assert span("untraced") is span("untraced", var="sic")
+
+    tracer = enable_tracing(memory_interval=0.01)
+    try:
+        with span("normalisation", var="sic"):
+            dask.array.ones((10, 10), chunks=5).sum().compute()
+            time.sleep(0.05)
+        tracer.save(tmp_path / "trace.json")
+    finally:
+        disable_tracing()
+
+    with open(tmp_path / "trace.json", "rb") as fh:
+        trace = orjson.loads(fh.read())
+
+    spans = [event for event in trace["traceEvents"] if event.get("cat") == "processing"]
+    assert [(event["name"], event["args"]) for event in spans] == [("normalisation", dict(var="sic"))]
+    assert trace["otherData"]["totals"]["dask"]["sum"]["count"] == 4
+    assert any(event["ph"] == "C" for event in trace["traceEvents"])
+    assert all(spans[0]["ts"] <= event["ts"] <= spans[0]["ts"] + spans[0]["dur"]
+               for event in trace["traceEvents"] if event.get("cat") == "dask")
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+
+"""Tests for `preprocess_toolbox.dataset.regrid`."""
+
+import os
+
+import iris
+import iris.analysis
+import iris.coord_systems
+import iris.coords
+import iris.cube
+import numpy as np
+import pytest
+
+from preprocess_toolbox.dataset.regrid import LinearRegridder, get_regridder, linear_regrid_weights
+
+
+@pytest.fixture
+def source_cube():
+    rng = np.random.default_rng(42)
+    cs = iris.coord_systems.GeogCS(6371228.0)
+    data = rng.random((3, 31, 72)).astype(np.float32)
+    data[1, 10:14, 20:24] = np.nan
+
+    cube = iris.cube.Cube(data, var_name="uas")
+    cube.add_dim_coord(iris.coords.DimCoord(np.arange(3), var_name="time",
+                                            units="days since 2000-01-01"), 0)
+    cube.add_dim_coord(iris.coords.DimCoord(np.linspace(90, 30, 31), "latitude",
+                                            units="degrees", coord_system=cs), 1)
+    cube.add_dim_coord(iris.coords.DimCoord(np.linspace(0, 360, 72, endpoint=False), "longitude",
+                                            units="degrees", coord_system=cs, circular=True), 2)
+    return cube
+
+
+@pytest.fixture
+def target_cube():
+    cs = iris.coord_systems.LambertAzimuthalEqualArea(90, 0, ellipsoid=iris.coord_systems.GeogCS(6371228.0))
+    cube = iris.cube.Cube(np.zeros((10, 12), dtype=np.float32), var_name="ref")
+    cube.add_dim_coord(iris.coords.DimCoord(np.linspace(4e6, -4e6, 10), "projection_y_coordinate",
+                                            units="m", coord_system=cs), 0)
+    cube.add_dim_coord(iris.coords.DimCoord(np.linspace(-4e6, 4e6, 12), "projection_x_coordinate",
+                                            units="m", coord_system=cs), 1)
+    return cube
+
+
+def test_linear_regrid_weights_match_iris(source_cube, target_cube):
+    expected = source_cube.regrid(target_cube, iris.analysis.Linear())
+    weights = linear_regrid_weights(source_cube, target_cube)
+
+    assert weights.shape == (10 * 12, 31 * 72)
+    regridded = (weights @ source_cube.data.reshape(3, -1).T).T.reshape(3, 10, 12)
+    np.testing.assert_allclose(regridded, np.ma.filled(expected.data, np.nan), rtol=1e-5, atol=1e-6)
+
+
+def test_linear_regridder_matches_iris(source_cube, target_cube, tmp_path):
+    expected = source_cube.regrid(target_cube, iris.analysis.Linear())
+    regridder = LinearRegridder(source_cube, target_cube, tmp_path)
+    regridded = regridder(source_cube)
+
+    assert regridded.shape == expected.shape
+    assert regridded.coord("time") == expected.coord("time")
+    assert regridded.coord(axis="x") == expected.coord(axis="x")
+    assert regridded.coord(axis="y") == expected.coord(axis="y")
+    np.testing.assert_allclose(regridded.data, np.ma.filled(expected.data, np.nan), rtol=1e-5, atol=1e-6)
+
+    # The weights are stored for reuse, giving the same result when loaded
+    assert os.listdir(tmp_path) == ["{}.npz".format(regridder.key)]
+    cached = LinearRegridder(source_cube, target_cube, tmp_path)
+    np.testing.assert_array_equal(cached(source_cube).data, regridded.data)
+
+
+def test_linear_regridder_rejects_other_grids(source_cube, target_cube):
+    regridder = get_regridder(source_cube, target_cube)
+
+    with pytest.raises(ValueError):
+        regridder(source_cube[:, :20])
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+
+"""Tests for `preprocess_toolbox.dataset.spatial`."""
+
+import os
+import types
+
+import iris.analysis.cartography
+import iris.coord_systems
+import iris.coords
+import iris.cube
+import numpy as np
+import pandas as pd
+import pytest
+import scipy.interpolate
+import xarray as xr
+
+from download_toolbox.interface import Frequency
+
+import preprocess_toolbox.dataset.spatial
+from preprocess_toolbox.dataset.spatial import (cached_gridcell_angles,
+                                                gridcell_angle_terms,
+                                                invert_gridcell_angles,
+                                                gridcell_angles_from_dim_coords,
+                                                interpolation_weights,
+                                                rotate_grid_vectors,
+                                                spatial_interpolation)
+
+
+def vector_cubes(grid=8, extent=4e6):
+    rng = np.random.default_rng(42)
+    cs = iris.coord_systems.LambertAzimuthalEqualArea(90, 0, ellipsoid=iris.coord_systems.GeogCS(6371228.0))
+    cubes = list()
+
+    for var_name in ("uas", "vas"):
+        data = np.ma.masked_array(rng.random((3, grid, grid)), mask=False)
+        cube = iris.cube.Cube(data, var_name=var_name)
+        cube.add_dim_coord(iris.coords.DimCoord(np.arange(3), var_name="time",
+                                                units="days since 2000-01-01"), 0)
+        cube.add_dim_coord(iris.coords.DimCoord(np.linspace(extent, -extent, grid), "projection_y_coordinate",
+                                                units="m", coord_system=cs), 1)
+        cube.add_dim_coord(iris.coords.DimCoord(np.linspace(-extent, extent, grid), "projection_x_coordinate",
+                                                units="m", coord_system=cs), 2)
+        cubes.append(cube)
+    cubes[0].data[1, 2:4, 3:5] = np.ma.masked
+    return cubes
+
+
+def test_spatial_interpolation_matches_griddata():
+    rng = np.random.default_rng(42)
+    shape = (20, 16)
+    data = rng.random((3, *shape))
+    data[:2, 3:6, 4:9] = np.nan
+    data[:2, 12:14, 10] = np.nan
+    data[2, 8:15, 2:5] = np.nan
+    da = xr.DataArray(data.copy(), dims=("time", "yc", "xc"),
+                      coords=dict(time=pd.date_range("2000-01-01", periods=3, freq="D")))
+
+    filled = spatial_interpolation(da, types.SimpleNamespace(frequency=Frequency.DAY)).values
+
+    for date_idx in range(len(data)):
+        invalid = np.isnan(data[date_idx])
+        invalid_idxs, neighbour_idxs, _ = interpolation_weights(np.packbits(invalid).tobytes(), shape)
+        neighbour_rows, neighbour_cols = np.unravel_index(neighbour_idxs, shape)
+        invalid_rows, invalid_cols = np.unravel_index(invalid_idxs, shape)
+
+        expected = scipy.interpolate.griddata((neighbour_cols, neighbour_rows),
+                                              data[date_idx].ravel()[neighbour_idxs],
+                                              (invalid_cols, invalid_rows),
+                                              method="linear")
+        np.testing.assert_allclose(filled[date_idx][invalid], expected, atol=1e-12)
+        np.testing.assert_array_equal(filled[date_idx][~invalid], data[date_idx][~invalid])
+
+
+def test_rotate_grid_vectors_matches_iris():
+    u_cube, v_cube = vector_cubes()
+    angles = gridcell_angles_from_dim_coords(u_cube[0])
+    u_rotated, v_rotated = rotate_grid_vectors(u_cube, v_cube, angles)
+
+    for date_idx in range(u_cube.shape[0]):
+        u_expected, v_expected = iris.analysis.cartography.rotate_grid_vectors(u_cube[date_idx],
+                                                                              v_cube[date_idx],
+                                                                              grid_angles_cube=angles)
+        for rotated, expected in ((u_rotated, u_expected), (v_rotated, v_expected)):
+            np.testing.assert_array_equal(np.ma.getmaskarray(rotated[date_idx].data),
+                                          np.ma.getmaskarray(expected.data))
+            np.testing.assert_allclose(np.ma.filled(rotated[date_idx].data, np.nan),
+                                       np.ma.filled(expected.data, np.nan), atol=1e-12)
+
+    # Precomputed terms of the angles rotate just the same
+    for rotated, from_terms in zip((u_rotated, v_rotated),
+                                   rotate_grid_vectors(u_cube, v_cube, gridcell_angle_terms(angles))):
+        np.testing.assert_array_equal(np.ma.filled(from_terms.data, np.nan), np.ma.filled(rotated.data, np.nan))
+
+
+@pytest.mark.parametrize("invert", [False, True])
+def test_cached_gridcell_angles(tmp_path, monkeypatch, invert):
+    cube = vector_cubes()[0][0]
+    expected = gridcell_angles_from_dim_coords(cube)
+    if invert:
+        invert_gridcell_angles(expected)
+    angles = cached_gridcell_angles(cube, tmp_path, invert=invert)
+    cache_files = os.listdir(tmp_path)
+
+    assert len(cache_files) == 1
+
+    # The second call must come from the cache rather than calculating the angles again
+    def calculate(cube):
+        raise AssertionError("gridcell angles calculated despite being cached")
+    monkeypatch.setattr(preprocess_toolbox.dataset.spatial, "gridcell_angles_from_dim_coords", calculate)
+    cached = cached_gridcell_angles(cube, tmp_path, invert=invert)
+    assert os.listdir(tmp_path) == cache_files
+
+    # Cached angles are shared between jobs, so must not be writable
+    assert not cached.data.flags.writeable
+    assert cached.name() == expected.name()
+
+    for result in (angles, cached):
+        assert result.coord(axis="x", dim_coords=True) == expected.coord(axis="x", dim_coords=True)
+        assert result.coord(axis="y", dim_coords=True) == expected.coord(axis="y", dim_coords=True)
+        np.testing.assert_allclose(np.ma.filled(result.data, np.nan),
+                                   np.ma.filled(expected.data, np.nan))
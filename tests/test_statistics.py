@@ -0,0 +1,36 @@
+#!/usr/bin/env python
+
+"""Tests for `preprocess_toolbox.statistics`."""
+
+import dask.array
+import numpy as np
+import pandas as pd
+
+from preprocess_toolbox.statistics import SufficientStatistics
+
+
+def test_sufficient_statistics_match_numpy(tmp_path):
+    rng = np.random.default_rng(42)
+    data = (100 + rng.random((30, 4, 5))).astype(np.float32)
+    data[rng.random(data.shape) < 0.1] = np.nan
+    data[7] = np.nan
+    dates = pd.date_range("2000-01-01", periods=len(data), freq="D")
+
+    # Merging statistics of chunks, and of dates added later, matches statistics of the whole
+    stats = SufficientStatistics.from_array(dask.array.from_array(data[:20], chunks=(3, 2, 5)), dates[:20])
+    stats.save(tmp_path / "stats.json")
+    stats = SufficientStatistics.load(tmp_path / "stats.json").merge(
+        SufficientStatistics.from_array(data[20:], dates[20:]))
+
+    values = data.astype(np.float64)
+    assert stats.count == np.count_nonzero(~np.isnan(data))
+    np.testing.assert_allclose([stats.mean, stats.std], [np.nanmean(values), np.nanstd(values)], rtol=1e-12)
+    assert (stats.minimum, stats.maximum) == (np.nanmin(data), np.nanmax(data))
+    pd.testing.assert_index_equal(stats.dates.sort_values(), dates)
+
+
+def test_sufficient_statistics_empty():
+    stats = SufficientStatistics.from_array(np.full((2, 3), np.nan)).merge(SufficientStatistics())
+
+    assert stats.count == 0
+    assert np.isnan(stats.std)
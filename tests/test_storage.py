@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+
+"""Tests for `preprocess_toolbox.storage`."""
+
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+
+from preprocess_toolbox.storage import NetCDFBackend, ZarrBackend
+
+
+@pytest.mark.parametrize("backend, unlimited", [(NetCDFBackend(), True), (NetCDFBackend(), False),
+                                                (ZarrBackend(), True)])
+def test_append_extends_time(tmp_path, backend, unlimited):
+    rng = np.random.default_rng(42)
+    dates = pd.date_range("2000-01-01", periods=10, freq="D")
+    da = xr.DataArray(rng.random((len(dates), 3, 4)).astype(np.float32), dims=("time", "yc", "xc"),
+                      coords=dict(time=dates, yc=np.arange(3), xc=np.arange(4)), name="sic_abs")
+    da[2, 1, 1] = np.nan
+    file_path = str(tmp_path / backend.filename("sic_abs.nc"))
+
+    if unlimited:
+        backend.write(da.isel(time=slice(0, 6)), file_path)
+    else:
+        # As written before time was unlimited
+        da.isel(time=slice(0, 6)).to_netcdf(file_path)
+
+    backend.append(da.isel(time=slice(6, 8)), file_path)
+    backend.append(da.isel(time=slice(8, None)).chunk(), file_path)
+
+    appended = backend.open_dataarray(file_path)
+    np.testing.assert_array_equal(appended.time.values, dates.values)
+    np.testing.assert_array_equal(appended.values, da.values)
+    appended.close()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+
+"""Tests for `preprocess_toolbox.dataset.time`."""
+
+import types
+
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+
+from download_toolbox.dataset import DatasetConfig
+from download_toolbox.interface import Frequency, get_dataset_config_implementation
+from download_toolbox.location import Location
+
+from preprocess_toolbox.dataset.time import (INVALID_DATES_KEY,
+                                             get_invalid_dates,
+                                             load_invalid_dates,
+                                             process_missing_dates,
+                                             set_invalid_dates)
+
+
+@pytest.fixture
+def gappy_ds():
+    rng = np.random.default_rng(42)
+    dates = pd.date_range("2000-01-01", periods=40, freq="D")
+    observed = dates.delete([3, 10, 11, 20, 21, 22, 23, 24, 25])
+    return xr.Dataset(dict(sic=(("time", "yc", "xc"), rng.random((len(observed), 3, 4)))),
+                      coords=dict(time=observed)), dates
+
+
+def test_process_missing_dates_matches_interp(gappy_ds):
+    ds, dates = gappy_ds
+    ds_config = types.SimpleNamespace(frequency=Frequency.DAY)
+    filled = process_missing_dates(ds.copy(), ds_config, "sic").sic
+
+    np.testing.assert_array_equal(filled.time.values, dates.values)
+    np.testing.assert_allclose(filled.values, ds.sic.interp(time=dates).values)
+
+
+@pytest.mark.parametrize("reindexed", [False, True])
+def test_process_missing_dates_several_variables(gappy_ds, reindexed):
+    ds, dates = gappy_ds
+    ds["vas"] = ds.sic * 2
+    ds_config = types.SimpleNamespace(frequency=Frequency.DAY)
+    # Absent dates are empty once the files of each variable are opened together
+    source_ds = ds.reindex(time=dates) if reindexed else ds.copy()
+    filled = process_missing_dates(source_ds, ds_config, ["sic", "vas"])
+
+    for var_name in ("sic", "vas"):
+        np.testing.assert_array_equal(filled[var_name].time.values, dates.values)
+        np.testing.assert_allclose(filled[var_name].values, ds[var_name].interp(time=dates).values)
+
+
+def test_process_missing_dates_max_gap(gappy_ds):
+    ds, dates = gappy_ds
+    ds_config = types.SimpleNamespace(frequency=Frequency.DAY)
+    filled = process_missing_dates(ds.copy(), ds_config, "sic", max_gap=2).sic
+    unfilled = filled.isnull().all(dim=("yc", "xc"))
+
+    np.testing.assert_array_equal(filled.time.values[unfilled.values], dates[20:26].values)
+
+
+def test_process_missing_dates_nan_threshold(gappy_ds):
+    ds, dates = gappy_ds
+    ds["sic"][5, :2] = np.nan
+    ds["sic"][6, :1] = np.nan
+    ds_config = types.SimpleNamespace(frequency=Frequency.DAY)
+    filled = process_missing_dates(ds.copy(), ds_config, "sic", nan_threshold=0.5).sic
+    expected = ds.sic.drop_isel(time=5).interp(time=dates)
+
+    np.testing.assert_allclose(filled.values[~np.isnan(expected.values)], expected.values[~np.isnan(expected.values)])
+    assert getattr(ds_config, INVALID_DATES_KEY) == [ds.time.to_index()[5].strftime("%Y-%m-%d")]
+    assert not hasattr(ds_config, "_invalid_dates")
+
+
+def test_invalid_dates_round_trip(tmp_path):
+    invalid_dates = pd.DatetimeIndex(["2000-01-04", "2000-01-11"])
+    ds_config = DatasetConfig(location=Location("test", north=True),
+                              var_names=["sic"],
+                              path_components=[],
+                              identifier="source",
+                              levels=[None],
+                              base_path=str(tmp_path))
+    set_invalid_dates(ds_config, invalid_dates)
+    config_path = ds_config.save_config()
+
+    for _ in range(2):
+        ds_config = get_dataset_config_implementation(config_path)
+        load_invalid_dates(ds_config)
+        pd.testing.assert_index_equal(get_invalid_dates(ds_config), invalid_dates)
+        # Saving again must keep the dates for the next stage to read
+        config_path = ds_config.save_config()
+